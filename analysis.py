@@ -0,0 +1,712 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Payload analysis routines used by the Statisfier and the Grapher.
+
+Most functions operate on a payload matrix as returned by
+ColumnarCapture.payload_matrix: a (packets x offsets) uint8 array of byte
+values along with a boolean array of the same shape marking which bytes
+were actually present in each packet.
+"""
+
+import numpy as np
+
+from urbtracker import UrbTracker
+
+
+class OffsetStats(object):
+    """Statistics for a single payload offset.
+
+        * offset: byte offset within the data payload
+        * count: number of packets which have a byte at this offset
+        * entropy: Shannon entropy of the byte values, in bits (0-8)
+        * change_rate: fraction of consecutive packet pairs in which the
+          byte changed
+        * bit_toggles: list of 8 counts, the number of times each bit
+          (LSB first) changed between consecutive packets
+        * score: ranking score; higher scores are more interesting
+    """
+
+    def __init__(self, offset, count, entropy, change_rate, bit_toggles):
+        self.offset = offset
+        self.count = count
+        self.entropy = entropy
+        self.change_rate = change_rate
+        self.bit_toggles = bit_toggles
+
+    @property
+    def score(self):
+        # Both terms are in [0, 1]; a byte which never changes scores 0.
+        return self.entropy / 8.0 + self.change_rate
+
+    @property
+    def toggling_bits(self):
+        """Mask of the bits which changed at least once."""
+        return sum(1 << b for b, n in enumerate(self.bit_toggles) if n)
+
+    def __repr__(self):
+        return '<OffsetStats offset=%d entropy=%.3f change_rate=%.3f>' % (
+                self.offset, self.entropy, self.change_rate)
+
+
+def _byte_counts(data, valid):
+    """Number of occurrences of each byte value in each column of a payload
+    matrix, as a (width, 256) array."""
+    width = data.shape[1]
+    cols = np.broadcast_to(np.arange(width), data.shape)
+    return np.bincount((cols[valid] << 8) | data[valid],
+                       minlength=width * 256).reshape(width, 256)
+
+
+def _entropy(counts):
+    totals = counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = counts / totals[:, np.newaxis].astype(float)
+        logs = np.where(counts > 0, np.log2(p), 0.0)
+    entropy = -(p * logs).sum(axis=1)
+    entropy[totals == 0] = 0.0
+    return entropy
+
+
+def byte_entropy(data, valid):
+    """Shannon entropy, in bits, of each column of a payload matrix."""
+    return _entropy(_byte_counts(data, valid))
+
+
+def _change_counts(data, valid):
+    """Number of consecutive (present) byte pairs in each column, how many
+    of them differ, and the per-bit toggle counts, shape (width, 8)."""
+    width = data.shape[1]
+    if len(data) < 2:
+        return (np.zeros(width, np.int64), np.zeros(width, np.int64),
+                np.zeros((width, 8), np.int64))
+    pairs = valid[1:] & valid[:-1]
+    xor = (data[1:] ^ data[:-1]) * pairs
+    npairs = pairs.sum(axis=0)
+    changed = (xor != 0).sum(axis=0)
+    # unpackbits gives MSB first; reverse so index b is bit b
+    bits = np.unpackbits(xor[:, :, np.newaxis], axis=2)[:, :, ::-1]
+    toggles = bits.sum(axis=0, dtype=np.int64)
+    return npairs, changed, toggles
+
+
+def _rates(npairs, changed):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(npairs > 0, changed / npairs.astype(float), 0.0)
+
+
+def change_rates(data, valid):
+    """Fraction of consecutive (present) byte pairs in each column which
+    differ, and the per-bit toggle counts.
+
+    Returns a tuple (rates, toggles) where toggles has shape (width, 8).
+    """
+    npairs, changed, toggles = _change_counts(data, valid)
+    return _rates(npairs, changed), toggles
+
+
+def _block_rows(width, block_elems):
+    """Number of matrix rows to process at once so that a block holds
+    about block_elems elements."""
+    return max(1, block_elems // max(width, 1))
+
+
+def _matrix_blocks(data, valid, block_elems):
+    """Generate (data, valid) blocks of consecutive rows of a payload
+    matrix."""
+    step = _block_rows(data.shape[1], block_elems)
+    for start in range(0, len(data), step):
+        yield data[start:start+step], valid[start:start+step]
+
+
+def payload_blocks(capture, rows, width, block_elems=1 << 22):
+    """Generate the payloads of the given packets of a ColumnarCapture as
+    consecutive payload matrices of width columns and about block_elems
+    bytes: (data, valid, ts) tuples, ts being the packet timestamps. Only
+    one block is held in memory at a time, however many packets there
+    are."""
+    headers = capture.headers
+    step = _block_rows(width, block_elems)
+    for start in range(0, len(rows), step):
+        block = rows[start:start+step]
+        data, valid = capture.payload_matrix(block, width)
+        ts = headers['ts_sec'][block] + headers['ts_usec'][block] / 1e6
+        yield data, valid, ts
+
+
+class OffsetStatsAccumulator(object):
+    """Computes the OffsetStats of a payload matrix of width columns whose
+    rows are added a block at a time, in order, with add()."""
+
+    def __init__(self, width):
+        self.width = width
+        self.counts = np.zeros((width, 256), np.int64)
+        self.npairs = np.zeros(width, np.int64)
+        self.changed = np.zeros(width, np.int64)
+        self.toggles = np.zeros((width, 8), np.int64)
+        # last row of the previous block, paired with the next block's first
+        self.last = None
+
+    def add(self, data, valid):
+        data = np.asarray(data, np.uint8)
+        valid = np.asarray(valid, bool)
+        if not len(data):
+            return
+        self.counts += _byte_counts(data, valid)
+        last = self.last
+        self.last = data[-1:], valid[-1:]
+        if last is not None:
+            data = np.concatenate((last[0], data))
+            valid = np.concatenate((last[1], valid))
+        npairs, changed, toggles = _change_counts(data, valid)
+        self.npairs += npairs
+        self.changed += changed
+        self.toggles += toggles
+
+    def stats(self):
+        """OffsetStats of every column, most interesting first."""
+        entropy = _entropy(self.counts)
+        rates = _rates(self.npairs, self.changed)
+        totals = self.counts.sum(axis=1)
+        stats = [OffsetStats(i, int(totals[i]), float(entropy[i]),
+                             float(rates[i]), self.toggles[i].tolist())
+                 for i in range(self.width)]
+        stats.sort(key=lambda s: (-s.score, s.offset))
+        return stats
+
+
+def offset_stats(data, valid, block_elems=1 << 22):
+    """Compute OffsetStats for each column of a payload matrix and return
+    them ranked, most interesting first."""
+    data = np.asarray(data, np.uint8)
+    valid = np.asarray(valid, bool)
+    acc = OffsetStatsAccumulator(data.shape[1])
+    for block in _matrix_blocks(data, valid, block_elems):
+        acc.add(*block)
+    return acc.stats()
+
+
+def field_stats(capture, width=None, block_elems=1 << 22):
+    """Compute ranked OffsetStats for every endpoint in a ColumnarCapture.
+
+    Returns a dict mapping (busnum, devnum, epnum) to a list of OffsetStats,
+    skipping endpoints which never carried any data. The payloads of each
+    endpoint are read a block of about block_elems bytes at a time.
+    """
+    result = dict()
+    datalen = capture.datalen
+    for addr, rows in capture.endpoints().items():
+        rows = rows[datalen[rows] > 0]
+        if len(rows) == 0:
+            continue
+        acc = OffsetStatsAccumulator(width or int(datalen[rows].max()))
+        for data, valid, ts in payload_blocks(capture, rows, acc.width,
+                                              block_elems):
+            acc.add(data, valid)
+        result[addr] = acc.stats()
+    return result
+
+
+class CorrelationAccumulator(object):
+    """Pearson correlation coefficient between every pair of columns of a
+    payload matrix of width columns whose rows are added a block at a time
+    with add().
+
+    Each coefficient is computed over the packets in which both bytes are
+    present. Only a few (width x width) matrices of sums are kept, however
+    many rows are added. Coefficients involving a constant column are 0.
+    """
+
+    def __init__(self, width):
+        self.count = np.zeros((width, width))
+        # sum_x[i,j]: sum of x_i where j valid
+        self.sum_x = np.zeros((width, width))
+        self.sum_xx = np.zeros((width, width))
+        self.sum_xy = np.zeros((width, width))
+
+    def add(self, data, valid):
+        v = valid.astype(float)
+        x = data * v
+        self.count += np.dot(v.T, v)
+        self.sum_x += np.dot(x.T, v)
+        self.sum_xx += np.dot((x * x).T, v)
+        self.sum_xy += np.dot(x.T, x)
+
+    def result(self):
+        """The (width x width) correlation matrix."""
+        count, sum_x = self.count, self.sum_x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.sum_xy - sum_x * sum_x.T / count
+            var_x = self.sum_xx - sum_x ** 2 / count
+            corr = cov / np.sqrt(var_x * var_x.T)
+        corr[~np.isfinite(corr)] = 0.0
+        # rounding can push |r| very slightly over 1
+        np.clip(corr, -1.0, 1.0, out=corr)
+        return corr
+
+
+def correlation_matrix(data, valid, block_elems=1 << 22):
+    """Pearson correlation coefficient between every pair of columns of a
+    payload matrix (see CorrelationAccumulator), accumulated over blocks of
+    about block_elems elements."""
+    acc = CorrelationAccumulator(data.shape[1])
+    for block in _matrix_blocks(data, valid, block_elems):
+        acc.add(*block)
+    return acc.result()
+
+
+class TimeCorrelationAccumulator(object):
+    """Pearson correlation of each column of a payload matrix with the
+    packet timestamps, e.g. to spot counters and slowly drifting values;
+    rows are added a block at a time with add()."""
+
+    def __init__(self, width):
+        # timestamps are taken relative to the first one, for precision
+        self.t0 = None
+        self.n = np.zeros(width)
+        self.sum_x = np.zeros(width)
+        self.sum_xx = np.zeros(width)
+        self.sum_t = np.zeros(width)
+        self.sum_tt = np.zeros(width)
+        self.sum_xt = np.zeros(width)
+
+    def add(self, data, valid, ts):
+        ts = np.asarray(ts, float)
+        if not len(ts):
+            return
+        if self.t0 is None:
+            self.t0 = ts[0]
+        t = (ts - self.t0)[:, np.newaxis]
+        v = valid.astype(float)
+        x = data * v
+        tv = t * v
+        self.n += v.sum(axis=0)
+        self.sum_x += x.sum(axis=0)
+        self.sum_xx += (x * x).sum(axis=0)
+        self.sum_t += tv.sum(axis=0)
+        self.sum_tt += (tv * t).sum(axis=0)
+        self.sum_xt += (x * t).sum(axis=0)
+
+    def result(self):
+        n = self.n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.sum_xt - self.sum_x * self.sum_t / n
+            var_x = self.sum_xx - self.sum_x ** 2 / n
+            var_t = self.sum_tt - self.sum_t ** 2 / n
+            # a constant column may be left with a rounding error
+            var_x[var_x <= 1e-12 * self.sum_xx] = 0.0
+            corr = cov / np.sqrt(var_x * var_t)
+        corr[~np.isfinite(corr)] = 0.0
+        np.clip(corr, -1.0, 1.0, out=corr)
+        return corr
+
+
+def time_correlation(data, valid, ts, block_elems=1 << 22):
+    """Pearson correlation of each column of a payload matrix with the
+    packet timestamps (see TimeCorrelationAccumulator)."""
+    ts = np.asarray(ts, float)
+    acc = TimeCorrelationAccumulator(data.shape[1])
+    step = _block_rows(data.shape[1], block_elems)
+    for start in range(0, len(data), step):
+        acc.add(data[start:start+step], valid[start:start+step],
+                ts[start:start+step])
+    return acc.result()
+
+
+def mutual_information(data, valid, columns=None, bins=16,
+                       block_elems=1 << 22, group_elems=1 << 24):
+    """Mutual information, in bits, between pairs of columns of a payload
+    matrix.
+
+    Byte values are quantized into ``bins`` levels to keep the joint
+    histograms small. Only the given columns are considered (by default the
+    ones which are not constant, since a constant byte carries no
+    information). Returns a tuple (columns, mi) where mi[a,b] is the mutual
+    information between columns[a] and columns[b].
+    """
+    if columns is None:
+        columns = [s.offset for s in offset_stats(data, valid) if s.score > 0]
+        columns.sort()
+    blocks = lambda: _matrix_blocks(data, valid, block_elems)
+    return list(columns), mutual_information_blocks(blocks, columns, bins,
+                                                    group_elems)
+
+
+def mutual_information_blocks(blocks, columns, bins=16, group_elems=1 << 24):
+    """Mutual information, in bits, between pairs of the given columns of a
+    payload matrix read in blocks: blocks() must return a new iterator over
+    its consecutive blocks of rows, (data, valid, ...) tuples, each time it
+    is called.
+
+    The joint histograms of a group of columns against all the others are
+    kept as uint32 counts of about group_elems elements in all, and the
+    blocks are read once per group, so memory use depends on neither the
+    number of rows nor (beyond the k x k result) the number of columns.
+    Returns mi, where mi[a,b] is the mutual information between columns[a]
+    and columns[b].
+    """
+    columns = np.asarray(columns, int)
+    k = len(columns)
+    cells = bins * bins
+    mi = np.zeros((k, k))
+    group = max(1, group_elems // max(k * cells, 1))
+    pair_index = np.arange(k) * cells
+    for first in range(0, k, group):
+        last = min(first + group, k)
+        joint = np.zeros((last - first, k * cells), np.uint32)
+        for block in blocks():
+            data, valid = block[0], block[1]
+            q = (data[:, columns].astype(np.int64) * bins) >> 8
+            qv = valid[:, columns]
+            for a in range(first, last):
+                both = qv & qv[:, a:a+1]
+                codes = (q[:, a:a+1] * bins + q + pair_index)[both]
+                joint[a - first] += np.bincount(
+                        codes, minlength=k * cells).astype(np.uint32)
+        for a in range(first, last):
+            p = joint[a - first].reshape(k, bins, bins).astype(float)
+            total = p.sum(axis=(1, 2))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p /= total[:, np.newaxis, np.newaxis]
+                pa = p.sum(axis=2)[:, :, np.newaxis]
+                pb = p.sum(axis=1)[:, np.newaxis, :]
+                terms = np.where(p > 0, p * np.log2(p / (pa * pb)), 0.0)
+            mi[a] = terms.sum(axis=(1, 2))
+    mi[~np.isfinite(mi)] = 0.0
+    return mi
+
+
+class EndianPair(object):
+    """A pair of adjacent offsets which looks like a 16-bit value.
+
+        * offset: offset of the first byte of the pair
+        * endian: 'little' (low byte first) or 'big'
+        * score: fraction of high-byte changes in which the combined 16-bit
+          value moved only slightly, i.e. the low byte carried into (or
+          borrowed from) the high byte
+        * events: number of high-byte changes seen
+    """
+
+    def __init__(self, offset, endian, score, events):
+        self.offset = offset
+        self.endian = endian
+        self.score = score
+        self.events = events
+
+    def __repr__(self):
+        return '<EndianPair offset=%d %s score=%.3f events=%d>' % (
+                self.offset, self.endian, self.score, self.events)
+
+
+ENDIANS = ('little', 'big')
+
+class EndianPairAccumulator(object):
+    """Finds adjacent offsets of a payload matrix of width columns which
+    behave like little- or big-endian 16-bit values (counters, analog
+    readings split into high/low bytes); rows are added a block at a time,
+    in order, with add().
+
+    For each pair of offsets and byte order, it counts the changes of the
+    high byte, the changes of the low byte and the high-byte changes in
+    which the 16-bit value moved by at most max_step.
+    """
+
+    def __init__(self, width, max_step=0x40):
+        pairs = max(width - 1, 0)
+        self.max_step = max_step
+        self.events = np.zeros((len(ENDIANS), pairs), np.int64)
+        self.lo_changes = np.zeros((len(ENDIANS), pairs), np.int64)
+        self.small = np.zeros((len(ENDIANS), pairs), np.int64)
+        # last (first byte, second byte) seen of each pair
+        self.last = [None] * pairs
+
+    def add(self, data, valid):
+        for i in range(len(self.last)):
+            both = valid[:, i] & valid[:, i+1]
+            a = data[both, i].astype(np.int64)
+            b = data[both, i+1].astype(np.int64)
+            if not len(a):
+                continue
+            if self.last[i] is not None:
+                a = np.concatenate(([self.last[i][0]], a))
+                b = np.concatenate(([self.last[i][1]], b))
+            self.last[i] = a[-1], b[-1]
+            for e, (lo, hi) in enumerate(((a, b), (b, a))):
+                hi_changed = np.diff(hi) != 0
+                step = np.abs(np.diff(lo + (hi << 8)))
+                self.events[e, i] += hi_changed.sum()
+                self.lo_changes[e, i] += (np.diff(lo) != 0).sum()
+                self.small[e, i] += (step[hi_changed] <= self.max_step).sum()
+
+    def pairs(self, min_score=0.5, min_events=2):
+        """Return a list of EndianPair, best first."""
+        result = list()
+        for i in range(len(self.last)):
+            candidates = []
+            for e, endian in enumerate(ENDIANS):
+                events = int(self.events[e, i])
+                # the low byte of a 16-bit value changes more often than
+                # the high byte
+                if events == 0 or self.lo_changes[e, i] <= events:
+                    score = 0.0
+                else:
+                    score = float(self.small[e, i]) / events
+                candidates.append((endian, score, events))
+            endian, score, events = max(candidates, key=lambda c: c[1])
+            if score >= min_score and events >= min_events:
+                result.append(EndianPair(i, endian, score, events))
+        result.sort(key=lambda p: (-p.score, -p.events, p.offset))
+        return result
+
+
+def endian_pairs(data, valid, min_score=0.5, min_events=2, max_step=0x40,
+                 block_elems=1 << 22):
+    """Find adjacent offsets which behave like little- or big-endian 16-bit
+    values (see EndianPairAccumulator).
+
+    Returns a list of EndianPair, best first.
+    """
+    acc = EndianPairAccumulator(data.shape[1], max_step)
+    for block in _matrix_blocks(data, valid, block_elems):
+        acc.add(*block)
+    return acc.pairs(min_score, min_events)
+
+
+def correlated_pairs(corr, threshold=0.9):
+    """List (i, j, r) for the column pairs (i < j) of a correlation matrix
+    whose absolute correlation is at least threshold, strongest first."""
+    i, j = np.nonzero(np.triu(np.abs(corr) >= threshold, 1))
+    pairs = [(int(a), int(b), float(corr[a, b])) for a, b in zip(i, j)]
+    pairs.sort(key=lambda p: (-abs(p[2]), p[0], p[1]))
+    return pairs
+
+
+class LogHistogram(object):
+    """Histogram of positive durations (in seconds) with logarithmically
+    spaced bins, so that microseconds and minutes can be told apart in a
+    fixed amount of memory."""
+
+    def __init__(self, lo=1e-6, hi=1e4, per_octave=8):
+        self.lo = lo
+        self.per_octave = per_octave
+        nbins = int(np.ceil(np.log2(hi / lo) * per_octave)) + 1
+        self.counts = np.zeros(nbins, np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, values):
+        values = np.asarray(values, float).ravel()
+        if not len(values):
+            return
+        with np.errstate(divide='ignore'):
+            bins = np.floor(np.log2(np.maximum(values, 0) / self.lo) *
+                            self.per_octave)
+        bins = np.clip(np.nan_to_num(bins), 0, len(self.counts) - 1)
+        self.counts += np.bincount(bins.astype(np.int64),
+                                   minlength=len(self.counts))
+        self.n += len(values)
+        self.total += values.sum()
+        lo, hi = values.min(), values.max()
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else None
+
+    def quantile(self, q):
+        """Approximate q-quantile (0 <= q <= 1): the geometric center of the
+        bin it falls in, clamped to the observed range."""
+        if not self.n:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.counts), q * self.n))
+        index = min(index, len(self.counts) - 1)
+        value = self.lo * 2 ** ((index + 0.5) / self.per_octave)
+        return min(max(value, self.min), self.max)
+
+    def mode(self):
+        """Approximate most common value."""
+        if not self.n:
+            return None
+        index = int(np.argmax(self.counts))
+        value = self.lo * 2 ** ((index + 0.5) / self.per_octave)
+        return min(max(value, self.min), self.max)
+
+
+class Throughput(object):
+    """Bytes per time bucket. When the series would grow past max_buckets,
+    adjacent buckets are merged and the bucket width doubles, so memory use
+    is bounded however long the capture is."""
+
+    def __init__(self, bucket=1.0, max_buckets=4096):
+        self.bucket = bucket
+        self.max_buckets = max_buckets - max_buckets % 2
+        self.origin = None
+        self.counts = np.zeros(self.max_buckets, np.int64)
+        self.used = 0
+
+    def add(self, ts, nbytes):
+        ts = np.asarray(ts, float)
+        if not len(ts):
+            return
+        if self.origin is None:
+            self.origin = ts[0]
+        index = np.floor((ts - self.origin) / self.bucket).astype(np.int64)
+        np.maximum(index, 0, out=index)
+        while index.max() >= self.max_buckets:
+            self.counts = np.concatenate((
+                    self.counts.reshape(-1, 2).sum(axis=1),
+                    np.zeros(self.max_buckets // 2, np.int64)))
+            self.bucket *= 2
+            self.used = (self.used + 1) // 2
+            index //= 2
+        self.counts += np.bincount(index, weights=nbytes,
+                                   minlength=self.max_buckets).astype(np.int64)
+        self.used = max(self.used, int(index.max()) + 1)
+
+    def series(self):
+        """Return (start times, bytes per second) of the used buckets."""
+        times = self.origin + np.arange(self.used) * self.bucket
+        return times, self.counts[:self.used] / float(self.bucket)
+
+
+def interval_seconds(interval, high_speed):
+    """Period of a declared usbmon 'interval' value: a number of 1 ms
+    frames at low and full speed, 2**(interval - 1) 125 us microframes at
+    high and super speed."""
+    if high_speed:
+        return 2 ** (interval - 1) * 125e-6
+    return interval * 1e-3
+
+
+class EndpointTiming(object):
+    """Timing behaviour of a single endpoint.
+
+        * interarrival: dict of LogHistogram by event type ('S', 'C') of the
+          time between consecutive events of that type
+        * latency: LogHistogram of the time from submission to callback
+        * intervals: dict counting the 'interval' values of the submissions
+          (isochronous and interrupt endpoints only)
+        * throughput: Throughput of the payload bytes
+    """
+
+    def __init__(self, bucket=1.0, max_buckets=4096):
+        self.packets = 0
+        self.bytes = 0
+        self.last_ts = dict()
+        self.interarrival = dict(S=LogHistogram(), C=LogHistogram())
+        self.latency = LogHistogram()
+        self.intervals = dict()
+        self.throughput = Throughput(bucket, max_buckets)
+
+    def add_events(self, event_type, ts):
+        """Add the (sorted) timestamps of events of one type."""
+        if not len(ts):
+            return
+        if self.last_ts.get(event_type) is not None:
+            ts = np.concatenate(([self.last_ts[event_type]], ts))
+        self.interarrival[event_type].add(np.diff(ts))
+        self.last_ts[event_type] = ts[-1]
+
+    def polling_estimate(self):
+        """Estimated polling period: the most common time between callbacks."""
+        return self.interarrival['C'].mode()
+
+    def declared_interval(self):
+        """Most common 'interval' value of the submissions, or None."""
+        if not self.intervals:
+            return None
+        return max(self.intervals, key=self.intervals.get)
+
+    def declared_period(self, high_speed=None):
+        """Period in seconds of the declared interval, as a tuple (period,
+        high_speed), or None. When the bus speed isn't given, it is taken
+        to be the one whose period is closest to the polling estimate."""
+        interval = self.declared_interval()
+        if interval is None:
+            return None
+        if high_speed is None:
+            estimate = self.polling_estimate()
+            if estimate is None or estimate <= 0 or interval < 1:
+                high_speed = False
+            else:
+                # compare on a log scale: periods differ by factors
+                error = lambda hs: abs(np.log(
+                        interval_seconds(interval, hs) / estimate))
+                high_speed = error(True) < error(False)
+        return interval_seconds(interval, high_speed), high_speed
+
+
+class TimingStats(object):
+    """Streaming per-endpoint timing statistics. Feed it consecutive chunks
+    of a capture (as ColumnarCapture objects) with update()."""
+
+    def __init__(self, bucket=1.0, max_buckets=4096, urb_timeout=60.0):
+        self.bucket = bucket
+        self.max_buckets = max_buckets
+        self.urb_timeout = urb_timeout
+        self.endpoints = dict()
+        self.urbs = UrbTracker(urb_timeout)
+
+    def endpoint(self, addr):
+        if addr not in self.endpoints:
+            self.endpoints[addr] = EndpointTiming(self.bucket,
+                                                  self.max_buckets)
+        return self.endpoints[addr]
+
+    def update(self, capture):
+        ts = capture.ts
+        events = capture.event_type
+        datalen = capture.datalen
+        periodic = capture.xfer_type <= 1   # isochronous or interrupt
+        for addr, rows in capture.endpoints().items():
+            ep = self.endpoint(addr)
+            ep.packets += len(rows)
+            ep.bytes += int(datalen[rows].sum())
+            ep.throughput.add(ts[rows], datalen[rows])
+            for event_type in ('S', 'C'):
+                ep.add_events(event_type, ts[rows[events[rows] == event_type]])
+            subs = rows[(events[rows] == 'S') & periodic[rows]]
+            for value, n in zip(*np.unique(capture.interval[subs],
+                                           return_counts=True)):
+                ep.intervals[int(value)] = ep.intervals.get(int(value), 0) + n
+        self.match_urbs(capture)
+
+    def match_urbs(self, capture):
+        """Pair submissions with callbacks to measure latency."""
+        keys = capture.endpoint_keys().tolist()
+        latencies = dict()
+        for t, ev, bus, urb, key in zip(capture.ts.tolist(),
+                                        capture.event_type.tolist(),
+                                        capture.busnum.tolist(),
+                                        capture.urb.tolist(), keys):
+            if ev == 'S':
+                self.urbs.submit(bus, urb, t)
+            else:
+                match = self.urbs.complete(bus, urb, t)
+                if match is not None and ev == 'C':
+                    latencies.setdefault(key, []).append(match[0])
+        for key, values in latencies.items():
+            addr = (key >> 16, (key >> 8) & 0xff, key & 0xff)
+            self.endpoint(addr).latency.add(values)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""List-like sequence stored in fixed-size blocks.
+
+A BlockList behaves like a Python list but keeps its items in a list of
+blocks of at most a few hundred items each, plus a Fenwick tree (binary
+indexed tree) of the block sizes. Looking up an item is a descent of the
+tree, and inserting or deleting items only moves the items of the blocks
+concerned and updates O(log n) tree nodes, so that deleting rows from the
+middle of a capture of millions of packets neither copies the capture nor
+walks all of its blocks. The tree is only rebuilt when blocks are split,
+merged or dropped, which happens at most once per block_size edits.
+
+snapshot() returns an independent copy in O(n / block_size) time by
+sharing the blocks; a block is copied by whichever list modifies it first.
+"""
+
+from itertools import chain, islice
+
+
+class BlockList(object):
+    """A mutable sequence stored as a list of blocks.
+
+    Supports len(), indexing (including negative indices), item assignment,
+    contiguous slices, append/extend/insert, deletion of single items or
+    contiguous slices, deletion of many scattered items in one pass with
+    delete_indices() and copy-on-write copies with snapshot().
+    """
+
+    def __init__(self, iterable=(), block_size=512):
+        self.block_size = block_size
+        self.blocks = []
+        # Fenwick tree of the block sizes, 1-based: tree[k] is the number
+        # of items in blocks (k - (k & -k), k]. It misses the last _tail
+        # items appended, and is rebuilt first when _stale.
+        self.tree = [0]
+        self._tail = 0
+        self._stale = False
+        self.length = 0
+        # ids of the blocks shared with a snapshot, copied before changing
+        self._shared = set()
+        self.extend(iterable)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return chain.from_iterable(self.blocks)
+
+    def __repr__(self):
+        return 'BlockList(%r)' % list(self)
+
+    def snapshot(self):
+        """Return a copy of the list, sharing its blocks until either list
+        modifies them."""
+        copy = BlockList(block_size=self.block_size)
+        self._sync()
+        copy.blocks = list(self.blocks)
+        copy.tree = list(self.tree)
+        copy.length = self.length
+        self._shared = set(id(block) for block in self.blocks)
+        copy._shared = set(self._shared)
+        return copy
+
+    def _own(self, b):
+        """Return block b, copying it first if it is shared."""
+        block = self.blocks[b]
+        if id(block) in self._shared:
+            self._shared.discard(id(block))
+            block = self.blocks[b] = list(block)
+        return block
+
+    def _rebuild(self):
+        """Rebuild the tree after blocks were added or removed."""
+        tree = [0] + [len(block) for block in self.blocks]
+        n = len(self.blocks)
+        for k in xrange(1, n + 1):
+            parent = k + (k & -k)
+            if parent <= n:
+                tree[parent] += tree[k]
+        self.tree = tree
+        self._tail = 0
+        self._stale = False
+
+    def _sync(self):
+        """Bring the tree up to date."""
+        if self._stale:
+            self._rebuild()
+        elif self._tail:
+            tail, self._tail = self._tail, 0
+            self._resize(len(self.blocks) - 1, tail)
+
+    def _resize(self, b, delta):
+        """Account for delta items added to (or removed from) block b."""
+        if self._stale:
+            return
+        k = b + 1
+        tree = self.tree
+        while k < len(tree):
+            tree[k] += delta
+            k += k & -k
+
+    def _index(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('BlockList index out of range')
+        return i
+
+    def _locate(self, i):
+        """Return (block number, offset in block) of item i."""
+        self._sync()
+        tree = self.tree
+        n = len(tree) - 1
+        b = 0
+        step = 1 << (n.bit_length() - 1) if n else 0
+        while step:
+            k = b + step
+            if k <= n and tree[k] <= i:
+                b = k
+                i -= tree[k]
+            step >>= 1
+        return b, i
+
+    def _range(self, s):
+        start, stop, step = s.indices(self.length)
+        if step != 1:
+            raise ValueError('BlockList only supports contiguous slices')
+        return start, max(start, stop)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop = self._range(i)
+            return list(self.iter_range(start, stop))
+        b, off = self._locate(self._index(i))
+        return self.blocks[b][off]
+
+    def __setitem__(self, i, value):
+        b, off = self._locate(self._index(i))
+        self._own(b)[off] = value
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop = self._range(i)
+        else:
+            start = self._index(i)
+            stop = start + 1
+        self.delete_range(start, stop)
+
+    def iter_range(self, start, stop):
+        """Iterate over the items from index start up to stop."""
+        if start >= stop:
+            return iter(())
+        b, off = self._locate(start)
+        items = chain(islice(self.blocks[b], off, None),
+                      chain.from_iterable(self.blocks[b+1:]))
+        return islice(items, stop - start)
+
+    def _new_block(self):
+        """Append an empty block."""
+        self._sync()
+        self.blocks.append([])
+        # the new last node covers blocks (k - (k & -k), k]
+        tree = self.tree
+        k = len(tree)
+        total = 0
+        j = k - 1
+        while j > k - (k & -k):
+            total += tree[j]
+            j -= j & -j
+        tree.append(total)
+
+    def append(self, item):
+        if not self.blocks or len(self.blocks[-1]) >= self.block_size:
+            self._new_block()
+        block = self.blocks[-1]
+        if self._shared and id(block) in self._shared:
+            block = self._own(-1)
+        block.append(item)
+        self._tail += 1
+        self.length += 1
+
+    def extend(self, iterable):
+        items = iter(iterable)
+        room = max(self.block_size - len(self.blocks[-1]), 0) \
+               if self.blocks else 0
+        chunk = list(islice(items, room or self.block_size))
+        while chunk:
+            if room:
+                block = self._own(len(self.blocks) - 1)
+            else:
+                self._new_block()
+                block = self.blocks[-1]
+            block.extend(chunk)
+            self._tail += len(chunk)
+            self.length += len(chunk)
+            room = 0
+            chunk = list(islice(items, self.block_size))
+
+    def insert(self, i, item):
+        if i < 0:
+            i = max(i + self.length, 0)
+        if i >= self.length:
+            self.append(item)
+            return
+        b, off = self._locate(i)
+        block = self._own(b)
+        block.insert(off, item)
+        self.length += 1
+        if len(block) > 2 * self.block_size:
+            half = len(block) // 2
+            self.blocks[b:b+1] = [block[:half], block[half:]]
+            self._stale = True
+        else:
+            self._resize(b, 1)
+
+    def delete_range(self, start, stop):
+        """Delete the items from index start up to stop."""
+        if start >= stop:
+            return
+        first, off = self._locate(start)
+        b = first
+        remaining = stop - start
+        while remaining:
+            block = self._own(b)
+            n = min(remaining, len(block) - off)
+            del block[off:off+n]
+            self._resize(b, -n)
+            remaining -= n
+            b += 1
+            off = 0
+        self.length -= stop - start
+        self._collect(first, b)
+
+    def delete_indices(self, indices):
+        """Delete the items at the given (sorted, distinct) indices in a
+        single pass over the blocks concerned."""
+        doomed = dict()
+        count = 0
+        for i in indices:
+            b, off = self._locate(self._index(i))
+            doomed.setdefault(b, set()).add(off)
+            count += 1
+        if not count:
+            return
+        for b, offs in doomed.iteritems():
+            self.blocks[b] = [item for j, item in enumerate(self.blocks[b])
+                              if j not in offs]
+            self._resize(b, -len(offs))
+        self.length -= count
+        self._collect(min(doomed), max(doomed) + 1)
+
+    def _collect(self, first, stop):
+        """Drop empty blocks among blocks[first:stop] and merge small
+        neighbours, marking the tree stale if that changed the blocks."""
+        kept = []
+        for block in self.blocks[first:stop]:
+            if not block:
+                continue
+            if kept and len(kept[-1]) + len(block) <= self.block_size:
+                # (a new list: either block may be shared with a snapshot)
+                kept[-1] = kept[-1] + block
+            else:
+                kept.append(block)
+        if len(kept) != stop - first:
+            self.blocks[first:stop] = kept
+            self._stale = True
+
+    def clear(self):
+        self.blocks = []
+        self.tree = [0]
+        self._tail = 0
+        self._stale = False
+        self.length = 0
+        self._shared = set()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Growable column storage for payload bytes.
+
+The Grapher keeps every payload byte it has seen, one row per packet and one
+column per payload offset. A ByteStore holds them in a single preallocated
+2-D NumPy array whose capacity is doubled (in rows or in columns) whenever it
+runs out, so that appending a packet is amortized O(1), and a column, or the
+last few rows of one, can be handed to a plot as a view without copying.
+Offsets beyond the end of a shorter payload hold the MISSING sentinel.
+
+A MinMaxPyramid summarizes a column at several resolutions so that long
+stretches of it can be plotted as a min/max envelope.
+"""
+
+import numpy as np
+
+# value of the bytes a payload doesn't have
+MISSING = 0xFFFF
+
+
+class ByteStore(object):
+    """Payload bytes of a sequence of packets, as a growable uint16 matrix.
+
+    len() is the number of packets (rows) and width the length of the
+    longest payload (columns) appended so far. Each row can also have a
+    timestamp; rows are expected to be appended in time order, so that the
+    rows of a time range can be found by binary search.
+
+    >>> store = ByteStore()
+    >>> store.append([1, 2, 3])
+    >>> store.append([4])
+    >>> store.column(2).tolist()
+    [3, 65535]
+    >>> store.valid(2).tolist()
+    [True, False]
+    """
+
+    def __init__(self, rows=1024, columns=64):
+        self.array = np.empty((max(rows, 1), max(columns, 1)), np.uint16)
+        self.array.fill(MISSING)
+        self.length = 0
+        self.width = 0
+        self.ts = ValueColumn(rows)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        """Byte at (row, offset), or MISSING."""
+        row, col = index
+        if not 0 <= row < self.length or not 0 <= col < self.width:
+            raise IndexError(index)
+        return int(self.array[row, col])
+
+    def _grow(self, rows, columns):
+        capacity = self.array.shape
+        if rows <= capacity[0] and columns <= capacity[1]:
+            return
+        shape = [size if needed <= size else max(needed, size * 2)
+                 for needed, size in zip((rows, columns), capacity)]
+        array = np.empty(shape, np.uint16)
+        array.fill(MISSING)
+        array[:self.length, :self.width] = self.array[:self.length, :self.width]
+        self.array = array
+
+    def widen(self, columns):
+        """Make the matrix at least columns wide."""
+        self._grow(self.length, columns)
+        self.width = max(self.width, columns)
+
+    def append(self, data, ts=np.nan):
+        """Append the payload of a packet: a sequence of byte values or a
+        string, and its timestamp."""
+        if isinstance(data, str):
+            data = np.frombuffer(data, np.uint8)
+        n = len(data)
+        self._grow(self.length + 1, n)
+        # rows past the end are kept filled with MISSING, so only the
+        # payload itself is written
+        self.array[self.length, :n] = data
+        self.length += 1
+        self.width = max(self.width, n)
+        self.ts.append(ts)
+
+    def append_matrix(self, data, valid, timestamps):
+        """Append the payloads of several packets at once, as returned by
+        ColumnarCapture.payload_matrix(): a (rows, width) matrix of bytes
+        and a boolean matrix which is False past the end of each payload;
+        and their timestamps."""
+        n = len(data)
+        lengths = valid.sum(axis=1)
+        w = int(lengths.max()) if n else 0
+        self._grow(self.length + n, w)
+        self.array[self.length:self.length + n, :w] = \
+                np.where(valid[:, :w], data[:, :w], MISSING)
+        self.length += n
+        self.width = max(self.width, w)
+        self.ts.extend(timestamps)
+
+    def extend(self, payloads, timestamps=None):
+        if timestamps is None:
+            timestamps = [np.nan] * len(payloads)
+        for data, ts in zip(payloads, timestamps):
+            self.append(data, ts)
+
+    def timestamps(self, start=0, stop=None):
+        """Timestamps of rows start to stop, as a view."""
+        return self.ts.values(start, stop)
+
+    def row_at(self, ts):
+        """Index of the first row whose timestamp is at least ts."""
+        return int(np.searchsorted(self.timestamps(), ts, 'left'))
+
+    def values(self):
+        """The (rows, width) matrix of bytes, as a view."""
+        return self.array[:self.length, :self.width]
+
+    def column(self, offset, start=0, stop=None):
+        """Bytes at a payload offset of rows start to stop, as a view."""
+        if stop is None:
+            stop = self.length
+        return self.array[start:stop, offset]
+
+    def valid(self, offset, start=0, stop=None):
+        """Boolean array which is True where the column has a byte."""
+        return self.column(offset, start, stop) != MISSING
+
+    def float_column(self, offset, start=0, stop=None):
+        """Bytes at a payload offset as a float64 array, NaN where missing
+        (a copy, suitable as a MinMaxPyramid source)."""
+        column = self.column(offset, start, stop)
+        values = column.astype(np.float64)
+        values[column == MISSING] = np.nan
+        return values
+
+    def clear(self):
+        self.array.fill(MISSING)
+        self.length = 0
+        self.width = 0
+        self.ts.clear()
+
+
+class ValueColumn(object):
+    """A growable float64 column of values, NaN where missing, for values
+    computed from payload bytes (such as the Grapher's custom byte
+    expressions) which do not fit in a byte.
+
+    >>> col = ValueColumn()
+    >>> col.append(300)
+    >>> col.append(None)
+    >>> col.valid().tolist()
+    [True, False]
+    """
+
+    def __init__(self, rows=1024):
+        self.array = np.empty(max(rows, 1), np.float64)
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, value):
+        """Append a value; None stands for a missing value."""
+        if self.length == len(self.array):
+            array = np.empty(len(self.array) * 2, np.float64)
+            array[:self.length] = self.array
+            self.array = array
+        self.array[self.length] = np.nan if value is None else value
+        self.length += 1
+
+    def extend(self, values):
+        """Append an array of values (NaN where missing)."""
+        n = self.length + len(values)
+        if n > len(self.array):
+            array = np.empty(max(n, len(self.array) * 2), np.float64)
+            array[:self.length] = self.array[:self.length]
+            self.array = array
+        self.array[self.length:n] = values
+        self.length = n
+
+    def values(self, start=0, stop=None):
+        """Values of rows start to stop, as a view."""
+        if stop is None:
+            stop = self.length
+        return self.array[start:stop]
+
+    def valid(self, start=0, stop=None):
+        return ~np.isnan(self.values(start, stop))
+
+    def clear(self):
+        self.length = 0
+
+
+class MinMaxPyramid(object):
+    """Minimum and maximum of a column over buckets of fanout, fanout**2,
+    fanout**3, ... rows, so that any range of the column, however long, can
+    be drawn as the min/max envelope of a few thousand buckets.
+
+    source(start, stop) must return the values of rows start to stop of the
+    column as a float64 array, NaN where missing. update() aggregates the
+    rows appended since its last call; only complete buckets are stored.
+
+    >>> values = np.arange(100.0)
+    >>> pyramid = MinMaxPyramid(lambda start, stop: values[start:stop], 4)
+    >>> pyramid.update(100)
+    >>> x, lo, hi = pyramid.envelope(0, 100, 5)
+    >>> x.tolist(), lo.tolist(), hi.tolist()
+    ([0, 32, 64, 96], [0.0, 32.0, 64.0, 96.0], [31.0, 63.0, 95.0, 99.0])
+    """
+
+    def __init__(self, source, fanout=8):
+        self.source = source
+        self.fanout = fanout
+        self.length = 0
+        # (mins, maxs) of the buckets of fanout**(k+1) rows, for level k
+        self.levels = []
+
+    def update(self, length):
+        """Aggregate the column up to row length."""
+        self.length = length
+        fanout = self.fanout
+        size = fanout
+        k = 0
+        while length >= size:
+            if k == len(self.levels):
+                self.levels.append((ValueColumn(), ValueColumn()))
+            mins, maxs = self.levels[k]
+            first, last = len(mins), length // size
+            if last > first:
+                if k == 0:
+                    lo = hi = self.source(first * fanout, last * fanout)
+                else:
+                    below_mins, below_maxs = self.levels[k - 1]
+                    lo = below_mins.values(first * fanout, last * fanout)
+                    hi = below_maxs.values(first * fanout, last * fanout)
+                mins.extend(np.fmin.reduce(lo.reshape(-1, fanout), axis=1))
+                maxs.extend(np.fmax.reduce(hi.reshape(-1, fanout), axis=1))
+            size *= fanout
+            k += 1
+
+    def envelope(self, start, stop, buckets):
+        """Downsample rows start to stop to at most about buckets buckets.
+
+        Returns (x, lo, hi): the first row of each bucket and the minimum
+        and maximum of its values (NaN if it has none). Buckets are aligned
+        to those of the pyramid, so the first one may begin before start.
+        When the range is
+        short enough to be drawn as it is, x is every row and lo and hi are
+        the same array of values.
+        """
+        stop = min(stop, self.length)
+        start = min(start, stop)
+        # the coarsest level with at least as many buckets as asked for
+        k = -1
+        size = 1
+        while (k + 1 < len(self.levels) and
+               size * self.fanout * buckets <= stop - start):
+            k += 1
+            size *= self.fanout
+        if k < 0:
+            values = self.source(start, stop)
+            return np.arange(start, stop), values, values
+
+        mins, maxs = self.levels[k]
+        first = start // size
+        end = max(first, min(-(-stop // size), len(mins)))
+        x = np.arange(first, end) * size
+        lo = mins.values(first, end)
+        hi = maxs.values(first, end)
+        tail = max(end * size, start)
+        if tail < stop:
+            # the last, incomplete bucket isn't stored
+            values = self.source(tail, stop)
+            x = np.append(x, tail)
+            lo = np.append(lo, np.fmin.reduce(values))
+            hi = np.append(hi, np.fmax.reduce(values))
+        if len(x) > buckets:
+            index = np.arange(0, len(x), -(-len(x) // buckets))
+            x = x[index]
+            lo = np.fmin.reduceat(lo, index)
+            hi = np.fmax.reduceat(hi, index)
+        return x, lo, hi
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
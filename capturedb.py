@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""SQLite store of USB captures.
+
+A CaptureDB keeps any number of usbmon captures in one SQLite database, a
+row per packet in the 'packets' table, so that old captures can be queried
+with SQL instead of being read and filtered again each time. Besides the raw
+usbmon header and the data payload (as blobs, from which the packet is
+rebuilt exactly) each row has decoded columns:
+
+    capture         id of the capture in the 'captures' table
+    urb             URB id (as a signed 64-bit integer)
+    event_type      'S', 'C' or 'E'
+    xfer_type       0 isochronous, 1 interrupt, 2 control, 3 bulk
+    busnum, devnum, epnum
+    ts              timestamp, in seconds since the epoch
+    status, length, datalen
+    bmRequestType, bRequest, wValue, wIndex, wLength
+                    fields of the setup packet; NULL unless the packet
+                    has one
+
+with indexes on the device, the endpoint and the timestamp (led by devnum,
+as the --device and --endpoint options of usbdb.py select packets by devnum
+and epnum alone). Captures are imported a chunk of packets at a time through
+ColumnarCapture, with the indexes dropped for the duration, and query
+results are returned as pcap records, ready for a PcapWriter.
+"""
+
+import sqlite3
+from struct import unpack_from
+
+import numpy as np
+
+from columnar import ColumnarCapture, USBMON_HEADER_LEN, is_saved_capture
+from pcapfile import PcapHeader, PcapStream, LINKTYPE_USB_LINUX_MMAPPED
+from usbrevue import SETUP_REQUEST_TYPES, USBMON_PACKET_FORMAT
+
+# number of packets inserted at a time
+IMPORT_CHUNK = 65536
+
+# (format, offset) of the timestamp fields of the usbmon header
+TS_SEC = USBMON_PACKET_FORMAT['ts_sec']
+TS_USEC = USBMON_PACKET_FORMAT['ts_usec']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id              INTEGER PRIMARY KEY,
+    name            TEXT,
+    linktype        INTEGER,
+    snaplen         INTEGER
+);
+CREATE TABLE IF NOT EXISTS packets (
+    id              INTEGER PRIMARY KEY,
+    capture         INTEGER REFERENCES captures(id),
+    urb             INTEGER,
+    event_type      TEXT,
+    xfer_type       INTEGER,
+    busnum          INTEGER,
+    devnum          INTEGER,
+    epnum           INTEGER,
+    ts              REAL,
+    status          INTEGER,
+    length          INTEGER,
+    datalen         INTEGER,
+    bmRequestType   INTEGER,
+    bRequest        INTEGER,
+    wValue          INTEGER,
+    wIndex          INTEGER,
+    wLength         INTEGER,
+    header          BLOB,
+    data            BLOB
+);
+'''
+
+# dropped by the imports and created again once the packets are in, which
+# is much faster than updating the indexes with every insert
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS packets_device ON packets (devnum, ts);
+CREATE INDEX IF NOT EXISTS packets_endpoint ON packets (devnum, epnum, ts);
+CREATE INDEX IF NOT EXISTS packets_ts ON packets (ts);
+'''
+DROP_INDEXES = '''
+DROP INDEX IF EXISTS packets_device;
+DROP INDEX IF EXISTS packets_endpoint;
+DROP INDEX IF EXISTS packets_ts;
+'''
+
+# decoded columns filled from the usbmon header fields of the same name
+HEADER_COLUMNS = ('urb', 'event_type', 'xfer_type', 'busnum', 'devnum',
+                  'epnum', 'ts', 'status', 'length', 'datalen')
+SETUP_COLUMNS = ('bmRequestType', 'bRequest', 'wValue', 'wIndex', 'wLength')
+COLUMNS = ('capture',) + HEADER_COLUMNS + SETUP_COLUMNS + ('header', 'data')
+
+# bRequest values of the HID class requests (bmRequestType type 'class')
+HID_CLASS_REQUESTS = dict(
+        GET_REPORT      = 0x01,
+        GET_IDLE        = 0x02,
+        GET_PROTOCOL    = 0x03,
+        SET_REPORT      = 0x09,
+        SET_IDLE        = 0x0A,
+        SET_PROTOCOL    = 0x0B,
+)
+
+# mask and values of the type bits of bmRequestType
+REQUEST_TYPE_MASK = 0x60
+STANDARD_REQUEST = 0x00
+CLASS_REQUEST = 0x20
+
+
+def request_condition(name):
+    """SQL condition (with its parameters) selecting the control requests
+    called name: a standard request (e.g. GET_DESCRIPTOR) or an HID class
+    request (e.g. SET_REPORT). Raises ValueError for unknown names."""
+    name = name.upper()
+    if name in HID_CLASS_REQUESTS:
+        return ('bRequest = ? AND (bmRequestType & %d) = %d' %
+                (REQUEST_TYPE_MASK, CLASS_REQUEST), [HID_CLASS_REQUESTS[name]])
+    if name in SETUP_REQUEST_TYPES and isinstance(SETUP_REQUEST_TYPES[name],
+                                                  int):
+        return ('bRequest = ? AND (bmRequestType & %d) = %d' %
+                (REQUEST_TYPE_MASK, STANDARD_REQUEST),
+                [SETUP_REQUEST_TYPES[name]])
+    raise ValueError('unknown request: %s' % name)
+
+
+def build_query(where=None, device=None, endpoint=None, request=None,
+                capture=None):
+    """Combine an SQL condition on the packets table with the usual
+    restrictions into a WHERE clause; returns (clause, parameters), clause
+    being empty if there is no condition at all.
+
+    device is a devnum, endpoint an epnum, request a request name for
+    request_condition() and capture a capture name.
+    """
+    conditions, params = [], []
+    if where:
+        conditions.append('(%s)' % where)
+    if device is not None:
+        conditions.append('devnum = ?')
+        params.append(device)
+    if endpoint is not None:
+        conditions.append('epnum = ?')
+        params.append(endpoint)
+    if request is not None:
+        condition, request_params = request_condition(request)
+        conditions.append(condition)
+        params.extend(request_params)
+    if capture is not None:
+        conditions.append('capture IN (SELECT id FROM captures WHERE name = ?)')
+        params.append(capture)
+    if not conditions:
+        return '', params
+    return 'WHERE ' + ' AND '.join(conditions), params
+
+
+class CaptureDB(object):
+    """A database of captures at path (which is created if need be; use
+    ':memory:' for a temporary one)."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        # (the indexes are missing if an import was interrupted)
+        self.db.executescript(SCHEMA + INDEXES)
+
+    def close(self):
+        self.db.close()
+
+    def drop_indexes(self):
+        """Drop the indexes of the packets table, before a bulk insert."""
+        self.db.executescript(DROP_INDEXES)
+
+    def create_indexes(self):
+        """Create the indexes of the packets table again."""
+        self.db.executescript(INDEXES)
+
+    def captures(self):
+        """List of (id, name, linktype, snaplen, packets) of the captures
+        imported."""
+        return self.db.execute(
+                'SELECT c.id, c.name, c.linktype, c.snaplen, '
+                '(SELECT COUNT(*) FROM packets p WHERE p.capture = c.id) '
+                'FROM captures c ORDER BY c.id').fetchall()
+
+    def import_capture(self, capture, name=None, chunk_size=IMPORT_CHUNK,
+                       reindex=True):
+        """Insert the packets of a ColumnarCapture as a new capture called
+        name. Returns the id of the capture.
+
+        The indexes are dropped before and created again after the insert,
+        unless reindex is False (to import several captures in a row
+        between calls to drop_indexes() and create_indexes())."""
+        if reindex:
+            self.drop_indexes()
+        try:
+            with self.db:
+                capture_id = self._add_capture(name, capture.linktype,
+                                               capture.snaplen)
+                for first, chunk in capture.chunks(chunk_size):
+                    self._insert(capture_id, chunk)
+        finally:
+            if reindex:
+                self.create_indexes()
+        return capture_id
+
+    def import_pcap(self, source, name=None, chunk_size=IMPORT_CHUNK,
+                    reindex=True):
+        """Insert the packets of source, a pcap file (a file name or a file
+        object) or a capture saved by usbcolumns.py, as a new capture called
+        name (by default, the file name). Returns the id of the capture.
+        See import_capture() for reindex."""
+        if name is None:
+            name = getattr(source, 'name', source)
+        if isinstance(source, basestring) and is_saved_capture(source):
+            return self.import_capture(ColumnarCapture.load(source), name,
+                                       chunk_size, reindex)
+        if reindex:
+            self.drop_indexes()
+        try:
+            return self._import_stream(PcapStream(source), name, chunk_size)
+        finally:
+            if reindex:
+                self.create_indexes()
+
+    def _import_stream(self, stream, name, chunk_size):
+        with self.db:
+            capture_id = self._add_capture(name, stream.linktype,
+                                           stream.snaplen)
+            chunk = []
+            for hdr, data in stream:
+                chunk.append(data)
+                if len(chunk) == chunk_size:
+                    self._insert(capture_id,
+                                 ColumnarCapture.from_records(chunk))
+                    chunk = []
+            if chunk:
+                self._insert(capture_id, ColumnarCapture.from_records(chunk))
+        return capture_id
+
+    def _add_capture(self, name, linktype, snaplen):
+        return self.db.execute(
+                'INSERT INTO captures (name, linktype, snaplen) '
+                'VALUES (?, ?, ?)', (name, linktype, snaplen)).lastrowid
+
+    def _insert(self, capture_id, capture):
+        # the rows are built a column at a time from the capture's arrays
+        n = len(capture)
+        headers = capture.headers
+        columns = dict(capture=[capture_id] * n,
+                       urb=headers['urb'].view(np.int64).tolist(),
+                       ts=capture.ts.tolist(),
+                       datalen=capture.datalen.tolist())
+        for name in HEADER_COLUMNS:
+            if name not in columns:
+                columns[name] = headers[name].tolist()
+        no_setup = headers['flag_setup'] != '\x00'
+        for name in SETUP_COLUMNS:
+            values = headers[name].astype(object)
+            values[no_setup] = None
+            columns[name] = values.tolist()
+        raw = np.ascontiguousarray(headers).view(
+                np.dtype((np.void, USBMON_HEADER_LEN))).tolist()
+        columns['header'] = [buffer(h) for h in raw]
+        blob = capture.blob.tostring()
+        offsets = capture.offsets.tolist()
+        columns['data'] = [buffer(blob, offsets[i], offsets[i+1] - offsets[i])
+                           for i in xrange(n)]
+        self.db.executemany(
+                'INSERT INTO packets (%s) VALUES (%s)' % (
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                zip(*[columns[name] for name in COLUMNS]))
+
+    def select(self, columns, clause='', params=(), limit=None):
+        """Cursor over the given columns (a list of column names or SQL
+        expressions) of the packets selected by clause (from build_query()),
+        in capture order."""
+        sql = self._select_sql(columns, clause)
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return self.db.execute(sql, list(params))
+
+    def query_plan(self, columns, clause='', params=()):
+        """SQLite's plan for select(), as a list of strings (e.g. 'SEARCH
+        TABLE packets USING INDEX packets_endpoint (devnum=? AND
+        epnum=?)'), to check which index a query uses."""
+        sql = 'EXPLAIN QUERY PLAN ' + self._select_sql(columns, clause)
+        return [row[-1] for row in self.db.execute(sql, list(params))]
+
+    def _select_sql(self, columns, clause):
+        return 'SELECT %s FROM packets %s ORDER BY ts, id' % (
+                ', '.join(columns), clause)
+
+    def count(self, clause='', params=()):
+        """Number of packets selected by clause."""
+        return self.db.execute('SELECT COUNT(*) FROM packets %s' % clause,
+                               list(params)).fetchone()[0]
+
+    def records(self, clause='', params=(), limit=None):
+        """Generate the packets selected by clause as pcap records, (header,
+        data) tuples like pcapy's next()."""
+        for header, data in self.select(['header', 'data'], clause, params,
+                                        limit):
+            raw = str(header) + str(data)
+            sec = unpack_from(TS_SEC[0], raw, TS_SEC[1])[0]
+            usec = unpack_from(TS_USEC[0], raw, TS_USEC[1])[0]
+            yield PcapHeader(sec, usec, len(raw), len(raw)), raw
+
+    def linktype(self, clause='', params=()):
+        """(linktype, snaplen) for writing the packets selected by clause to
+        a pcap file: those of the first capture they belong to."""
+        row = self.db.execute(
+                'SELECT linktype, snaplen FROM captures WHERE id IN '
+                '(SELECT capture FROM packets %s) ORDER BY id LIMIT 1'
+                % clause, list(params)).fetchone()
+        return row or (LINKTYPE_USB_LINUX_MMAPPED, 65535)
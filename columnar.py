@@ -0,0 +1,861 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Columnar (struct-of-arrays) representation of a USB packet capture.
+
+Where the Packet class decodes one usbmon packet at a time, a
+ColumnarCapture holds a whole capture as NumPy arrays so that analysis can
+be done with vectorized operations:
+
+    * ``headers`` is a structured array with one 64-byte record per packet,
+      with one field per usbmon header attribute.
+    * ``offsets`` and ``blob`` hold the (variable-length) data payloads; the
+      payload of packet ``i`` is ``blob[offsets[i]:offsets[i+1]]``.
+
+A capture can be saved to disk with save() or export_pcap() as a directory
+of .npy files, one per array, and loaded back with ColumnarCapture.load(),
+which memory-maps them: reloading a capture costs no parsing, and only the
+pages of the columns actually used are read. CaptureReader gives the records
+of a saved capture the interface of a PcapReader.
+
+"""
+
+import ast
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from pcapfile import PcapReader, PcapHeader, RECORD_HEADER, \
+        LINKTYPE_USB_LINUX_MMAPPED
+from usbrevue import USBMON_PACKET_FORMAT, USBMON_TRANSFER_TYPE
+
+USBMON_HEADER_LEN = 64
+
+# NumPy types for the usbmon header attributes. Offsets are taken from
+# USBMON_PACKET_FORMAT; the setup subfields overlay the 'setup' field.
+_HEADER_TYPES = [
+    ('urb',         '<u8'),
+    ('event_type',  'S1'),
+    ('xfer_type',   'u1'),
+    ('epnum',       'u1'),
+    ('devnum',      'u1'),
+    ('busnum',      '<u2'),
+    ('flag_setup',  'S1'),
+    ('flag_data',   'S1'),
+    ('ts_sec',      '<i8'),
+    ('ts_usec',     '<i4'),
+    ('status',      '<i4'),
+    ('length',      '<u4'),
+    ('len_cap',     '<u4'),
+    ('interval',    '<i4'),
+    ('start_frame', '<i4'),
+    ('xfer_flags',  '<u4'),
+    ('ndesc',       '<u4'),
+]
+
+_SETUP_TYPES = [
+    ('bmRequestType',   'u1',   0),
+    ('bRequest',        'u1',   1),
+    ('wValue',          '<u2',  2),
+    ('wIndex',          '<u2',  4),
+    ('wLength',         '<u2',  6),
+]
+
+def _header_dtype():
+    names, formats, offsets = [], [], []
+    for name, fmt in _HEADER_TYPES:
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(USBMON_PACKET_FORMAT[name][1])
+    setup_offset = USBMON_PACKET_FORMAT['setup'][1]
+    for name, fmt, offset in _SETUP_TYPES:
+        names.append(name)
+        formats.append(fmt)
+        offsets.append(setup_offset + offset)
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets,
+                         itemsize=USBMON_HEADER_LEN))
+
+HEADER_DTYPE = _header_dtype()
+
+# files of a saved capture, one per array
+CAPTURE_ARRAYS = ('headers', 'offsets', 'blob', 'pcap')
+# number of records copied at a time by export_pcap()
+EXPORT_CHUNK = 65536
+# ... and of payload bytes: gathering them takes 16 bytes of indices each
+EXPORT_BYTES = 1 << 21
+
+
+def capture_path(path, name):
+    return os.path.join(path, name + '.npy')
+
+def is_saved_capture(path):
+    """True if path is a directory holding a capture saved by
+    ColumnarCapture.save() or export_pcap()."""
+    return all(os.path.isfile(capture_path(path, name))
+               for name in CAPTURE_ARRAYS)
+
+
+class ColumnarCapture(object):
+    """A capture of usbmon packets stored as columns.
+
+    Header attributes are available as arrays by attribute or item access,
+    e.g. ``cap.epnum`` or ``cap['devnum']``. ``ts`` is the packet timestamp
+    in (floating-point) seconds.
+    """
+
+    def __init__(self, headers, offsets, blob,
+                 linktype=LINKTYPE_USB_LINUX_MMAPPED, snaplen=65535):
+        self.headers = headers
+        self.offsets = offsets
+        self.blob = blob
+        # pcap global header fields, to write the capture back as pcap
+        self.linktype = linktype
+        self.snaplen = snaplen
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a capture saved by save() or export_pcap(). Its arrays are
+        memory-mapped read-only unless mmap is False."""
+        if not is_saved_capture(path):
+            raise ValueError('%s: not a saved capture' % path)
+        mode = 'r' if mmap else None
+        arrays = [np.load(capture_path(path, name), mmap_mode=mode)
+                  for name in CAPTURE_ARRAYS]
+        headers, offsets, blob, pcap = arrays
+        if headers.dtype.itemsize != USBMON_HEADER_LEN or \
+                len(offsets) != len(headers) + 1:
+            raise ValueError('%s: corrupt saved capture' % path)
+        headers = headers.view(HEADER_DTYPE)
+        return cls(headers, offsets, blob, int(pcap[0]), int(pcap[1]))
+
+    def save(self, path):
+        """Save the capture as a directory of .npy files (created if need
+        be), to be loaded with load()."""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(capture_path(path, 'headers'),
+                np.ascontiguousarray(self.headers).view(
+                    np.dtype((np.void, USBMON_HEADER_LEN))))
+        np.save(capture_path(path, 'offsets'),
+                np.asarray(self.offsets, np.int64))
+        np.save(capture_path(path, 'blob'), np.asarray(self.blob, np.uint8))
+        np.save(capture_path(path, 'pcap'),
+                np.array([self.linktype, self.snaplen], np.int64))
+
+    @classmethod
+    def from_packets(cls, packets):
+        """Build a ColumnarCapture from an iterable of Packet objects."""
+        return cls.from_records(packet.repack() for packet in packets)
+
+    @classmethod
+    def from_records(cls, records):
+        """Build a ColumnarCapture from an iterable of raw usbmon packets
+        (strings, as read from pcap)."""
+        hdrs = []
+        payloads = []
+        lengths = [0]
+        for raw in records:
+            hdrs.append(raw[:USBMON_HEADER_LEN])
+            payloads.append(raw[USBMON_HEADER_LEN:])
+            lengths.append(len(raw) - USBMON_HEADER_LEN)
+        headers = np.frombuffer(''.join(hdrs), HEADER_DTYPE)
+        offsets = np.cumsum(lengths, dtype=np.int64)
+        blob = np.frombuffer(''.join(payloads), np.uint8)
+        return cls(headers, offsets, blob)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getattr__(self, attr):
+        if attr in HEADER_DTYPE.names:
+            return self.headers[attr]
+        raise AttributeError(attr)
+
+    def __getitem__(self, attr):
+        return getattr(self, attr)
+
+    @property
+    def ts(self):
+        """Timestamps in seconds, as float64."""
+        return self.headers['ts_sec'] + self.headers['ts_usec'] / 1e6
+
+    @property
+    def datalen(self):
+        """Length of each packet's data payload."""
+        return np.diff(self.offsets)
+
+    def data(self, i):
+        """Data payload of packet i, as a uint8 array."""
+        return self.blob[self.offsets[i]:self.offsets[i+1]]
+
+    def record(self, i):
+        """Packet i as a raw usbmon packet (string), as read from pcap."""
+        return (self.headers[i:i+1].tostring() +
+                self.blob[self.offsets[i]:self.offsets[i+1]].tostring())
+
+    def pcap_records(self):
+        """The packets as the records of a pcap file (without its global
+        header), as a string. Timestamps are kept, and the captured and
+        original lengths are both the length of the record."""
+        n = len(self)
+        caplen = USBMON_HEADER_LEN + np.diff(self.offsets)
+        fixed = np.empty((n, RECORD_HEADER.size + USBMON_HEADER_LEN), np.uint8)
+        # little-endian uint32 fields, as RECORD_HEADER packs them
+        fields = np.column_stack((self.headers['ts_sec'],
+                                  self.headers['ts_usec'], caplen, caplen))
+        fixed[:, :RECORD_HEADER.size] = fields.astype('<u4').view(
+                np.uint8).reshape(n, RECORD_HEADER.size)
+        fixed[:, RECORD_HEADER.size:] = self.headers.view(np.uint8).reshape(
+                n, USBMON_HEADER_LEN)
+        fixed = fixed.tostring()
+        blob = self.blob.tostring()
+        size = len(fixed) // n if n else 0
+        offsets = self.offsets.tolist()
+        return ''.join([part for i in xrange(n) for part in
+                        (fixed[i*size:(i+1)*size],
+                         blob[offsets[i]:offsets[i+1]])])
+
+    def slice(self, start, stop):
+        """The packets from start up to (but not including) stop, as a
+        ColumnarCapture sharing this one's arrays where possible."""
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        offsets = self.offsets[start:stop+1]
+        base = offsets[0]
+        return ColumnarCapture(self.headers[start:stop], offsets - base,
+                               self.blob[base:offsets[-1]],
+                               self.linktype, self.snaplen)
+
+    def chunks(self, size):
+        """Generate the capture as consecutive slices of size packets,
+        with the number of the first packet of each: (first, capture)."""
+        for start in xrange(0, len(self), size):
+            yield start, self.slice(start, start + size)
+
+    def endpoint_keys(self):
+        """Return an array with a single integer per packet identifying its
+        (busnum, devnum, epnum) address."""
+        return ((self.headers['busnum'].astype(np.int64) << 16) |
+                (self.headers['devnum'].astype(np.int64) << 8) |
+                self.headers['epnum'])
+
+    def endpoints(self):
+        """Return a dict mapping (busnum, devnum, epnum) to an array of the
+        indices of the packets on that endpoint."""
+        keys = self.endpoint_keys()
+        result = dict()
+        for key in np.unique(keys):
+            addr = (int(key >> 16), int((key >> 8) & 0xff), int(key & 0xff))
+            result[addr] = np.flatnonzero(keys == key)
+        return result
+
+    def payload_matrix(self, rows=None, width=None):
+        """Gather the payloads of the given packets (all by default) into a
+        rectangular matrix.
+
+        Returns a tuple of (data, valid): ``data`` is a uint8 array of shape
+        (len(rows), width) and ``valid`` is a boolean array of the same shape
+        which is False where a payload is shorter than ``width``. ``width``
+        defaults to the longest of the selected payloads.
+        """
+        if rows is None:
+            rows = np.arange(len(self))
+        starts = self.offsets[rows]
+        lengths = self.offsets[np.asarray(rows) + 1] - starts
+        if width is None:
+            width = int(lengths.max()) if len(lengths) else 0
+        cols = np.arange(width)
+        valid = cols < lengths[:, np.newaxis]
+        index = starts[:, np.newaxis] + cols
+        # keep out-of-payload indices inside the blob; they are masked anyway
+        np.minimum(index, max(len(self.blob) - 1, 0), out=index)
+        if len(self.blob):
+            # (a new array: gathering from a read-only memory-mapped blob
+            # gives a read-only one)
+            data = np.where(valid, self.blob[index], np.uint8(0))
+        else:
+            data = np.zeros(index.shape, np.uint8)
+        return data, valid
+
+    def column(self, offset):
+        """Byte at the given payload offset of every packet. As with
+        Packet.data, a negative offset counts from the end of each payload.
+
+        Returns a tuple (values, valid) of an int64 array (0 where missing)
+        and a boolean array which is False for payloads too short to have
+        that offset.
+        """
+        return self.positions(np.full(len(self), offset, np.int64))
+
+    def positions(self, pos):
+        """Byte at payload offset pos[i] of every packet i, pos being an
+        array of offsets from the start of the payloads (negative ones
+        count from the end). Returns (values, valid) as column() does."""
+        datalen = self.datalen.astype(np.int64)
+        pos = np.where(pos < 0, pos + datalen, pos)
+        valid = (pos >= 0) & (pos < datalen)
+        if not len(self.blob):
+            return np.zeros(len(self), np.int64), valid
+        index = np.clip(self.offsets[:-1] + pos, 0, len(self.blob) - 1)
+        values = self.blob[index].astype(np.int64)
+        values[~valid] = 0
+        return values, valid
+
+
+def export_pcap(source, path, chunk=EXPORT_CHUNK, max_bytes=EXPORT_BYTES):
+    """Convert the pcap file source (a path or a PcapReader) of usbmon
+    packets to a capture saved in the directory path, for
+    ColumnarCapture.load(). Returns the number of packets.
+
+    The records are copied straight from the memory-mapped pcap into the
+    memory-mapped arrays, at most chunk records and max_bytes payload bytes
+    at a time (a longer payload is copied on its own), so that captures
+    larger than memory can be converted. Raises ValueError if a record is
+    too short to hold a usbmon header.
+    """
+    reader = source if isinstance(source, PcapReader) else PcapReader(source)
+    reader.index()
+    count = len(reader)
+    starts = np.zeros(count, np.int64)
+    if count:
+        starts[:] = np.frombuffer(reader.offsets,
+                                  'u%d' % reader.offsets.itemsize)
+    ends = np.append(starts[1:], reader.next_offset)
+    caplens = ends - starts - RECORD_HEADER.size
+    if count and caplens.min() < USBMON_HEADER_LEN:
+        raise ValueError('%s: record %d is too short for a usbmon header' % (
+            reader.f.name, int(np.argmax(caplens < USBMON_HEADER_LEN))))
+    lengths = caplens - USBMON_HEADER_LEN
+    offsets = np.zeros(count + 1, np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    open_memmap = np.lib.format.open_memmap
+    headers = open_memmap(capture_path(path, 'headers'), 'w+',
+                          np.dtype((np.void, USBMON_HEADER_LEN)), (count,))
+    blob = open_memmap(capture_path(path, 'blob'), 'w+', np.uint8,
+                       (int(offsets[-1]),))
+    np.save(capture_path(path, 'offsets'), offsets)
+    np.save(capture_path(path, 'pcap'),
+            np.array([reader.linktype, reader.snaplen], np.int64))
+
+    buf = np.frombuffer(reader.buf, np.uint8)
+    header_cols = np.arange(USBMON_HEADER_LEN)
+    header_bytes = headers.view(np.uint8).reshape(count, USBMON_HEADER_LEN)
+    first = 0
+    while first < count:
+        last = min(first + chunk, count,
+                   np.searchsorted(offsets, offsets[first] + max_bytes,
+                                   'right') - 1)
+        last = max(last, first + 1)
+        hdr_starts = starts[first:last] + RECORD_HEADER.size
+        header_bytes[first:last] = buf[hdr_starts[:, np.newaxis] + header_cols]
+        # payload bytes: each record's run of the pcap maps to a run of blob
+        dest = slice(offsets[first], offsets[last])
+        if last == first + 1:
+            pos = hdr_starts[0] + USBMON_HEADER_LEN
+            blob[dest] = buf[pos:pos + dest.stop - dest.start]
+        else:
+            shift = np.repeat(hdr_starts + USBMON_HEADER_LEN -
+                              offsets[first:last], lengths[first:last])
+            blob[dest] = buf[np.arange(dest.start, dest.stop) + shift]
+        first = last
+    headers.flush()
+    blob.flush()
+    del headers, blob, header_bytes, buf
+    if not isinstance(source, PcapReader):
+        reader.close()
+    return count
+
+
+class CaptureSpool(object):
+    """Temporary on-disk storage for a capture read as a stream, e.g. from
+    standard input: chunks of packets are appended to files as they arrive
+    with append(), and capture() returns them all as a memory-mapped
+    ColumnarCapture, which can then be read in several passes without the
+    packets being held in memory. close() deletes the files.
+    """
+
+    def __init__(self, dir=None):
+        self.path = tempfile.mkdtemp(prefix='usbrevue-', dir=dir)
+        self.files = dict((name, open(os.path.join(self.path, name), 'wb'))
+                          for name in ('headers', 'offsets', 'blob'))
+        self.count = 0
+        self.size = 0
+        self.linktype = LINKTYPE_USB_LINUX_MMAPPED
+        self.snaplen = 65535
+        # offsets of the payloads in the blob, starting with the first one
+        self.files['offsets'].write(np.zeros(1, np.int64).tostring())
+
+    def append(self, capture):
+        """Append the packets of a ColumnarCapture."""
+        self.files['headers'].write(np.ascontiguousarray(capture.headers).view(
+                np.dtype((np.void, USBMON_HEADER_LEN))).tostring())
+        offsets = np.asarray(capture.offsets[1:], np.int64) + self.size
+        self.files['offsets'].write(offsets.tostring())
+        self.files['blob'].write(np.asarray(capture.blob, np.uint8).tostring())
+        self.count += len(capture)
+        self.size += int(capture.offsets[-1])
+
+    def _map(self, name, dtype, count):
+        self.files[name].flush()
+        if not count:
+            return np.zeros(0, dtype)
+        return np.memmap(os.path.join(self.path, name), dtype, 'r',
+                         shape=(count,))
+
+    def capture(self):
+        """The packets appended so far, as a ColumnarCapture."""
+        return ColumnarCapture(self._map('headers', HEADER_DTYPE, self.count),
+                               self._map('offsets', np.int64, self.count + 1),
+                               self._map('blob', np.uint8, self.size),
+                               self.linktype, self.snaplen)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class CaptureReader(object):
+    """Random access to the records of a saved capture, with the interface
+    of a PcapReader (record(), header(), index() and so on) so that a saved
+    capture can be viewed like a pcap file. The whole capture is available
+    at once, but index() still hands out the records a chunk at a time, for
+    the benefit of callers showing them as they are indexed.
+
+    The capture itself is the capture attribute.
+    """
+
+    def __init__(self, path):
+        self.capture = ColumnarCapture.load(path)
+        self.linktype = self.capture.linktype
+        self.snaplen = self.capture.snaplen
+        self.count = 0
+        self.done = not len(self.capture)
+
+    def __len__(self):
+        return self.count
+
+    def index(self, count=None):
+        """Index up to count (by default, all) further records. Returns the
+        number of records indexed."""
+        total = len(self.capture)
+        n = total - self.count if count is None else \
+                min(count, total - self.count)
+        self.count += n
+        self.done = self.count == total
+        return n
+
+    def header(self, i):
+        """The PcapHeader of record i."""
+        hdr = self.capture.headers[i]
+        caplen = USBMON_HEADER_LEN + int(self.capture.offsets[i+1] -
+                                         self.capture.offsets[i])
+        return PcapHeader(int(hdr['ts_sec']), int(hdr['ts_usec']),
+                          caplen, caplen)
+
+    def record(self, i):
+        """Return record i as a tuple (header, data), like pcapy's next()."""
+        return self.header(i), self.capture.record(i)
+
+    def __iter__(self):
+        self.index()
+        for i in xrange(len(self)):
+            yield self.record(i)
+
+    def close(self):
+        self.capture = None
+
+
+class _ExpressionTransformer(ast.NodeTransformer):
+    """Rewrite the boolean parts of a Python expression so that it can be
+    evaluated over arrays: 'and', 'or' and 'not' become element-wise
+    operations and chained comparisons are split up. The operands of 'and'
+    and 'or' are passed as functions, so that the VectorValidity functions
+    they become calls to can tell their validity apart, and divisions become
+    calls to those functions as well."""
+
+    DIVISIONS = {ast.Div: '_div', ast.FloorDiv: '_floordiv', ast.Mod: '_mod'}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        func = self.DIVISIONS.get(type(node.op))
+        if func is None:
+            return node
+        return ast.copy_location(ast.Call(ast.Name(func, ast.Load()),
+                                          [node.left, node.right], [],
+                                          None, None), node)
+
+    @staticmethod
+    def _lazy_call(func, operands, node):
+        thunks = [ast.Lambda(ast.arguments([], None, None, []), operand)
+                  for operand in operands]
+        return ast.copy_location(ast.Call(ast.Name(func, ast.Load()),
+                                          thunks, [], None, None), node)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        func = '_all' if isinstance(node.op, ast.And) else '_any'
+        return self._lazy_call(func, node.values, node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.Call(ast.Name('_not', ast.Load()),
+                                              [node.operand], [], None, None),
+                                     node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        lefts = [node.left] + node.comparators[:-1]
+        parts = [ast.Compare(l, [op], [r]) for l, op, r in
+                 zip(lefts, node.ops, node.comparators)]
+        return self._lazy_call('_all', parts, node)
+
+
+class _DataColumns(object):
+    """Stands in for Packet.data while evaluating a ColumnExpression. Each
+    lookup marks the packets whose payload lacks the offset as missing in
+    the VectorValidity validity."""
+
+    def __init__(self, capture, validity):
+        self.capture = capture
+        self.validity = validity
+        self.columns = dict()
+
+    def __getitem__(self, offset):
+        if isinstance(offset, slice):
+            return _DataSlice(self.capture, offset)
+        if not isinstance(offset, (int, long)):
+            raise TypeError('payload offsets must be integers or slices')
+        if offset not in self.columns:
+            values, valid = self.capture.column(offset)
+            self.columns[offset] = values, ~valid
+        values, invalid = self.columns[offset]
+        self.validity.missing(invalid)
+        return values
+
+    def __len__(self):
+        raise TypeError('use len(data) only in comparisons')
+
+
+class _DataSlice(object):
+    """Stands in for a slice of Packet.data (e.g. data[2:4] or data[-2:])
+    while evaluating a ColumnExpression. As with a list, the slice of each
+    payload is cut to the payload's length, and it can be compared to a
+    list or tuple of values, indexed, or measured with len()."""
+
+    def __init__(self, capture, s):
+        self.capture = capture
+        step = 1 if s.step is None else s.step
+        if not all(isinstance(v, (int, long, type(None)))
+                   for v in (s.start, s.stop, s.step)):
+            raise TypeError('slice bounds must be integers')
+        if step == 0:
+            raise ValueError('slice step cannot be zero')
+        n = capture.datalen.astype(np.int64)
+        # the clamping of slice.indices(), one payload length per packet
+        if step > 0:
+            start = self._bound(s.start, n, 0, 0, n)
+            stop = self._bound(s.stop, n, n, 0, n)
+            length = (stop - start + step - 1) // step
+        else:
+            start = self._bound(s.start, n, n - 1, -1, n - 1)
+            stop = self._bound(s.stop, n, -1, -1, n - 1)
+            length = (start - stop - step - 1) // -step
+        self.start = start
+        self.step = step
+        self.lengths = np.maximum(length, 0)
+
+    @staticmethod
+    def _bound(value, n, default, lo, hi):
+        if value is None:
+            return np.broadcast_to(np.asarray(default, np.int64), n.shape)
+        if value < 0:
+            return np.clip(n + value, lo, hi)
+        return np.minimum(value, hi)
+
+    def __getitem__(self, index):
+        """Element index of the slice of every packet; (0 and) missing for
+        packets whose slice is too short."""
+        if not isinstance(index, (int, long)):
+            raise TypeError('indices into a payload slice must be integers')
+        pos = np.where(index < 0, self.lengths + index, index)
+        present = (pos >= 0) & (pos < self.lengths)
+        values, valid = self.capture.positions(
+                np.where(present, self.start + pos * self.step, 0))
+        values[~present] = 0
+        return values
+
+    def __eq__(self, other):
+        other = list(other)
+        result = self.lengths == len(other)
+        for i, value in enumerate(other):
+            result &= self[i] == value
+        return result
+
+    def __ne__(self, other):
+        return ~(self == other)
+
+    def __len__(self):
+        raise TypeError('use len(data[...]) only in comparisons')
+
+
+class _SetupColumns(object):
+    """Stands in for Packet.setup while evaluating a ColumnExpression."""
+
+    def __init__(self, capture):
+        self.capture = capture
+
+    def __getattr__(self, attr):
+        return self.capture.headers[attr]
+
+
+def _not(arg):
+    return np.logical_not(arg)
+
+def _bool(arg):
+    return np.asarray(arg, bool)
+
+def _len(arg, data, capture):
+    if arg is data:
+        return capture.datalen
+    if isinstance(arg, _DataSlice):
+        return arg.lengths
+    return len(arg)
+
+# names needed by the code returned by compile_vectorized()
+VECTOR_BUILTINS = dict(_not=_not, bool=_bool, abs=np.abs)
+
+
+class VectorValidity(object):
+    """Which elements of an expression compiled by compile_vectorized() can
+    be evaluated, for one evaluation; Python would raise an exception for
+    the others.
+
+    Operands mark the elements they lack (e.g. a payload byte) with
+    missing(). Where a divisor is 0 (which NumPy would silently turn into a
+    0 quotient for integers), the division operators divide by 1 instead
+    and mark the element as missing. 'and' and 'or' evaluate their operands
+    in turn and, as in Python, an element only needs the operands up to the
+    first one which decides it: "data[0] > 10 or data[3] > 10" is true for
+    a two-byte payload whose first byte is 20. invalid stays None if every
+    element is valid."""
+
+    def __init__(self):
+        self.invalid = None
+
+    def names(self):
+        """The names to evaluate the expression with."""
+        return dict(_all=self.all, _any=self.any, _div=self.div,
+                    _floordiv=self.floordiv, _mod=self.mod)
+
+    def missing(self, invalid):
+        """Mark the elements for which invalid is True as not valid."""
+        invalid = np.asarray(invalid, bool)
+        if not invalid.any():
+            return
+        self.invalid = invalid if self.invalid is None \
+                else self.invalid | invalid
+
+    def _operand(self, operand):
+        # the truth and validity of an operand of 'and' or 'or' on its own
+        self.invalid = None
+        value = np.asarray(operand(), bool)
+        if self.invalid is None:
+            return value, True
+        return value, ~self.invalid
+
+    def all(self, *operands):
+        saved = self.invalid
+        false, pending = np.asarray(False), np.asarray(True)
+        for operand in operands:
+            value, valid = self._operand(operand)
+            false = false | (pending & valid & ~value)
+            pending = pending & valid & value
+        self.invalid = saved
+        self.missing(~(false | pending))
+        return pending
+
+    def any(self, *operands):
+        saved = self.invalid
+        true, pending = np.asarray(False), np.asarray(True)
+        for operand in operands:
+            value, valid = self._operand(operand)
+            true = true | (pending & valid & value)
+            pending = pending & valid & ~value
+        self.invalid = saved
+        self.missing(~(true | pending))
+        return true
+
+    def _divisor(self, b):
+        zero = np.asarray(b) == 0
+        if not zero.any():
+            return b
+        self.missing(zero)
+        return np.where(zero, 1, b)
+
+    def div(self, a, b):
+        return a / self._divisor(b)
+
+    def floordiv(self, a, b):
+        return a // self._divisor(b)
+
+    def mod(self, a, b):
+        return a % self._divisor(b)
+
+    def mask(self, n):
+        """Boolean array of the n elements of the result which are valid."""
+        if self.invalid is None:
+            return np.ones(n, bool)
+        return ~np.broadcast_to(self.invalid, (n,))
+
+
+def compile_vectorized(exp, filename='<expression>'):
+    """Compile a Python expression so that it can be evaluated with arrays
+    in place of its operands. It must be evaluated with the names of
+    VECTOR_BUILTINS and those of a VectorValidity defined as globals (the
+    operands of 'and' and 'or' become lambdas)."""
+    tree = ast.parse(exp.strip(), filename, 'eval')
+    tree = ast.fix_missing_locations(_ExpressionTransformer().visit(tree))
+    return compile(tree, filename, 'eval')
+
+
+def _is_predicate(node):
+    """Whether the expression tree node is a condition to be counted
+    rather than a value: a comparison, a boolean operation, a call to
+    bool(), a bit mask (x & 0x80) or a bitwise combination of those."""
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not)
+    if isinstance(node, ast.Call):
+        return isinstance(node.func, ast.Name) and node.func.id == 'bool'
+    if isinstance(node, ast.BinOp):
+        if isinstance(node.op, ast.BitAnd):
+            return True
+        if isinstance(node.op, (ast.BitOr, ast.BitXor)):
+            return _is_predicate(node.left) and _is_predicate(node.right)
+    return False
+
+class ColumnExpression(object):
+    """A Python expression over packet attributes (in the notation used by
+    the modifier and the viewer filters, e.g. "data[0] == 0xdd and
+    epnum == 0x81") compiled once and evaluated over all packets of a
+    ColumnarCapture at a time.
+
+    Available names are the usbmon header attributes, the transfer type
+    names (isochronous, interrupt, control, bulk), ``data[N]`` (negative N
+    counting from the end of the payload), slices such as ``data[2:4]``
+    (compared to lists, indexed or measured with len()), ``len(data)`` and
+    ``setup.<field>``. Predicates (see _is_predicate()) evaluate to booleans.
+    """
+
+    def __init__(self, exp):
+        self.exp = exp
+        tree = ast.parse(exp.strip(), '<expression>', 'eval')
+        self.is_predicate = _is_predicate(tree.body)
+        self.code = compile_vectorized(exp)
+
+    def evaluate(self, capture):
+        """Evaluate the expression for every packet of capture.
+
+        Returns a tuple (values, valid). valid is False for the packets
+        for which evaluating the expression with a Packet would raise an
+        exception: those whose payload is too short for the offsets it needs
+        (see VectorValidity), and those for which it divides by zero; for
+        predicates, values is also False (or 0, for bit masks) there.
+        """
+        validity = VectorValidity()
+        data = _DataColumns(capture, validity)
+        namespace = dict(USBMON_TRANSFER_TYPE)
+        namespace.update(VECTOR_BUILTINS)
+        namespace.update(validity.names())
+        namespace.update(data=data, setup=_SetupColumns(capture),
+                         len=lambda d: _len(d, data, capture),
+                         __builtins__={})
+        for name in HEADER_DTYPE.names:
+            namespace[name] = capture.headers[name]
+        values = eval(self.code, namespace)
+        values = np.broadcast_to(values, (len(capture),))
+        valid = validity.mask(len(capture))
+        if self.is_predicate:
+            values = np.where(valid, values, np.zeros(1, values.dtype))
+        return values, valid
+
+
+_BYTE_OFFSET = re.compile(r'\[(\d+)\]')
+
+class ByteExpression(object):
+    """A custom byte expression of the Grapher (usbgraph.py) and of its
+    headless export (graphexport.py), in which [N] stands for the byte at
+    payload offset N, e.g. "([0] << 8) + [1]". It is compiled once and
+    evaluated over whole columns of bytes at a time.
+
+    offsets are the payload offsets the expression refers to.
+    """
+
+    def __init__(self, exp):
+        self.exp = exp
+        self.offsets = sorted(set(int(n) for n in _BYTE_OFFSET.findall(exp)))
+        self.code = compile_vectorized(_BYTE_OFFSET.sub(r'_byte(\1)', exp),
+                                       '<custom byte>')
+
+    def evaluate(self, column, n):
+        """Evaluate the expression for n packets, column(offset) returning
+        a tuple (values, valid) of arrays of the n packets' bytes at a payload
+        offset and of whether each packet has it (as ColumnarCapture.column()
+        does).
+
+        Returns a float64 array of the values, NaN for the packets lacking
+        a byte the expression needs (see VectorValidity), for which it
+        divides by zero or whose value is not finite.
+        """
+        validity = VectorValidity()
+        columns = dict()
+
+        def byte(offset):
+            if offset not in columns:
+                values, valid = column(offset)
+                columns[offset] = (np.asarray(values, np.int64),
+                                   ~np.asarray(valid, bool))
+            values, invalid = columns[offset]
+            validity.missing(invalid)
+            return values
+
+        namespace = dict(VECTOR_BUILTINS, _byte=byte, __builtins__={})
+        namespace.update(validity.names())
+        # (overflowing shifts and float results are dealt with below)
+        with np.errstate(over='ignore', invalid='ignore'):
+            values = eval(self.code, namespace)
+            values = np.array(np.broadcast_to(values, (n,)), np.float64)
+        values[~validity.mask(n)] = np.nan
+        values[~np.isfinite(values)] = np.nan
+        return values
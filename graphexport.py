@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Headless export of Grapher plots.
+
+Reads a capture as a stream, evaluates payload byte offsets and custom byte
+expressions (in the Grapher's notation, e.g. "([0] << 8) + [1]") over
+chunks of packets at a time with NumPy, and reduces them to a min/max
+envelope of a bounded number of buckets of consecutive packets, which can
+be written as CSV, as a NumPy .npy file and rendered to a PNG image. No Qt
+or X display is needed, and memory use does not depend on the length of
+the capture. A capture saved by usbcolumns.py may be given instead of a pcap
+file; it is memory-mapped rather than parsed.
+
+    graphexport.py --offsets 0,1 --exp "([0] << 8) + [1]" --csv out.csv \
+            --png out.png [capture.pcap]
+
+(or equivalently "usbgraph.py --headless ...").
+"""
+
+import csv
+import struct
+import sys
+import zlib
+from optparse import OptionParser
+
+import numpy as np
+
+from columnar import ColumnarCapture, ByteExpression, is_saved_capture
+from pcapfile import PcapStream
+
+DEFAULT_BUCKETS = 2000
+# packets evaluated at a time
+CHUNK_SIZE = 65536
+
+# curve colors of rendered images
+PALETTE = [(0, 0, 255), (255, 0, 0), (0, 139, 0), (255, 140, 0),
+           (138, 43, 226), (0, 206, 209), (139, 9, 139), (184, 134, 11)]
+
+
+class StreamingEnvelope(object):
+    """Minimum and maximum of several series of values streamed a chunk at
+    a time, over buckets of consecutive values.
+
+    Buckets start as single values; whenever there are 2 * buckets of them,
+    neighbouring buckets are merged and the bucket size doubles, so memory
+    use stays bounded however long the stream is. Values are NaN where
+    missing.
+    """
+
+    def __init__(self, nseries, buckets=DEFAULT_BUCKETS):
+        self.nseries = nseries
+        self.buckets = max(buckets, 1)
+        self.size = 1
+        self.count = 0
+        # complete buckets: first value index, first timestamp, min and max
+        self.first = np.zeros(0, np.int64)
+        self.ts = np.zeros(0)
+        self.lo = np.zeros((0, nseries))
+        self.hi = np.zeros((0, nseries))
+        # the incomplete last bucket, as (first, ts, lo, hi, count)
+        self.pending = None
+
+    def add(self, ts, values):
+        """Add a chunk: ts is an array of n timestamps and values an (n,
+        nseries) array."""
+        n = len(ts)
+        i = 0
+        if self.pending is not None:
+            first, pts, lo, hi, count = self.pending
+            take = min(self.size - count, n)
+            lo = np.fmin(lo, np.fmin.reduce(values[:take], axis=0))
+            hi = np.fmax(hi, np.fmax.reduce(values[:take], axis=0))
+            self.pending = (first, pts, lo, hi, count + take)
+            i = take
+            if count + take == self.size:
+                self._append([first], [pts], [lo], [hi])
+                self.pending = None
+        full = (n - i) // self.size
+        if full:
+            end = i + full * self.size
+            block = values[i:end].reshape(full, self.size, self.nseries)
+            self._append(self.count + np.arange(i, end, self.size),
+                         ts[i:end:self.size], np.fmin.reduce(block, axis=1),
+                         np.fmax.reduce(block, axis=1))
+            i = end
+        if i < n:
+            self.pending = (self.count + i, ts[i],
+                            np.fmin.reduce(values[i:], axis=0),
+                            np.fmax.reduce(values[i:], axis=0), n - i)
+        self.count += n
+        self._compact()
+
+    def _append(self, first, ts, lo, hi):
+        self.first = np.append(self.first, first)
+        self.ts = np.append(self.ts, ts)
+        self.lo = np.vstack((self.lo, lo))
+        self.hi = np.vstack((self.hi, hi))
+
+    def _compact(self):
+        while len(self.first) >= 2 * self.buckets:
+            m = len(self.first) // 2 * 2
+            if m < len(self.first):
+                # the odd bucket out joins the incomplete one
+                first, ts = self.first[-1], self.ts[-1]
+                lo, hi = self.lo[-1], self.hi[-1]
+                count = self.size
+                if self.pending is not None:
+                    lo = np.fmin(lo, self.pending[2])
+                    hi = np.fmax(hi, self.pending[3])
+                    count += self.pending[4]
+                self.pending = (first, ts, lo, hi, count)
+            self.first = self.first[0:m:2]
+            self.ts = self.ts[0:m:2]
+            self.lo = np.fmin(self.lo[0:m:2], self.lo[1:m:2])
+            self.hi = np.fmax(self.hi[0:m:2], self.hi[1:m:2])
+            self.size *= 2
+
+    def result(self):
+        """Return (first, ts, lo, hi) for all buckets, including the
+        incomplete last one."""
+        if self.pending is None:
+            return self.first, self.ts, self.lo, self.hi
+        first, ts, lo, hi, count = self.pending
+        return (np.append(self.first, first), np.append(self.ts, ts),
+                np.vstack((self.lo, lo)), np.vstack((self.hi, hi)))
+
+
+class GraphExport(object):
+    """Envelopes of payload byte offsets and custom byte expressions over a
+    capture, optionally restricted to one (devnum, epnum) endpoint."""
+
+    def __init__(self, offsets=(), expressions=(), endpoint=None,
+                 buckets=DEFAULT_BUCKETS):
+        self.offsets = list(offsets)
+        self.expressions = [ByteExpression(exp) for exp in expressions]
+        self.names = (['[%d]' % offset for offset in self.offsets] +
+                      list(expressions))
+        self.endpoint = endpoint
+        self.envelope = StreamingEnvelope(len(self.names), buckets)
+        self.first_ts = None
+
+    def add_capture(self, capture):
+        """Add the packets of a ColumnarCapture."""
+        columns = []
+        for offset in self.offsets:
+            values, valid = capture.column(offset)
+            columns.append(np.where(valid, values, np.nan))
+        for expression in self.expressions:
+            columns.append(expression.evaluate(capture.column, len(capture)))
+        ts = capture.ts
+        values = np.column_stack(columns).reshape(len(ts), -1)
+        if self.endpoint is not None:
+            rows = ((capture.devnum == self.endpoint[0]) &
+                    (capture.epnum == self.endpoint[1]))
+            ts, values = ts[rows], values[rows]
+        if not len(ts):
+            return
+        if self.first_ts is None:
+            self.first_ts = ts[0]
+        self.envelope.add(ts, values)
+
+    def read(self, stream, chunk_size=CHUNK_SIZE):
+        """Add the packets of a PcapStream, chunk_size at a time."""
+        chunk = []
+        for hdr, data in stream:
+            chunk.append(data)
+            if len(chunk) == chunk_size:
+                self.add_capture(ColumnarCapture.from_records(chunk))
+                chunk = []
+        if chunk:
+            self.add_capture(ColumnarCapture.from_records(chunk))
+
+    def read_capture(self, capture, chunk_size=CHUNK_SIZE):
+        """Add the packets of a ColumnarCapture (e.g. a saved capture),
+        chunk_size at a time."""
+        for first, chunk in capture.chunks(chunk_size):
+            self.add_capture(chunk)
+
+    def table(self):
+        """The envelope as a structured array with the fields 'packet' (the
+        first packet of each bucket), 'time' (its timestamp, in seconds
+        since the first packet) and '<name> min' and '<name> max' for each
+        offset ('[N]') and expression."""
+        first, ts, lo, hi = self.envelope.result()
+        fields = [('packet', np.int64), ('time', np.float64)]
+        for name in self.names:
+            fields += [(name + ' min', np.float64), (name + ' max', np.float64)]
+        table = np.zeros(len(first), fields)
+        table['packet'] = first
+        if len(first):
+            table['time'] = ts - self.first_ts
+        for k, name in enumerate(self.names):
+            table[name + ' min'] = lo[:, k]
+            table[name + ' max'] = hi[:, k]
+        return table
+
+    def write_csv(self, f):
+        table = self.table()
+        writer = csv.writer(f)
+        writer.writerow(table.dtype.names)
+        for row in table.tolist():
+            writer.writerow(['' if v != v else v for v in row])
+
+    def write_npy(self, f):
+        np.save(f, self.table())
+
+    def render(self, width=1000, height=400, time_axis=False):
+        """Draw the envelopes (one vertical stroke per bucket, from minimum
+        to maximum) as an RGB image, a (height, width, 3) uint8 array."""
+        image = np.empty((height, width, 3), np.uint8)
+        image.fill(255)
+        image[0, :] = image[-1, :] = image[:, 0] = image[:, -1] = 192
+        first, ts, lo, hi = self.envelope.result()
+        if not len(first) or np.isnan(lo).all():
+            return image
+        x = ts - ts[0] if time_axis else (first - first[0]).astype(float)
+        xs = np.round(x * (width - 3) / max(x[-1], 1e-9)).astype(int) + 1
+        ymin, ymax = np.nanmin(lo), np.nanmax(hi)
+        scale = (height - 3) / max(ymax - ymin, 1e-9)
+        for k in xrange(len(self.names)):
+            color = PALETTE[k % len(PALETTE)]
+            valid = ~np.isnan(lo[:, k])
+            tops = height - 2 - np.round((hi[valid, k] - ymin) * scale)
+            bottoms = height - 2 - np.round((lo[valid, k] - ymin) * scale)
+            for px, top, bottom in zip(xs[valid], tops.astype(int),
+                                       bottoms.astype(int)):
+                image[top:bottom + 1, px] = color
+        return image
+
+    def write_png(self, f, width=1000, height=400, time_axis=False):
+        write_png(f, self.render(width, height, time_axis))
+
+
+def write_png(f, image):
+    """Write an RGB image (a (height, width, 3) uint8 array) as PNG."""
+    height, width = image.shape[:2]
+    image = np.ascontiguousarray(image, np.uint8)
+    # each scanline is preceded by its filter type (0, none)
+    raw = np.zeros((height, width * 3 + 1), np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk('IDAT', zlib.compress(raw.tostring(), 6)))
+    f.write(chunk('IEND', ''))
+
+
+def add_options(parser):
+    """Add the headless export options to an OptionParser."""
+    parser.add_option("--offsets", metavar="N,N,...",
+            help="Payload byte offsets to export.")
+    parser.add_option("--exp", metavar="EXP,EXP,...",
+            help="Custom byte expressions to export, as in the Grapher, "
+                 "e.g. '([0] << 8) + [1]'.")
+    parser.add_option("--endpoint", metavar="DEVNUM:EPNUM",
+            help="Only use the packets of this endpoint (epnum in hex, "
+                 "e.g. 3:81).")
+    parser.add_option("--buckets", type="int", default=DEFAULT_BUCKETS,
+            help="Reduce the capture to between BUCKETS and twice as many "
+                 "buckets of packets (default %default).")
+    parser.add_option("--csv", metavar="FILE", help="Write CSV to FILE.")
+    parser.add_option("--npy", metavar="FILE",
+            help="Write a NumPy structured array to FILE.")
+    parser.add_option("--png", metavar="FILE",
+            help="Render the plot to FILE.")
+    parser.add_option("--image-size", metavar="WxH", default="1000x400",
+            help="Size of the rendered image (default %default).")
+    parser.add_option("--time", default=False, action="store_true",
+            help="Render against time rather than packet numbers.")
+
+
+def run(parser, options, args):
+    """Export the capture given in args (or stdin) as asked by options."""
+    if not (options.csv or options.npy or options.png):
+        parser.error('nothing to export: use --csv, --npy or --png')
+    offsets = [int(o, 0) for o in options.offsets.split(',')] \
+            if options.offsets else []
+    expressions = [e.strip() for e in options.exp.split(',')] \
+            if options.exp else []
+    if not offsets and not expressions:
+        parser.error('nothing to plot: use --offsets or --exp')
+    endpoint = None
+    if options.endpoint:
+        devnum, epnum = options.endpoint.split(':')
+        endpoint = (int(devnum), int(epnum, 16))
+    width, height = [int(n) for n in options.image_size.split('x')]
+
+    export = GraphExport(offsets, expressions, endpoint, options.buckets)
+    if args and is_saved_capture(args[0]):
+        export.read_capture(ColumnarCapture.load(args[0]))
+    else:
+        export.read(PcapStream(args[0] if args else sys.stdin))
+    if options.csv:
+        with open(options.csv, 'wb') as f:
+            export.write_csv(f)
+    if options.npy:
+        with open(options.npy, 'wb') as f:
+            export.write_npy(f)
+    if options.png:
+        with open(options.png, 'wb') as f:
+            export.write_png(f, width, height, options.time)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [capture.pcap|capture-dir]")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+    run(parser, options, args)
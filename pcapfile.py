@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Pure-Python access to pcap capture files.
+
+PcapWriter writes packets with the same dump(hdr, data) interface as the
+dumper objects of pcapy, so the two can be used interchangeably, e.g. to
+write packets to a file while the pcapy dumper is writing to stdout.
+
+PcapReader gives random access to the records of a capture file: the file
+is memory-mapped and indexed by record offset, so that a record is only read
+when it is asked for. PcapStream reads the records of a file or a pipe one
+after the other, in constant memory.
+"""
+
+import mmap
+import os
+import struct
+from array import array
+
+PCAP_MAGIC = 0xa1b2c3d4
+# the same, with nanosecond timestamps
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_VERSION = (2, 4)
+# DLT_USB_LINUX_MMAPPED: usbmon packets with the 64-byte header
+LINKTYPE_USB_LINUX_MMAPPED = 220
+
+GLOBAL_HEADER = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+
+
+def parse_global_header(buf, name):
+    """Parse the global header of a pcap file at the start of buf. Returns
+    a tuple (endian, nanosecond, snaplen, linktype), endian being the struct
+    byte order character of the file. Raises ValueError if it is not a
+    pcap file."""
+    if len(buf) < GLOBAL_HEADER.size:
+        raise ValueError('%s: not a pcap file' % name)
+    for endian in '<>':
+        magic = struct.unpack_from(endian + 'I', buf)[0]
+        if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise ValueError('%s: not a pcap file' % name)
+    (magic, major, minor, tz, sigfigs, snaplen,
+     linktype) = struct.unpack_from(endian + 'IHHiIII', buf)
+    return endian, magic == PCAP_MAGIC_NSEC, snaplen, linktype
+
+
+class PcapWriter(object):
+    """Write packets to a pcap file.
+
+    f is a file name or a file object opened for writing in binary mode.
+    """
+
+    def __init__(self, f, linktype=LINKTYPE_USB_LINUX_MMAPPED, snaplen=65535):
+        if isinstance(f, basestring):
+            f = open(f, 'wb')
+        self.f = f
+        self.f.write(GLOBAL_HEADER.pack(PCAP_MAGIC, PCAP_VERSION[0],
+                                        PCAP_VERSION[1], 0, 0, snaplen,
+                                        linktype))
+
+    def dump(self, hdr, data):
+        """Write a packet, given its pcapy header and captured data."""
+        sec, usec = hdr.getts()
+        self.f.write(RECORD_HEADER.pack(sec, usec, len(data), hdr.getlen()))
+        self.f.write(data)
+
+    def write_records(self, records):
+        """Write packets already in the form of pcap records (record
+        headers and captured data), e.g. ColumnarCapture.pcap_records()."""
+        self.f.write(records)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class PcapHeader(object):
+    """Record header of a pcap file, with the accessors of pcapy's Pkthdr."""
+
+    __slots__ = ('sec', 'usec', 'caplen', 'length')
+
+    def __init__(self, sec, usec, caplen, length):
+        self.sec = sec
+        self.usec = usec
+        self.caplen = caplen
+        self.length = length
+
+    def getts(self):
+        return (self.sec, self.usec)
+
+    def getcaplen(self):
+        return self.caplen
+
+    def getlen(self):
+        return self.length
+
+
+class PcapReader(object):
+    """Random access to the records of a pcap file.
+
+    Records are found by index(), which scans the record headers following
+    the last record indexed so far; it can be called a chunk at a time (e.g.
+    from a background thread) so that the first records are available
+    before the whole file has been scanned. len() is the number of records
+    indexed so far and done is True once the end of the file is reached.
+
+    Raises ValueError if the file is not a pcap file.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.size = os.fstat(self.f.fileno()).st_size
+        if self.size < GLOBAL_HEADER.size:
+            raise ValueError('%s: not a pcap file' % path)
+        self.buf = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        (endian, self.nanosecond, self.snaplen,
+         self.linktype) = parse_global_header(self.buf, path)
+        self.record_header = struct.Struct(endian + 'IIII')
+        self.caplen_field = struct.Struct(endian + 'I')
+        # file offset of each indexed record
+        self.offsets = array('L')
+        self.next_offset = GLOBAL_HEADER.size
+        self.done = False
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def index(self, count=None):
+        """Index up to count (by default, all) further records. Returns the
+        number of records indexed. A truncated last record is ignored."""
+        buf, size = self.buf, self.size
+        offsets = self.offsets
+        caplen_of = self.caplen_field.unpack_from
+        hdr_size = RECORD_HEADER.size
+        offset = self.next_offset
+        n = 0
+        while count is None or n < count:
+            if offset + hdr_size > size:
+                self.done = True
+                break
+            end = offset + hdr_size + caplen_of(buf, offset + 8)[0]
+            if end > size:
+                self.done = True
+                break
+            offsets.append(offset)
+            offset = end
+            n += 1
+        self.next_offset = offset
+        return n
+
+    def header(self, i):
+        """The PcapHeader of record i."""
+        sec, usec, caplen, length = \
+                self.record_header.unpack_from(self.buf, self.offsets[i])
+        if self.nanosecond:
+            usec //= 1000
+        return PcapHeader(sec, usec, caplen, length)
+
+    def record(self, i):
+        """Return record i as a tuple (header, data), like pcapy's next()."""
+        hdr = self.header(i)
+        start = self.offsets[i] + RECORD_HEADER.size
+        return hdr, self.buf[start:start+hdr.caplen]
+
+    def __iter__(self):
+        """Iterate over all records, indexing the file as needed."""
+        i = 0
+        while i < len(self) or (not self.done and self.index(1024)):
+            yield self.record(i)
+            i += 1
+
+    def close(self):
+        self.buf.close()
+        self.f.close()
+
+
+class PcapStream(object):
+    """Sequential access to the records of a pcap file.
+
+    f is a file name or a file object opened for reading in binary mode,
+    which need not be seekable (e.g. sys.stdin), so that captures of any
+    size can be processed as they are read. Iterating generates (header,
+    data) tuples, like pcapy's next(); a truncated last record is ignored.
+
+    Raises ValueError if the file is not a pcap file.
+    """
+
+    def __init__(self, f):
+        if isinstance(f, basestring):
+            f = open(f, 'rb')
+        self.f = f
+        (endian, self.nanosecond, self.snaplen,
+         self.linktype) = parse_global_header(f.read(GLOBAL_HEADER.size),
+                                              getattr(f, 'name', 'stream'))
+        self.record_header = struct.Struct(endian + 'IIII')
+
+    def __iter__(self):
+        read = self.f.read
+        unpack = self.record_header.unpack
+        hdr_size = RECORD_HEADER.size
+        while True:
+            hdr = read(hdr_size)
+            if len(hdr) < hdr_size:
+                return
+            sec, usec, caplen, length = unpack(hdr)
+            data = read(caplen)
+            if len(data) < caplen:
+                return
+            if self.nanosecond:
+                usec //= 1000
+            yield PcapHeader(sec, usec, caplen, length), data
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Searching captures for byte patterns.
+
+A byte pattern is written as hex bytes, optionally separated by spaces, with
+'??' standing for any byte, e.g. "a1 01 ?? 00". byte_pattern() compiles it
+to a regular expression over raw bytes; find_records() runs it over the
+memory-mapped records of a PcapReader (or the payloads of a saved capture
+opened with a CaptureReader) in bulk, without looking at the records one at
+a time, and reports the records whose payload matches.
+
+PatternMatcher looks for many patterns at once and reports every occurrence
+of each of them.
+"""
+
+import re
+from bisect import bisect_right
+from collections import deque
+
+import numpy as np
+
+from columnar import CaptureReader
+from pcapfile import RECORD_HEADER
+
+USBMON_HEADER_LEN = 64
+_BYTE_RE = re.compile(r'\s*([0-9a-fA-F]{2}|\?\?)')
+
+
+def parse_byte_pattern(text):
+    """Parse a byte pattern into a list of byte values, None standing for
+    any byte.
+
+    >>> parse_byte_pattern('a1 01??00')
+    [161, 1, None, 0]
+    """
+    values = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        m = _BYTE_RE.match(text, pos)
+        if m is None:
+            raise ValueError('invalid byte pattern: %r' % text)
+        values.append(None if m.group(1) == '??' else int(m.group(1), 16))
+        pos = m.end()
+    if not values:
+        raise ValueError('empty byte pattern')
+    return values
+
+
+def _regex_source(values):
+    return ''.join('.' if b is None else re.escape(chr(b)) for b in values)
+
+
+def byte_pattern(text, overlapping=False):
+    """Compile a byte pattern to a regular expression.
+
+    With overlapping, the pattern is put in a lookahead so that finditer()
+    finds overlapping occurrences too; the matched bytes are then group 1.
+    Without it, the regular expression engine can use its fast literal
+    search for patterns starting with a few fixed bytes.
+    """
+    source = _regex_source(parse_byte_pattern(text))
+    if overlapping:
+        source = '(?=(%s))' % source
+    return re.compile(source, re.DOTALL)
+
+
+def find_in_payload(regex, raw):
+    """Return True if the payload of the raw usbmon packet matches."""
+    return regex.search(raw, USBMON_HEADER_LEN) is not None
+
+
+def find_records(regex, reader, first, last, forward=True, chunk=4096):
+    """Generate the numbers of the records of reader, from first up to (but
+    not including) last, whose payload matches regex; in increasing order,
+    or decreasing if forward is False.
+
+    The regular expression is run over the file itself, and a match is only
+    mapped to its record by a binary search over the record offsets.
+    """
+    if forward:
+        for rec in _find_forward(regex, reader, first, last):
+            yield rec
+        return
+    # search backwards a chunk of records at a time
+    while last > first:
+        start = max(first, last - chunk)
+        for rec in reversed(list(_find_forward(regex, reader, start, last))):
+            yield rec
+        last = start
+
+
+def _find_forward(regex, reader, first, last):
+    if first >= last:
+        return
+    if isinstance(reader, CaptureReader):
+        for rec in _find_forward_columnar(regex, reader.capture, first, last):
+            yield rec
+        return
+    buf = reader.buf
+    offsets = reader.offsets
+    caplen_of = reader.caplen_field.unpack_from
+    hdr_size = RECORD_HEADER.size
+    pos = offsets[first]
+    if last < len(offsets):
+        end = offsets[last]
+    else:
+        end = reader.next_offset
+    while pos < end:
+        m = regex.search(buf, pos, end)
+        if m is None:
+            return
+        start = m.start()
+        rec = bisect_right(offsets, start, first, last) - 1
+        data_start = offsets[rec] + hdr_size + USBMON_HEADER_LEN
+        data_end = offsets[rec] + hdr_size + caplen_of(buf, offsets[rec] + 8)[0]
+        if start < data_start:
+            # in the pcap or usbmon header: carry on from the payload
+            pos = data_start
+        elif m.end() > data_end:
+            # runs into the next record
+            pos = start + 1
+        else:
+            yield rec
+            pos = data_end
+
+def _find_forward_columnar(regex, capture, first, last):
+    # the payloads are contiguous in the blob: search it directly
+    buf = buffer(capture.blob)
+    offsets = capture.offsets
+    pos = offsets[first]
+    end = offsets[last]
+    while pos < end:
+        m = regex.search(buf, pos, end)
+        if m is None:
+            return
+        start = m.start()
+        rec = int(np.searchsorted(offsets, start, 'right')) - 1
+        data_end = offsets[rec + 1]
+        if m.end() > data_end:
+            # runs into the next payload
+            pos = start + 1
+        else:
+            yield rec
+            pos = data_end
+
+class PatternMatcher(object):
+    """Find every occurrence of several byte patterns at once.
+
+    Patterns without wildcards are matched together by an Aho-Corasick
+    automaton, which finds all of them, overlapping or not, in a single pass
+    over the data. Patterns with '??' wildcards are matched with their own
+    regular expression.
+
+    The automaton runs in Python, so data is first screened with a single
+    regular expression matching any of the patterns, run by the regular
+    expression engine over whole chunks of a capture at a time; only the
+    payloads it flags are scanned.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.values = [parse_byte_pattern(p) for p in self.patterns]
+        self.lengths = [len(v) for v in self.values]
+        # Aho-Corasick automaton: goto transitions, failure links and the
+        # patterns ending in each state
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [[]]
+        self.wildcards = []
+        for index, values in enumerate(self.values):
+            if None in values:
+                self.wildcards.append((index, byte_pattern(self.patterns[index],
+                                                           overlapping=True)))
+            else:
+                self._add(index, values)
+        self._link()
+        # any pattern, shortest first so that a match is never rejected for
+        # running past the end of a payload when a shorter one fits
+        alternatives = [_regex_source(values)
+                        for values in sorted(self.values, key=len)]
+        self.prefilter = re.compile('(?:%s)' % '|'.join(alternatives),
+                                    re.DOTALL)
+
+    def _add(self, index, values):
+        state = 0
+        for b in values:
+            if b not in self.goto[state]:
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][b] = len(self.goto) - 1
+            state = self.goto[state][b]
+        self.out[state].append(index)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for b, child in self.goto[state].iteritems():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and b not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(b, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def scan(self, data, start=0, end=None):
+        """Return the list of (pattern index, offset) of every occurrence of
+        the patterns in data[start:end], with offsets relative to start,
+        ordered by offset."""
+        if end is None:
+            end = len(data)
+        goto, fail, out = self.goto, self.fail, self.out
+        hits = []
+        state = 0
+        for pos in xrange(start, end):
+            b = ord(data[pos])
+            while state and b not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(b, 0)
+            for index in out[state]:
+                hits.append((pos - start - self.lengths[index] + 1, index))
+        for index, regex in self.wildcards:
+            for m in regex.finditer(data, start, end):
+                if m.end(1) <= end:
+                    hits.append((m.start(1) - start, index))
+        hits.sort()
+        return [(index, offset) for offset, index in hits]
+
+    def scan_payloads(self, blob, offsets):
+        """Scan concatenated payloads: payload i is blob[offsets[i]:
+        offsets[i+1]] (as in a ColumnarCapture). Generates (i, hits) for
+        every payload with at least one occurrence, hits as from scan()."""
+        offsets = np.asarray(offsets)
+        npayloads = len(offsets) - 1
+        end = int(offsets[-1]) if len(offsets) else 0
+        pos = 0
+        while pos < end:
+            m = self.prefilter.search(blob, pos, end)
+            if m is None:
+                return
+            i = int(np.searchsorted(offsets, m.start(), 'right')) - 1
+            i = min(i, npayloads - 1)
+            payload_end = int(offsets[i + 1])
+            if m.end() > payload_end:
+                pos = m.start() + 1
+                continue
+            hits = self.scan(blob, int(offsets[i]), payload_end)
+            if hits:
+                yield i, hits
+            pos = payload_end
+
+    def scan_records(self, reader, first=0, last=None):
+        """Scan the payloads of the records of a PcapReader (from first up
+        to last; by default all records indexed so far). Generates (record,
+        hits) for every record with at least one occurrence."""
+        if last is None:
+            last = len(reader)
+        hdr_size = RECORD_HEADER.size
+        for rec in _find_forward(self.prefilter, reader, first, last):
+            start = reader.offsets[rec] + hdr_size
+            caplen = reader.caplen_field.unpack_from(reader.buf, start - 8)[0]
+            hits = self.scan(reader.buf, start + USBMON_HEADER_LEN,
+                             start + caplen)
+            if hits:
+                yield rec, hits
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -42,12 +42,23 @@ setup(
             'Topic :: System :: Hardware :: Hardware Drivers',
           ],
         py_modules  = [
+            'analysis',
+            'blocklist',
+            'bytestore',
+            'capturedb',
+            'columnar',
+            'graphexport',
+            'pcapfile',
+            'search',
+            'urbtracker',
             'usbrevue',
             'util',
           ],
         scripts = [
             'codegen.py',
             'usbcap',
+            'usbcolumns.py',
+            'usbdb.py',
             'usbgraph.py',
             'usbmodify.py',
             'usbreplay.py',
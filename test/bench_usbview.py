@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Stress benchmark for the usbview packet model.
+
+Feeds synthetic usbmon traffic (interrupt polling with an occasional control
+transfer) through PacketModel and PacketFilterProxyModel, one packet at a
+time and in batches, and prints the packet rate reached for each.
+
+    python bench_usbview.py [-n PACKETS] [-b BATCH[,BATCH...]]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from tutil import *
+from PyQt4.QtGui import QApplication
+from usbview import PacketModel, PacketFilterProxyModel
+
+
+def synthetic_packets(n):
+    """Generate n packets of interrupt-in traffic with a GET_STATUS control
+    transfer every 100 packets."""
+    packets = []
+    for i in xrange(n):
+        ts = i * 1e-4
+        if i % 100 < 2:
+            packets.append(make_packet(urb=0x2000 + i // 100, xfer_type=2,
+                                       epnum=0x80, ts=ts,
+                                       event_type='SC'[i % 100],
+                                       setup=[0x80, 0, 0, 0, 0, 0, 2, 0]))
+        else:
+            packets.append(make_packet(data=[i & 0xff, (i >> 8) & 0xff, 0, 0],
+                                       urb=0x1000 + i % 8, ts=ts,
+                                       event_type='SC'[i % 2]))
+    return packets
+
+
+def run(packets, batch, filter_expr):
+    model = PacketModel()
+    proxy = PacketFilterProxyModel()
+    proxy.setSourceModel(model)
+    proxy.set_filter(filter_expr)
+    start = time.time()
+    if batch == 1:
+        for packet in packets:
+            model.new_packet(packet)
+    else:
+        for i in xrange(0, len(packets), batch):
+            model.new_packets(packets[i:i+batch])
+    elapsed = time.time() - start
+    return elapsed, proxy.rowCount()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--packets', type='int', default=50000,
+            help='Number of synthetic packets to feed (default %default).')
+    parser.add_option('-b', '--batches', default='1,64,1024',
+            help='Comma-separated batch sizes to try (default %default).')
+    parser.add_option('-f', '--filter', default='epnum == 0x81',
+            help='Display filter applied by the proxy model.')
+    (options, args) = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    packets = synthetic_packets(options.packets)
+    for batch in map(int, options.batches.split(',')):
+        elapsed, shown = run(packets, batch, options.filter)
+        print 'batch %6d: %8.0f packets/s (%d shown)' % (
+                batch, len(packets) / elapsed, shown)
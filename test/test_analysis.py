@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for analysis.py and columnar.py"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from tutil import *
+import analysis
+from columnar import ColumnarCapture, ColumnExpression, ByteExpression, \
+                     CaptureReader, CaptureSpool, export_pcap, \
+                     is_saved_capture
+from pcapfile import PcapWriter, PcapReader
+from usbrevue import USBMON_TRANSFER_TYPE
+
+
+def counter_capture(n=64):
+    """Capture of an endpoint whose payload is (constant, counter, toggle
+    bit) plus a second endpoint with a constant payload."""
+    packets = list()
+    for i in range(n):
+        packets.append(make_packet([0xdd, i & 0xff, i & 1], epnum=0x81,
+                                   ts=i * 0.01))
+        packets.append(make_packet([0x55, 0x55], epnum=0x82, ts=i * 0.01))
+    return ColumnarCapture.from_packets(packets)
+
+
+class TestColumnarCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.cap = counter_capture(8)
+
+    def test_header_columns(self):
+        self.assertEqual(len(self.cap), 16)
+        self.assertEqual(list(self.cap.epnum[:2]), [0x81, 0x82])
+        self.assertEqual(self.cap['devnum'][0], 2)
+        self.assertAlmostEqual(self.cap.ts[2], 0.01)
+
+    def test_payloads(self):
+        self.assertEqual(list(self.cap.datalen[:2]), [3, 2])
+        self.assertEqual(list(self.cap.data(2)), [0xdd, 1, 1])
+
+    def test_endpoints(self):
+        eps = self.cap.endpoints()
+        self.assertEqual(sorted(eps), [(1, 2, 0x81), (1, 2, 0x82)])
+        self.assertEqual(list(eps[(1, 2, 0x82)]), range(1, 16, 2))
+
+    def test_payload_matrix(self):
+        data, valid = self.cap.payload_matrix([0, 1])
+        self.assertEqual(data.shape, (2, 3))
+        self.assertEqual(data.tolist(), [[0xdd, 0, 0], [0x55, 0x55, 0]])
+        self.assertEqual(valid.tolist(), [[True] * 3, [True, True, False]])
+
+    def test_negative_column(self):
+        cap = ColumnarCapture.from_packets(
+                [make_packet([1, 2, 3]), make_packet([4]), make_packet([])])
+        values, valid = cap.column(-1)
+        self.assertEqual(values.tolist(), [3, 4, 0])
+        self.assertEqual(valid.tolist(), [True, True, False])
+        values, valid = cap.column(-2)
+        self.assertEqual(values.tolist(), [2, 0, 0])
+        self.assertEqual(valid.tolist(), [True, False, False])
+
+    def test_slice(self):
+        part = self.cap.slice(3, 6)
+        self.assertEqual(len(part), 3)
+        self.assertEqual(list(part.offsets), [0, 2, 5, 7])
+        self.assertEqual(list(part.data(1)), [0xdd, 2, 0])
+        self.assertEqual(part.record(0), self.cap.record(3))
+        chunks = list(self.cap.chunks(5))
+        self.assertEqual([(first, len(c)) for first, c in chunks],
+                         [(0, 5), (5, 5), (10, 5), (15, 1)])
+
+
+class TestSavedCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.packets = [make_packet(range(i % 5), epnum=0x81 + i % 2,
+                                    ts=i * 0.5) for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, cap):
+        self.assertEqual(len(cap), 20)
+        self.assertEqual(list(cap.epnum[:3]), [0x81, 0x82, 0x81])
+        self.assertAlmostEqual(cap.ts[3], 1.5)
+        for i, packet in enumerate(self.packets):
+            self.assertEqual(cap.record(i), packet.repack())
+
+    def test_save_load(self):
+        path = os.path.join(self.dir, 'cap')
+        ColumnarCapture.from_packets(self.packets).save(path)
+        self.assertTrue(is_saved_capture(path))
+        cap = ColumnarCapture.load(path)
+        self.assertTrue(isinstance(cap.blob, np.memmap))
+        self.check(cap)
+        self.check(ColumnarCapture.load(path, mmap=False))
+        self.assertRaises(ValueError, ColumnarCapture.load, self.dir)
+
+    def test_spool(self):
+        spool = CaptureSpool(self.dir)
+        self.assertEqual(len(spool.capture()), 0)
+        capture = ColumnarCapture.from_packets(self.packets)
+        for first, chunk in capture.chunks(7):
+            spool.append(chunk)
+        cap = spool.capture()
+        self.assertTrue(isinstance(cap.blob, np.memmap))
+        self.check(cap)
+        del cap
+        spool.close()
+        self.assertFalse(os.path.exists(spool.path))
+
+    def test_export(self):
+        pcap = os.path.join(self.dir, 'cap.pcap')
+        writer = PcapWriter(open(pcap, 'wb'))
+        for packet in self.packets:
+            writer.dump(packet.hdr, packet.repack())
+        writer.close()
+        path = os.path.join(self.dir, 'cap')
+        self.assertEqual(export_pcap(pcap, path, chunk=7), 20)
+        self.check(ColumnarCapture.load(path))
+        # chunks limited by payload bytes, some single oversized records
+        small = os.path.join(self.dir, 'small')
+        self.assertEqual(export_pcap(pcap, small, max_bytes=2), 20)
+        self.check(ColumnarCapture.load(small))
+        # and back to pcap records, in chunks
+        cap = ColumnarCapture.load(path)
+        records = ''.join(chunk.pcap_records() for first, chunk in
+                          cap.chunks(7))
+        self.assertEqual(records, open(pcap, 'rb').read()[24:])
+
+        reader = CaptureReader(path)
+        pcap_reader = PcapReader(pcap)
+        self.assertEqual(reader.index(15), 15)
+        self.assertFalse(reader.done)
+        self.assertEqual(reader.index(), 5)
+        self.assertTrue(reader.done)
+        for i, (hdr, data) in enumerate(pcap_reader):
+            rhdr, rdata = reader.record(i)
+            self.assertEqual(rdata, data)
+            self.assertEqual(rhdr.getts(), hdr.getts())
+            self.assertEqual(rhdr.getcaplen(), hdr.getcaplen())
+        pcap_reader.close()
+
+
+class TestColumnExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.cap = counter_capture(8)
+
+    def evaluate(self, exp):
+        return ColumnExpression(exp).evaluate(self.cap)
+
+    def test_predicate(self):
+        e = ColumnExpression('data[0] == 0xdd')
+        self.assertTrue(e.is_predicate)
+        values, valid = e.evaluate(self.cap)
+        self.assertEqual(values.tolist(), [True, False] * 8)
+
+    def test_short_payloads(self):
+        values, valid = self.evaluate('data[2] == 0')
+        self.assertEqual(valid.tolist(), [True, False] * 8)
+        self.assertEqual(values.tolist(), [True, False, False, False] * 4)
+
+    def test_boolean_operators(self):
+        values, valid = self.evaluate(
+                'epnum == 0x81 and not data[2] or data[1] == 7')
+        self.assertEqual(values.nonzero()[0].tolist(), [0, 4, 8, 12, 14])
+
+    def test_chained_comparison(self):
+        values, valid = self.evaluate('2 <= data[1] < 5')
+        self.assertEqual(values.nonzero()[0].tolist(), [4, 6, 8])
+
+    def test_masks_and_names(self):
+        values, valid = self.evaluate(
+                'data[1] & 0x01 != 0 and epnum & 0x0f == 1 '
+                'and xfer_type == interrupt '
+                'and event_type == "C"')
+        self.assertEqual(values.nonzero()[0].tolist(), [2, 6, 10, 14])
+        values, valid = self.evaluate('len(data) > 2')
+        self.assertEqual(values.tolist(), [True, False] * 8)
+
+    def test_negative_offsets(self):
+        values, valid = self.evaluate('data[-1] == 0x55')
+        self.assertEqual(values.tolist(), [False, True] * 8)
+        values, valid = self.evaluate('data[-3] == 0xdd')
+        self.assertEqual(valid.tolist(), [True, False] * 8)
+        self.assertEqual(values.tolist(), [True, False] * 8)
+        values, valid = self.evaluate('data[-1] - data[0]')
+        self.assertEqual(values[2], 1 - 0xdd)
+
+    def test_slices(self):
+        values, valid = self.evaluate('data[0:2] == [0xdd, 3]')
+        self.assertEqual(values.nonzero()[0].tolist(), [6])
+        values, valid = self.evaluate('data[1:] == (0x55,)')
+        self.assertEqual(values.nonzero()[0].tolist(), range(1, 16, 2))
+        values, valid = self.evaluate('data[-2:] != [0x55, 0x55]')
+        self.assertEqual(values.tolist(), [True, False] * 8)
+        values, valid = self.evaluate('len(data[1:5]) == 2')
+        self.assertEqual(values.tolist(), [True, False] * 8)
+        values, valid = self.evaluate('data[::-1][0] == 1')
+        self.assertEqual(values.nonzero()[0].tolist(), [2, 6, 10, 14])
+        self.assertRaises(TypeError, self.evaluate, 'data["a":]')
+        self.assertRaises(ValueError, self.evaluate, 'data[::0] == []')
+        # the same as Packet.data slices, for every payload length
+        cap = ColumnarCapture.from_packets(
+                [make_packet(range(n)) for n in range(5)])
+        for s in ('1:3', '-3:', ':-1', '::2', '3:0:-1', '-1::-2', '5:'):
+            sliced = [eval('range(%d)[%s]' % (n, s)) for n in range(5)]
+            for expected in sliced:
+                exp = 'data[%s] == %r' % (s, expected)
+                values, valid = ColumnExpression(exp).evaluate(cap)
+                self.assertEqual(values.nonzero()[0].tolist(),
+                                 [n for n in range(5)
+                                  if sliced[n] == expected], exp)
+
+    def test_mask_predicate(self):
+        e = ColumnExpression('data[2] & 0x01')
+        self.assertTrue(e.is_predicate)
+        values, valid = e.evaluate(self.cap)
+        self.assertEqual(values.nonzero()[0].tolist(), [2, 6, 10, 14])
+        self.assertTrue(ColumnExpression(
+                'bool(data[0]) ^ bool(data[1])').is_predicate)
+        self.assertFalse(ColumnExpression('data[0] ^ data[1]').is_predicate)
+        self.assertFalse(ColumnExpression('data[0] | 0x80').is_predicate)
+
+    def test_matches_packets(self):
+        # the packets for which a Packet at a time evaluates to true, the
+        # operands of 'and' and 'or' being needed only up to the one which
+        # decides the result
+        packets = [make_packet([(i * 37 + j * 91) % 256 for j in range(i % 6)])
+                   for i in range(60)]
+        cap = ColumnarCapture.from_packets(packets)
+        for exp in ('data[0] > 10 or data[3] > 10',
+                    'data[0] > 100 and data[3] > 10',
+                    'not (data[1] > 50 and data[4] > 50)',
+                    'not (data[0] < 100 or data[2] < 100)',
+                    'data[0] < 100 < data[2]',
+                    'len(data) < 2 or data[1] / data[0] > 1',
+                    'data[1] > 10 or data[0] and data[3] or data[2] > 0'):
+            expected = []
+            for i, packet in enumerate(packets):
+                try:
+                    if eval(exp, USBMON_TRANSFER_TYPE, packet):
+                        expected.append(i)
+                except Exception:
+                    pass
+            values, valid = ColumnExpression(exp).evaluate(cap)
+            self.assertEqual(np.flatnonzero(values & valid).tolist(),
+                             expected, exp)
+
+    def test_division_by_zero(self):
+        # the counter is 0, 1, 2 ... on the even rows
+        for exp in ('data[0] / data[1]', 'data[0] // data[1]',
+                    'data[0] % data[1]'):
+            values, valid = self.evaluate(exp)
+            self.assertEqual(valid.tolist()[:6],
+                             [False, True, True, True, True, True], exp)
+        values, valid = self.evaluate('data[0] / data[1]')
+        self.assertEqual(values[4], 0xdd / 2)
+        # never true where the toggle bit, the divisor, is 0
+        values, valid = self.evaluate('data[0] % data[2] == 0')
+        self.assertEqual(values.nonzero()[0].tolist(), [2, 6, 10, 14])
+        values, valid = self.evaluate('data[0] / 0')
+        self.assertFalse(valid.any())
+
+    def test_value_expression(self):
+        e = ColumnExpression('data[1] << 8 | data[0]')
+        self.assertFalse(e.is_predicate)
+        values, valid = e.evaluate(self.cap)
+        self.assertEqual(values[2], 0x1dd)
+        self.assertEqual(values[1], 0x5555)
+
+
+class TestByteExpression(unittest.TestCase):
+
+    def test_evaluate(self):
+        cap = counter_capture(8)
+        # as the ColumnExpression with data[N] in place of [N]
+        for exp in ('([0] << 8) + [1]', '[2] * 2', '[1] / [2]',
+                    '[2] > 0 or [1] > 0x50', 'not ([2] and [0])'):
+            values = ByteExpression(exp).evaluate(cap.column, len(cap))
+            expected, valid = ColumnExpression(
+                    exp.replace('[', 'data[')).evaluate(cap)
+            self.assertEqual(np.isnan(values).tolist(), (~valid).tolist(),
+                             exp)
+            self.assertEqual(values[valid].tolist(), expected[valid].tolist(),
+                             exp)
+        values = ByteExpression('[7]').evaluate(cap.column, len(cap))
+        self.assertTrue(np.isnan(values).all())
+
+
+class TestOffsetStats(unittest.TestCase):
+
+    def test_field_stats_ranking(self):
+        stats = analysis.field_stats(counter_capture())
+        ranked = [s.offset for s in stats[(1, 2, 0x81)]]
+        self.assertEqual(ranked, [1, 2, 0])
+        counter, toggle, constant = stats[(1, 2, 0x81)]
+        self.assertAlmostEqual(counter.entropy, 6.0)
+        self.assertAlmostEqual(counter.change_rate, 1.0)
+        self.assertAlmostEqual(toggle.entropy, 1.0)
+        self.assertEqual(toggle.bit_toggles, [63, 0, 0, 0, 0, 0, 0, 0])
+        self.assertEqual(toggle.toggling_bits, 0x01)
+        self.assertEqual(constant.score, 0)
+        self.assertTrue(all(s.score == 0 for s in stats[(1, 2, 0x82)]))
+
+    def test_blocks(self):
+        # the same ranking a few rows at a time, across block boundaries
+        capture = counter_capture()
+        whole = analysis.field_stats(capture)
+        blocked = analysis.field_stats(capture, block_elems=7)
+        self.assertEqual(sorted(whole), sorted(blocked))
+        for addr in whole:
+            self.assertEqual([(s.offset, s.count, s.entropy, s.change_rate,
+                               s.bit_toggles) for s in whole[addr]],
+                             [(s.offset, s.count, s.entropy, s.change_rate,
+                               s.bit_toggles) for s in blocked[addr]])
+
+    def test_missing_bytes(self):
+        data = np.array([[1, 0], [2, 7], [3, 0]], np.uint8)
+        valid = np.array([[True, False], [True, True], [True, False]])
+        stats = dict((s.offset, s) for s in analysis.offset_stats(data, valid))
+        self.assertEqual(stats[1].count, 1)
+        self.assertEqual(stats[1].entropy, 0)
+        self.assertEqual(stats[1].change_rate, 0)
+        self.assertAlmostEqual(stats[0].change_rate, 1.0)
+
+
+class TestCorrelation(unittest.TestCase):
+
+    def setUp(self):
+        # offsets: 0,1 little-endian counter; 2 = checksum of 0; 3 random;
+        # 4 constant
+        rng = np.random.RandomState(1)
+        n = 2000
+        counter = np.arange(n) * 3
+        self.data = np.empty((n, 5), np.uint8)
+        self.data[:, 0] = counter & 0xff
+        self.data[:, 1] = counter >> 8
+        self.data[:, 2] = 0xff - self.data[:, 0]
+        self.data[:, 3] = rng.randint(0, 256, n)
+        self.data[:, 4] = 0x42
+        self.valid = np.ones(self.data.shape, bool)
+
+    def test_correlation_matrix(self):
+        corr = analysis.correlation_matrix(self.data, self.valid,
+                                           block_elems=64)
+        self.assertAlmostEqual(corr[0, 2], -1.0)
+        self.assertAlmostEqual(corr[0, 0], 1.0)
+        self.assertTrue(abs(corr[0, 3]) < 0.1)
+        self.assertEqual(corr[0, 4], 0.0)
+        pairs = analysis.correlated_pairs(corr)
+        self.assertEqual([(i, j) for i, j, r in pairs], [(0, 2)])
+
+    def test_correlation_missing_bytes(self):
+        valid = self.valid.copy()
+        valid[::2, 2] = False
+        data = self.data.copy()
+        data[::2, 2] = 0
+        corr = analysis.correlation_matrix(data, valid)
+        self.assertAlmostEqual(corr[0, 2], -1.0)
+
+    def test_time_correlation(self):
+        corr = analysis.time_correlation(self.data, self.valid,
+                                         np.arange(len(self.data)) * 0.001)
+        self.assertTrue(corr[1] > 0.99)
+        self.assertEqual(corr[4], 0.0)
+
+    def test_mutual_information(self):
+        columns, mi = analysis.mutual_information(self.data, self.valid)
+        self.assertEqual(columns, [0, 1, 2, 3])
+        self.assertAlmostEqual(mi[0, 2], mi[0, 0])
+        self.assertTrue(mi[0, 2] > 3.9)
+        self.assertTrue(mi[0, 3] < 0.2)
+
+    def test_blocks(self):
+        valid = self.valid.copy()
+        valid[::3, 1] = False
+        ts = np.arange(len(self.data)) * 0.001 + 1.3e9
+        np.testing.assert_allclose(
+                analysis.time_correlation(self.data, valid, ts, block_elems=45),
+                analysis.time_correlation(self.data, valid, ts))
+        np.testing.assert_allclose(
+                analysis.correlation_matrix(self.data, valid, block_elems=45),
+                analysis.correlation_matrix(self.data, valid))
+        columns, mi = analysis.mutual_information(self.data, valid)
+        blocked = analysis.mutual_information(self.data, valid,
+                                              block_elems=45, group_elems=300)
+        self.assertEqual(blocked[0], columns)
+        np.testing.assert_allclose(blocked[1], mi)
+        pairs = analysis.endian_pairs(self.data, valid)
+        self.assertEqual([(p.offset, p.endian, p.score, p.events)
+                          for p in analysis.endian_pairs(self.data, valid,
+                                                         block_elems=45)],
+                         [(p.offset, p.endian, p.score, p.events)
+                          for p in pairs])
+
+    def test_payload_blocks(self):
+        capture = counter_capture(8)
+        rows = np.arange(0, 16, 2)
+        blocks = list(analysis.payload_blocks(capture, rows, 3, block_elems=9))
+        self.assertEqual([len(block[0]) for block in blocks], [3, 3, 2])
+        data = np.concatenate([block[0] for block in blocks])
+        self.assertEqual(data.tolist(), capture.payload_matrix(rows)[0].tolist())
+        ts = np.concatenate([block[2] for block in blocks])
+        np.testing.assert_allclose(ts, capture.ts[rows])
+
+    def test_endian_pairs(self):
+        pairs = analysis.endian_pairs(self.data, self.valid)
+        self.assertEqual(len(pairs), 1)
+        self.assertEqual((pairs[0].offset, pairs[0].endian), (0, 'little'))
+        self.assertEqual(pairs[0].score, 1.0)
+
+        swapped = self.data[:, [1, 0]]
+        pairs = analysis.endian_pairs(swapped, self.valid[:, :2])
+        self.assertEqual((pairs[0].offset, pairs[0].endian), (0, 'big'))
+
+
+class TestTiming(unittest.TestCase):
+
+    def test_log_histogram(self):
+        h = analysis.LogHistogram()
+        h.add([0.001] * 90 + [0.1] * 10)
+        self.assertEqual(h.n, 100)
+        self.assertAlmostEqual(h.quantile(0.5), 0.001, delta=0.0001)
+        self.assertAlmostEqual(h.quantile(0.95), 0.1, delta=0.01)
+        self.assertAlmostEqual(h.mode(), 0.001, delta=0.0001)
+        self.assertAlmostEqual(h.mean, 0.0109)
+        self.assertEqual((h.min, h.max), (0.001, 0.1))
+
+    def test_throughput_bounded(self):
+        t = analysis.Throughput(bucket=1.0, max_buckets=8)
+        t.add(np.arange(4) + 0.5, [10] * 4)
+        t.add(np.arange(4, 20) + 0.5, [10] * 16)
+        self.assertEqual(t.bucket, 4.0)
+        times, rates = t.series()
+        self.assertEqual(times.tolist(), [0.5, 4.5, 8.5, 12.5, 16.5])
+        self.assertEqual(rates.tolist(), [10.0] * 5)
+
+    def test_interval_seconds(self):
+        self.assertEqual(analysis.interval_seconds(10, False), 0.010)
+        self.assertEqual(analysis.interval_seconds(1, True), 125e-6)
+        self.assertEqual(analysis.interval_seconds(4, True), 0.001)
+        ep = analysis.EndpointTiming()
+        ep.intervals[4] = 10
+        ep.interarrival['C'].add([0.001] * 10)
+        self.assertEqual(ep.declared_period(), (0.001, True))
+
+    def test_timing_stats(self):
+        packets = list()
+        for i in range(40):
+            t = i * 0.008
+            packets.append(make_packet([], urb=i, event_type='S', ts=t,
+                                       interval=8))
+            packets.append(make_packet([i, 0], urb=i, event_type='C',
+                                       ts=t + 0.002, interval=8))
+        stats = analysis.TimingStats()
+        # split so that URBs are matched across chunks
+        stats.update(ColumnarCapture.from_packets(packets[:41]))
+        stats.update(ColumnarCapture.from_packets(packets[41:]))
+        ep = stats.endpoints[(1, 2, 0x81)]
+        self.assertEqual(ep.packets, 80)
+        self.assertEqual(ep.bytes, 80)
+        self.assertEqual(ep.declared_interval(), 8)
+        self.assertEqual(ep.declared_period(False), (0.008, False))
+        # 2**7 microframes is 16 ms, further from the 8 ms measured
+        self.assertEqual(ep.declared_period(), (0.008, False))
+        self.assertEqual(ep.declared_period(True), (0.016, True))
+        self.assertAlmostEqual(ep.polling_estimate(), 0.008, delta=0.0005)
+        self.assertEqual(ep.interarrival['C'].n, 39)
+        self.assertEqual(ep.latency.n, 40)
+        self.assertAlmostEqual(ep.latency.quantile(0.5), 0.002, delta=0.0002)
+        self.assertEqual(len(stats.urbs), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
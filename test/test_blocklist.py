@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+import unittest
+
+from tutil import *
+from blocklist import BlockList
+
+class TestBlockList(unittest.TestCase):
+
+    def setUp(self):
+        self.ref = range(100)
+        self.bl = BlockList(self.ref, block_size=8)
+
+    def check(self):
+        self.assertEqual(len(self.bl), len(self.ref))
+        self.assertEqual(list(self.bl), self.ref)
+        for i in xrange(len(self.ref)):
+            self.assertEqual(self.bl[i], self.ref[i])
+        # the incrementally updated tree matches one built from scratch
+        self.bl._sync()
+        tree = list(self.bl.tree)
+        self.bl._rebuild()
+        self.assertEqual(tree, self.bl.tree)
+
+    def test_get(self):
+        self.check()
+        self.assertEqual(self.bl[-1], 99)
+        self.assertEqual(self.bl[10:30], self.ref[10:30])
+        self.assertEqual(self.bl[95:200], self.ref[95:])
+        self.assertRaises(IndexError, lambda: self.bl[100])
+
+    def test_set(self):
+        self.bl[42] = 'x'
+        self.ref[42] = 'x'
+        self.check()
+
+    def test_insert(self):
+        for i in xrange(40):
+            self.bl.insert(20, i)
+            self.ref.insert(20, i)
+        self.bl.insert(0, 'first')
+        self.ref.insert(0, 'first')
+        self.check()
+        # into an overfull last block
+        for i in xrange(12):
+            self.bl.insert(len(self.bl) - 1, i)
+            self.ref.insert(len(self.ref) - 1, i)
+        self.bl.extend(xrange(20))
+        self.ref.extend(xrange(20))
+        self.check()
+
+    def test_delete(self):
+        del self.bl[0]
+        del self.ref[0]
+        del self.bl[5:60]
+        del self.ref[5:60]
+        del self.bl[-1]
+        del self.ref[-1]
+        self.check()
+        del self.bl[:]
+        self.assertEqual(len(self.bl), 0)
+        self.bl.append(1)
+        self.assertEqual(list(self.bl), [1])
+
+    def test_delete_indices(self):
+        doomed = [0, 1, 2, 7, 8, 9, 30, 31, 64, 99]
+        self.bl.delete_indices(doomed)
+        self.ref = [x for x in self.ref if x not in doomed]
+        self.check()
+        self.bl.delete_indices(range(len(self.bl)))
+        self.assertEqual(list(self.bl), [])
+
+    def test_snapshot(self):
+        snap = self.bl.snapshot()
+        copy = list(self.ref)
+        self.bl[3] = 'x'
+        self.bl.append('y')
+        self.bl.insert(50, 'z')
+        del self.bl[10:30]
+        self.bl.delete_indices([0, 1, 60])
+        snap.insert(0, 'w')
+        self.assertEqual(list(snap), ['w'] + copy)
+        self.ref[3] = 'x'
+        self.ref.append('y')
+        self.ref.insert(50, 'z')
+        del self.ref[10:30]
+        for i in (60, 1, 0):
+            del self.ref[i]
+        self.check()
+
+    def test_random_ops(self):
+        rnd = random.Random(1)
+        snaps = []
+        for n in xrange(2000):
+            op = rnd.randrange(4)
+            if op == 0 or not self.ref:
+                self.bl.append(n)
+                self.ref.append(n)
+            elif op == 1:
+                i = rnd.randrange(len(self.ref))
+                self.bl.insert(i, n)
+                self.ref.insert(i, n)
+            elif op == 2:
+                i = rnd.randrange(len(self.ref))
+                j = i + rnd.randrange(20)
+                del self.bl[i:j]
+                del self.ref[i:j]
+            else:
+                doomed = sorted(rnd.sample(xrange(len(self.ref)),
+                                           min(5, len(self.ref))))
+                self.bl.delete_indices(doomed)
+                for i in reversed(doomed):
+                    del self.ref[i]
+            i = rnd.randrange(len(self.ref)) if self.ref else 0
+            self.assertEqual(self.bl[i:i+10], self.ref[i:i+10])
+            if n % 100 == 0:
+                self.check()
+                snaps.append((self.bl.snapshot(), list(self.ref)))
+        for snap, ref in snaps:
+            self.assertEqual(list(snap), ref)
+        self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+import unittest
+
+import numpy as np
+
+from tutil import *
+from bytestore import ByteStore, ValueColumn, MinMaxPyramid, MISSING
+
+class TestByteStore(unittest.TestCase):
+
+    def test_append(self):
+        store = ByteStore(rows=2, columns=2)
+        payloads = [[1, 2], [3], '\x04\x05\x06', [], [7] * 10]
+        store.extend(payloads)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store.width, 10)
+        for row, data in enumerate(payloads):
+            data = [ord(b) for b in data] if isinstance(data, str) else data
+            expected = data + [MISSING] * (10 - len(data))
+            self.assertEqual(store.values()[row].tolist(), expected)
+        self.assertEqual(store[2, 2], 6)
+        self.assertEqual(store[1, 1], MISSING)
+        self.assertRaises(IndexError, lambda: store[5, 0])
+        self.assertRaises(IndexError, lambda: store[0, 10])
+
+    def test_append_matrix(self):
+        store = ByteStore(rows=2, columns=2)
+        store.append([9], 0.5)
+        data = np.array([[1, 2, 0, 0], [3, 0, 0, 0], [4, 5, 6, 0]], np.uint8)
+        valid = np.array([[1, 1, 0, 0], [1, 0, 0, 0], [1, 1, 1, 0]], bool)
+        store.append_matrix(data, valid, [1.0, 2.0, 3.0])
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.width, 3)
+        self.assertEqual(store.values().tolist(),
+                         [[9, MISSING, MISSING], [1, 2, MISSING],
+                          [3, MISSING, MISSING], [4, 5, 6]])
+        self.assertEqual(store.timestamps().tolist(), [0.5, 1.0, 2.0, 3.0])
+
+    def test_views(self):
+        store = ByteStore(rows=4, columns=4)
+        for i in xrange(100):
+            store.append([i, i + 1] if i % 2 else [i])
+        column = store.column(1, 90)
+        self.assertTrue(np.may_share_memory(column, store.array))
+        self.assertEqual(column.tolist(),
+                         [i + 1 if i % 2 else MISSING for i in xrange(90, 100)])
+        self.assertEqual(store.valid(1, 90, 94).tolist(),
+                         [False, True, False, True])
+
+    def test_widen(self):
+        store = ByteStore(rows=1, columns=1)
+        store.append([1])
+        store.widen(5)
+        self.assertEqual(store.width, 5)
+        self.assertEqual(store.values().tolist(), [[1] + [MISSING] * 4])
+        store.clear()
+        self.assertEqual(len(store), 0)
+        store.append([2])
+        self.assertEqual(store.values().tolist(), [[2]])
+
+    def test_timestamps(self):
+        store = ByteStore(rows=2)
+        store.extend([[1], [2], [3], [4]], [0.5, 1.0, 1.0, 2.5])
+        store.append([5])
+        self.assertEqual(store.timestamps(0, 4).tolist(), [0.5, 1.0, 1.0, 2.5])
+        self.assertEqual(store.row_at(0.0), 0)
+        self.assertEqual(store.row_at(1.0), 1)
+        self.assertEqual(store.row_at(1.1), 3)
+        self.assertTrue(np.isnan(store.timestamps()[4]))
+        store.clear()
+        self.assertEqual(len(store.timestamps()), 0)
+
+
+class TestValueColumn(unittest.TestCase):
+
+    def test_append(self):
+        col = ValueColumn(rows=1)
+        for i in xrange(10):
+            col.append(None if i % 3 == 0 else i * 1000)
+        self.assertEqual(len(col), 10)
+        self.assertEqual(col.values(7, 9).tolist(), [7000, 8000])
+        self.assertEqual(col.valid(0, 4).tolist(), [False, True, True, False])
+
+    def test_extend(self):
+        col = ValueColumn(rows=2)
+        col.append(1)
+        col.extend(np.arange(5.0))
+        col.extend([np.nan])
+        self.assertEqual(len(col), 7)
+        self.assertEqual(col.values(0, 6).tolist(), [1, 0, 1, 2, 3, 4])
+        self.assertFalse(col.valid()[6])
+
+
+class TestMinMaxPyramid(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.values = np.array([random.choice([np.nan, random.random()])
+                                for i in xrange(5000)])
+        self.pyramid = MinMaxPyramid(lambda a, b: self.values[a:b], 4)
+
+    def check(self, start, stop, buckets):
+        x, lo, hi = self.pyramid.envelope(start, stop, buckets)
+        self.assertTrue(len(x) <= buckets or lo is hi)
+        self.assertTrue(x[0] <= start < (x[1] if len(x) > 1 else stop))
+        bounds = list(x[1:]) + [stop]
+        for first, last, l, h in zip(x, bounds, lo, hi):
+            chunk = self.values[first:last]
+            chunk = chunk[~np.isnan(chunk)]
+            if len(chunk):
+                self.assertEqual(l, chunk.min())
+                self.assertEqual(h, chunk.max())
+            else:
+                self.assertTrue(np.isnan(l) and np.isnan(h))
+
+    def test_envelope(self):
+        self.pyramid.update(5000)
+        self.check(0, 5000, 10)
+        self.check(1234, 4321, 7)
+        self.check(0, 30, 10)
+
+    def test_incremental(self):
+        for n in (1, 3, 64, 65, 1000, 4999):
+            self.pyramid.update(n)
+            self.check(0, n, 4)
+            self.check(n // 2, n, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
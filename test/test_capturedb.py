@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import unittest
+from StringIO import StringIO
+
+from tutil import *
+from columnar import ColumnarCapture
+from pcapfile import PcapWriter
+from capturedb import CaptureDB, build_query, request_condition
+
+class TestCaptureDB(unittest.TestCase):
+
+    def setUp(self):
+        # a SET_REPORT request and its callback, then interrupt packets on
+        # two devices
+        self.packets = [
+            make_packet([1], event_type='S', xfer_type=2, epnum=0, devnum=5,
+                        ts=1.0, setup=[0x21, 0x09, 0, 2, 0, 0, 1, 0],
+                        urb=0xffff880012345678),
+            make_packet([], event_type='C', xfer_type=2, epnum=0, devnum=5,
+                        ts=1.5, urb=0xffff880012345678)]
+        for i in xrange(10):
+            self.packets.append(make_packet([i, i * 2], devnum=5 + i % 2,
+                                            epnum=0x81, ts=2.0 + i))
+        self.db = CaptureDB(':memory:')
+        self.db.import_capture(ColumnarCapture.from_packets(self.packets),
+                               'test', chunk_size=4)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_columns(self):
+        rows = self.db.select(['urb', 'event_type', 'devnum', 'epnum', 'ts',
+                               'datalen', 'bmRequestType', 'bRequest',
+                               'wValue', 'wLength'], limit=3).fetchall()
+        self.assertEqual(rows[0], (0xffff880012345678 - (1 << 64), 'S', 5, 0,
+                                   1.0, 1, 0x21, 9, 0x200, 1))
+        self.assertEqual(rows[1][1], 'C')
+        self.assertEqual(rows[2][5:], (2, None, None, None, None))
+        self.assertEqual(self.db.captures(), [(1, 'test', 220, 65535, 12)])
+
+    def test_query(self):
+        clause, params = build_query(device=5, endpoint=0x81)
+        self.assertEqual(self.db.count(clause, params), 5)
+        clause, params = build_query('datalen > 1 AND ts < 5', capture='test')
+        self.assertEqual(self.db.count(clause, params), 3)
+        clause, params = build_query(device=5, request='SET_REPORT')
+        self.assertEqual(self.db.count(clause, params), 1)
+        self.assertEqual(self.db.count(*build_query(capture='other')), 0)
+        self.assertRaises(ValueError, request_condition, 'NO_SUCH_REQUEST')
+        # a standard request with the same bRequest
+        clause, params = build_query(request='set_configuration')
+        self.assertEqual(self.db.count(clause, params), 0)
+
+    def test_query_plan(self):
+        clause, params = build_query(device=5, endpoint=0x81)
+        plan = ' '.join(self.db.query_plan(['data'], clause, params))
+        self.assertTrue('USING INDEX packets_endpoint (devnum=? AND epnum=?)'
+                        in plan, plan)
+        # the index also gives the order by timestamp
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+        clause, params = build_query(device=5)
+        plan = ' '.join(self.db.query_plan(['data'], clause, params))
+        self.assertTrue('USING INDEX packets_device (devnum=?)' in plan, plan)
+        clause, params = build_query('ts > 3')
+        plan = ' '.join(self.db.query_plan(['data'], clause, params))
+        self.assertTrue('USING INDEX packets_ts (ts>?)' in plan, plan)
+
+    def test_indexes_rebuilt(self):
+        indexes = lambda: sorted(row[0] for row in self.db.db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        names = ['packets_device', 'packets_endpoint', 'packets_ts']
+        self.assertEqual(indexes(), names)
+        self.db.drop_indexes()
+        self.assertEqual(indexes(), [])
+        self.db.import_capture(ColumnarCapture.from_packets(self.packets),
+                               'again', reindex=False)
+        self.assertEqual(indexes(), [])
+        self.db.create_indexes()
+        self.db.import_capture(ColumnarCapture.from_packets(self.packets),
+                               'third')
+        self.assertEqual(indexes(), names)
+        self.assertEqual(self.db.count(*build_query(device=5, endpoint=0x81)),
+                         15)
+
+    def test_records(self):
+        records = list(self.db.records())
+        self.assertEqual([data for hdr, data in records],
+                         [packet.repack() for packet in self.packets])
+        hdr, data = records[3]
+        self.assertEqual(hdr.getts(), (3, 0))
+        self.assertEqual(hdr.getcaplen(), len(data))
+        self.assertEqual(len(list(self.db.records(limit=2))), 2)
+
+    def test_import_pcap(self):
+        f = StringIO()
+        writer = PcapWriter(f)
+        for packet in self.packets:
+            writer.dump(packet.hdr, packet.repack())
+        pcap = f.getvalue()
+        self.db.import_pcap(StringIO(pcap), 'again', chunk_size=5)
+        clause, params = build_query(capture='again')
+        self.assertEqual(self.db.count(clause, params), 12)
+        self.assertEqual(self.db.linktype(clause, params), (220, 65535))
+        # written back as pcap
+        out = StringIO()
+        writer = PcapWriter(out, *self.db.linktype(clause, params))
+        for hdr, data in self.db.records(clause, params):
+            writer.dump(hdr, data)
+        self.assertEqual(out.getvalue(), pcap)
+
+
+if __name__ == '__main__':
+    unittest.main()
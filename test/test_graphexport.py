@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import random
+import struct
+import unittest
+import zlib
+from StringIO import StringIO
+
+import numpy as np
+
+from tutil import *
+from pcapfile import PcapWriter, PcapStream
+from columnar import ColumnarCapture
+from graphexport import StreamingEnvelope, GraphExport, write_png
+
+class TestStreamingEnvelope(unittest.TestCase):
+
+    def test_envelope(self):
+        random.seed(2)
+        values = np.array([[random.choice([np.nan, random.random()]),
+                            random.random()] for i in xrange(3001)])
+        ts = np.arange(len(values)) * 0.5
+        env = StreamingEnvelope(2, buckets=10)
+        i = 0
+        while i < len(values):
+            n = random.randint(1, 200)
+            env.add(ts[i:i+n], values[i:i+n])
+            i += n
+        first, bts, lo, hi = env.result()
+        self.assertTrue(10 <= len(first) <= 21)
+        self.assertEqual(first[0], 0)
+        self.assertEqual(bts.tolist(), (first * 0.5).tolist())
+        bounds = list(first[1:]) + [len(values)]
+        for k in xrange(len(first)):
+            chunk = values[first[k]:bounds[k]]
+            for s in xrange(2):
+                column = chunk[:, s][~np.isnan(chunk[:, s])]
+                if len(column):
+                    self.assertEqual(lo[k, s], column.min())
+                    self.assertEqual(hi[k, s], column.max())
+                else:
+                    self.assertTrue(np.isnan(lo[k, s]))
+
+    def test_short(self):
+        env = StreamingEnvelope(1, buckets=10)
+        env.add(np.arange(3.0), np.array([[1.0], [2.0], [3.0]]))
+        first, ts, lo, hi = env.result()
+        self.assertEqual(first.tolist(), [0, 1, 2])
+        self.assertEqual(lo[:, 0].tolist(), [1, 2, 3])
+
+
+class TestGraphExport(unittest.TestCase):
+
+    def setUp(self):
+        f = StringIO()
+        writer = PcapWriter(f)
+        for i in xrange(100):
+            packet = make_packet(data=[i, 2 * i, 1] if i % 2 else [i],
+                                 epnum=0x81 if i % 2 else 0x02, ts=i * 0.1)
+            writer.dump(packet.hdr, packet.repack())
+        self.pcap = f.getvalue()
+
+    def export(self, **kwargs):
+        export = GraphExport(**kwargs)
+        export.read(PcapStream(StringIO(self.pcap)), chunk_size=16)
+        return export
+
+    def test_table(self):
+        export = self.export(offsets=[0, 1], expressions=['[1] - [0]'],
+                             buckets=200)
+        table = export.table()
+        self.assertEqual(len(table), 100)
+        self.assertEqual(table['[0] min'].tolist(), range(100))
+        self.assertTrue(np.isnan(table['[1] max'][0]))
+        self.assertEqual(table['[1] - [0] max'][3], 3)
+        # packet 0 (offset 0 is 0) is not plotted as 0
+        table = self.export(expressions=['[0] / [0]'], buckets=200).table()
+        self.assertTrue(np.isnan(table['[0] / [0] max'][0]))
+        self.assertEqual(table['[0] / [0] max'][1], 1)
+        self.assertAlmostEqual(table['time'][10], 1.0)
+
+    def test_endpoint(self):
+        export = self.export(offsets=[1], endpoint=(2, 0x81), buckets=10)
+        table = export.table()
+        self.assertTrue(10 <= len(table) <= 20)
+        self.assertEqual(table['[1] min'][0], 2)
+        self.assertEqual(np.nanmax(table['[1] max']), 198)
+
+    def test_read_capture(self):
+        records = [data for hdr, data in PcapStream(StringIO(self.pcap))]
+        export = GraphExport(offsets=[1], endpoint=(2, 0x81), buckets=10)
+        export.read_capture(ColumnarCapture.from_records(records),
+                            chunk_size=16)
+        self.assertEqual(export.table().tolist(),
+                         self.export(offsets=[1], endpoint=(2, 0x81),
+                                     buckets=10).table().tolist())
+
+    def test_csv(self):
+        f = StringIO()
+        self.export(offsets=[1], buckets=200).write_csv(f)
+        lines = f.getvalue().splitlines()
+        self.assertEqual(lines[0], 'packet,time,[1] min,[1] max')
+        self.assertEqual(lines[1], '0,0.0,,')
+        self.assertEqual(lines[2], '1,0.1,2.0,2.0')
+
+    def test_png(self):
+        f = StringIO()
+        self.export(offsets=[0]).write_png(f, 64, 32)
+        png = f.getvalue()
+        self.assertEqual(png[:8], '\x89PNG\r\n\x1a\n')
+        self.assertEqual(struct.unpack('>II', png[16:24]), (64, 32))
+        idat = png.index('IDAT')
+        length = struct.unpack('>I', png[idat-4:idat])[0]
+        raw = zlib.decompress(png[idat+4:idat+4+length])
+        self.assertEqual(len(raw), 32 * (64 * 3 + 1))
+
+    def test_write_png(self):
+        image = np.zeros((2, 3, 3), np.uint8)
+        image[0, 1] = (255, 0, 0)
+        image[1, 2] = (1, 2, 3)
+        f = StringIO()
+        write_png(f, image)
+        png = f.getvalue()
+        self.assertEqual(png[-12:], struct.pack('>I', 0) + 'IEND' +
+                         struct.pack('>I', zlib.crc32('IEND') & 0xffffffff))
+        ihdr = png.index('IHDR')
+        self.assertEqual(struct.unpack('>IIBBBBB', png[ihdr+4:ihdr+17]),
+                         (3, 2, 8, 2, 0, 0, 0))
+        idat = png.index('IDAT')
+        length = struct.unpack('>I', png[idat-4:idat])[0]
+        raw = np.frombuffer(zlib.decompress(png[idat+4:idat+4+length]),
+                            np.uint8).reshape(2, 10)
+        # filter type 0 then the RGB triplets of each scanline
+        self.assertEqual(raw[:, 0].tolist(), [0, 0])
+        self.assertEqual(raw[:, 1:].reshape(2, 3, 3).tolist(), image.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from tutil import *
+from usbrevue import Packet
+from pcapfile import PcapWriter, PcapReader, PcapStream, GLOBAL_HEADER, \
+                     RECORD_HEADER, LINKTYPE_USB_LINUX_MMAPPED
+
+class TestPcapWriter(unittest.TestCase):
+
+    def test_write(self):
+        f = StringIO()
+        writer = PcapWriter(f)
+        packets = [make_packet(data=[i] * i, ts=1.5 + i) for i in range(3)]
+        for packet in packets:
+            writer.dump(packet.hdr, packet.repack())
+        out = f.getvalue()
+
+        header = GLOBAL_HEADER.unpack_from(out)
+        self.assertEqual(header[0], 0xa1b2c3d4)
+        self.assertEqual(header[-1], LINKTYPE_USB_LINUX_MMAPPED)
+        offset = GLOBAL_HEADER.size
+        for packet in packets:
+            sec, usec, caplen, length = RECORD_HEADER.unpack_from(out, offset)
+            offset += RECORD_HEADER.size
+            self.assertEqual((sec, usec), packet.hdr.getts())
+            self.assertEqual(caplen, 64 + packet.datalen)
+            self.assertEqual(out[offset:offset+caplen], packet.repack())
+            offset += caplen
+        self.assertEqual(offset, len(out))
+
+    def test_compatible(self):
+        # the same bytes as a capture written by tcpdump/pcapy
+        mouse = open(test_data('mouse.pcap'), 'rb').read()
+        f = StringIO()
+        PcapWriter(f)
+        self.assertEqual(f.getvalue()[:8], mouse[:8])
+
+
+class TestPcapReader(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcap')
+        self.packets = [make_packet(data=range(i), ts=10 + i * 0.25)
+                        for i in range(20)]
+        writer = PcapWriter(os.fdopen(fd, 'wb'))
+        for packet in self.packets:
+            writer.dump(packet.hdr, packet.repack())
+        writer.close()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_roundtrip(self):
+        reader = PcapReader(self.path)
+        self.assertEqual(len(reader), 0)
+        self.assertEqual(reader.index(5), 5)
+        self.assertEqual(len(reader), 5)
+        self.assertFalse(reader.done)
+        self.assertEqual(reader.index(), 15)
+        self.assertTrue(reader.done)
+        self.assertEqual(reader.index(), 0)
+        for i in (19, 0, 7):
+            hdr, data = reader.record(i)
+            self.assertEqual(hdr.getts(), self.packets[i].hdr.getts())
+            self.assertEqual(hdr.getcaplen(), len(data))
+            self.assertEqual(Packet(hdr, data), self.packets[i])
+        reader.close()
+
+    def test_iter(self):
+        reader = PcapReader(self.path)
+        self.assertEqual([data for hdr, data in reader],
+                         [packet.repack() for packet in self.packets])
+
+    def test_truncated(self):
+        f = open(self.path, 'r+b')
+        f.truncate(os.path.getsize(self.path) - 3)
+        f.close()
+        reader = PcapReader(self.path)
+        self.assertEqual(reader.index(), 19)
+
+    def test_not_pcap(self):
+        f = open(self.path, 'wb')
+        f.write('not a pcap file, really not at all')
+        f.close()
+        self.assertRaises(ValueError, PcapReader, self.path)
+
+    def test_capture(self):
+        reader = PcapReader(test_data('mouse.pcap'))
+        reader.index()
+        self.assertEqual(reader.linktype, LINKTYPE_USB_LINUX_MMAPPED)
+        self.assertEqual(reader.next_offset, reader.size)
+        for hdr, data in reader:
+            Packet(hdr, data)
+
+
+class TestPcapStream(unittest.TestCase):
+
+    def setUp(self):
+        self.packets = [make_packet(data=range(i), ts=10 + i * 0.25)
+                        for i in range(20)]
+        self.f = StringIO()
+        writer = PcapWriter(self.f)
+        for packet in self.packets:
+            writer.dump(packet.hdr, packet.repack())
+
+    def test_read(self):
+        stream = PcapStream(StringIO(self.f.getvalue()))
+        self.assertEqual(stream.linktype, LINKTYPE_USB_LINUX_MMAPPED)
+        records = list(stream)
+        self.assertEqual(len(records), len(self.packets))
+        for (hdr, data), packet in zip(records, self.packets):
+            self.assertEqual(hdr.getts(), packet.hdr.getts())
+            self.assertEqual(Packet(hdr, data), packet)
+
+    def test_truncated(self):
+        stream = PcapStream(StringIO(self.f.getvalue()[:-3]))
+        self.assertEqual(len(list(stream)), len(self.packets) - 1)
+
+    def test_not_pcap(self):
+        self.assertRaises(ValueError, PcapStream, StringIO('not pcap'))
+
+
+if __name__ == '__main__':
+    unittest.main()
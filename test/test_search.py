@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tutil import *
+from pcapfile import PcapWriter, PcapReader
+from columnar import ColumnarCapture, CaptureReader, export_pcap
+from search import parse_byte_pattern, byte_pattern, find_in_payload, \
+                   find_records, PatternMatcher
+
+class TestBytePattern(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_byte_pattern('DD ?? 01'), [0xdd, None, 1])
+        self.assertEqual(parse_byte_pattern(' dd0102 '), [0xdd, 1, 2])
+        self.assertRaises(ValueError, parse_byte_pattern, 'dd 1')
+        self.assertRaises(ValueError, parse_byte_pattern, 'xx')
+        self.assertRaises(ValueError, parse_byte_pattern, '')
+
+    def test_payload(self):
+        raw = make_packet(data=[1, 2, 0xdd, 0xdd, 3]).repack()
+        self.assertTrue(find_in_payload(byte_pattern('dd ?? 03'), raw))
+        self.assertTrue(find_in_payload(byte_pattern('01'), raw))
+        self.assertFalse(find_in_payload(byte_pattern('03 ??'), raw))
+
+
+class TestFindRecords(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcap')
+        writer = PcapWriter(os.fdopen(fd, 'wb'))
+        # the urb carries the pattern bytes in every usbmon header, which
+        # must not match
+        for i in range(50):
+            data = [0xa5, i, 0x5a] if i % 7 == 3 else [i, 0xa5]
+            packet = make_packet(data=data, urb=0x5aa5)
+            writer.dump(packet.hdr, packet.repack())
+        # pattern split across two records
+        for data in ([0xa5], [0x77, 0x5a]):
+            packet = make_packet(data=data, urb=0x5aa5)
+            writer.dump(packet.hdr, packet.repack())
+        writer.close()
+        self.reader = PcapReader(self.path)
+        self.reader.index()
+
+    def tearDown(self):
+        self.reader.close()
+        os.unlink(self.path)
+
+    def test_forward(self):
+        regex = byte_pattern('a5 ?? 5a')
+        hits = list(find_records(regex, self.reader, 0, len(self.reader)))
+        self.assertEqual(hits, [3, 10, 17, 24, 31, 38, 45])
+        hits = list(find_records(regex, self.reader, 11, 31))
+        self.assertEqual(hits, [17, 24])
+
+    def test_backward(self):
+        regex = byte_pattern('a5 ?? 5a')
+        hits = list(find_records(regex, self.reader, 0, 40, forward=False,
+                                 chunk=8))
+        self.assertEqual(hits, [38, 31, 24, 17, 10, 3])
+
+    def test_overlapping(self):
+        # record 5 holds [05, a5]: found even though '05' also matches in
+        # the header
+        hits = list(find_records(byte_pattern('05 a5'), self.reader, 0, 50))
+        self.assertEqual(hits, [5])
+
+    def test_saved_capture(self):
+        path = tempfile.mkdtemp()
+        try:
+            export_pcap(self.path, path)
+            reader = CaptureReader(path)
+            reader.index()
+            regex = byte_pattern('a5 ?? 5a')
+            self.assertEqual(list(find_records(regex, reader, 0, len(reader))),
+                             [3, 10, 17, 24, 31, 38, 45])
+            self.assertEqual(list(find_records(regex, reader, 0, 40,
+                                               forward=False, chunk=8)),
+                             [38, 31, 24, 17, 10, 3])
+            self.assertEqual(list(find_records(byte_pattern('05 a5'), reader,
+                                               0, 50)), [5])
+        finally:
+            shutil.rmtree(path)
+
+
+class TestPatternMatcher(unittest.TestCase):
+
+    def setUp(self):
+        # 'he', 'she', 'his', 'hers'
+        self.matcher = PatternMatcher(['68 65', '73 68 65', '68 69 73',
+                                       '68 65 72 73'])
+
+    def test_scan(self):
+        hits = self.matcher.scan('ushers')
+        self.assertEqual(sorted(hits), [(0, 2), (1, 1), (3, 2)])
+        self.assertEqual(self.matcher.scan('xxhisx', 2, 5), [(2, 0)])
+        self.assertEqual(self.matcher.scan('nothing'), [])
+
+    def test_wildcards(self):
+        matcher = PatternMatcher(['01 ?? 01', '01'])
+        self.assertEqual(matcher.scan('\x01\x02\x01\x03\x01'),
+                         [(0, 0), (1, 0), (0, 2), (1, 2), (1, 4)])
+
+    def test_payloads(self):
+        packets = [make_packet(data=map(ord, s)) for s in
+                   ('', 'his', 'xxxxh', 'ers', 'she')]
+        capture = ColumnarCapture.from_packets(packets)
+        hits = list(self.matcher.scan_payloads(capture.blob.tostring(),
+                                               capture.offsets))
+        # 'hers' across two payloads is not a hit
+        self.assertEqual(hits, [(1, [(2, 0)]), (4, [(1, 0), (0, 1)])])
+
+    def test_records(self):
+        fd, path = tempfile.mkstemp(suffix='.pcap')
+        writer = PcapWriter(os.fdopen(fd, 'wb'))
+        for s in ('', 'hers', 'xxhis', 'none'):
+            packet = make_packet(data=map(ord, s))
+            writer.dump(packet.hdr, packet.repack())
+        writer.close()
+        reader = PcapReader(path)
+        reader.index()
+        self.assertEqual(list(self.matcher.scan_records(reader)),
+                         [(1, [(0, 0), (3, 0)]), (2, [(2, 2)])])
+        reader.close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for urbtracker.py"""
+
+import unittest
+
+from tutil import *
+from urbtracker import UrbTracker
+
+
+class TestUrbTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = UrbTracker(timeout=10)
+
+    def test_pairing(self):
+        self.tracker.submit(1, 0xa0, 1.0, 'first')
+        self.tracker.submit(2, 0xa0, 1.5, 'other bus')
+        self.assertEqual(len(self.tracker), 2)
+        self.assertEqual(self.tracker.complete(1, 0xa0, 1.25), (0.25, 'first'))
+        self.assertEqual(self.tracker.complete(1, 0xa0, 1.5), None)
+        self.assertEqual(self.tracker.orphans, 1)
+        self.assertTrue((2, 0xa0) in self.tracker)
+
+    def test_track_packets(self):
+        sub = make_packet(urb=7, event_type='S', ts=2.0)
+        self.assertEqual(self.tracker.track(sub, 'row 0'), None)
+        cb = make_packet(urb=7, event_type='C', ts=2.004)
+        latency, item = self.tracker.track(cb)
+        self.assertEqual(item, 'row 0')
+        self.assertAlmostEqual(latency, 0.004)
+        self.assertEqual(self.tracker.matched, 1)
+
+    def test_timeout_eviction(self):
+        self.tracker.submit(1, 1, 0.0)
+        self.tracker.submit(1, 2, 5.0)
+        self.tracker.submit(1, 1, 6.0)       # re-used URB id
+        self.tracker.submit(1, 3, 15.5)
+        self.assertEqual(self.tracker.evicted, 1)
+        self.assertEqual(list(self.tracker.pending), [(1, 1), (1, 3)])
+        evicted = self.tracker.expire(100.0)
+        self.assertEqual([key for key, sub in evicted], [(1, 1), (1, 3)])
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_no_timeout(self):
+        tracker = UrbTracker()
+        tracker.submit(1, 1, 0.0)
+        tracker.submit(1, 2, 1e6)
+        self.assertEqual(tracker.expire(1e9), [])
+        self.assertEqual(len(tracker), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,7 @@
 """Module to make testing easier."""
 
 import os.path
+import struct
 from os.path import abspath, dirname
 
 import sys
@@ -43,6 +44,37 @@ PYTHON_2_7_PLUS = True  if sys.version_info[0] == 2 and sys.version_info[1] >= 7
 def test_data(fname):
     return os.path.join(TEST_DATA_DIR, fname)
 
+class FakePcapHeader(object):
+    """Stand-in for a pcapy packet header."""
+    def __init__(self, ts, caplen):
+        self.ts = ts
+        self.caplen = caplen
+
+    def getts(self):
+        return (int(self.ts), int(round((self.ts - int(self.ts)) * 1e6)))
+
+    def getlen(self):
+        return self.caplen
+
+    def getcaplen(self):
+        return self.caplen
+
+def make_packet(data=(), urb=0x1000, event_type='C', xfer_type=1, epnum=0x81,
+                devnum=2, busnum=1, ts=0.0, setup=None, status=0,
+                interval=0):
+    """Build a synthetic usbmon Packet with the given fields."""
+    from usbrevue import Packet
+    data = ''.join(chr(b) for b in data)
+    ts_sec = int(ts)
+    ts_usec = int(round((ts - ts_sec) * 1e6))
+    flag_setup = '\x00' if setup is not None else '-'
+    setup = ''.join(chr(b) for b in setup) if setup is not None else '\x00' * 8
+    raw = struct.pack('<QcBBBHccqiiII8siiII', urb, event_type, xfer_type,
+                      epnum, devnum, busnum, flag_setup, '\x00', ts_sec,
+                      ts_usec, status, len(data), len(data), setup, interval,
+                      0, 0, 0) + data
+    return Packet(FakePcapHeader(ts, len(raw)), raw)
+
 class TestUtil(object):
     """Mix-in class of functions supporting testing."""
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Tracking of URBs from submission to callback.
+
+usbmon reports every USB Request Block twice: once when it is submitted
+('S') and once when it completes ('C') or fails ('E'). Both events carry the
+same URB id, which is unique per bus while the request is in flight, so
+submissions and callbacks are paired on (busnum, urb).
+"""
+
+from collections import OrderedDict
+
+
+class UrbTracker(object):
+    """Pair submissions with their callbacks in constant time.
+
+    Outstanding submissions are kept in an ordered dict keyed by (busnum,
+    urb), so that submit() and complete() are O(1) and orphaned submissions
+    (which never see a callback, e.g. because the capture stopped) can be
+    evicted oldest first once they are older than ``timeout`` seconds.
+
+    Each submission may carry an arbitrary ``item`` (e.g. the Packet itself
+    or its row in a view), which is handed back when the callback arrives.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.pending = OrderedDict()
+        self.matched = 0
+        self.orphans = 0        # callbacks without a submission
+        self.evicted = 0        # submissions dropped by the timeout
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def __repr__(self):
+        return '[%s]' % ', '.join('0x%x' % urb for bus, urb in self.pending)
+
+    def submit(self, busnum, urb, ts, item=None):
+        """Record a submission at time ts (in seconds)."""
+        key = (busnum, urb)
+        # a re-used URB id starts over at the back of the queue
+        self.pending.pop(key, None)
+        self.pending[key] = (ts, item)
+        if self.timeout is not None:
+            self.expire(ts)
+
+    def complete(self, busnum, urb, ts=None):
+        """Record a callback (or error). Returns a tuple (latency, item) for
+        the matching submission, or None if there is none. latency is None
+        if ts is not given."""
+        sub = self.pending.pop((busnum, urb), None)
+        if sub is None:
+            self.orphans += 1
+            return None
+        self.matched += 1
+        sub_ts, item = sub
+        return (None if ts is None else ts - sub_ts), item
+
+    def track(self, packet, item=None):
+        """Track a Packet: submissions are recorded, callbacks and errors
+        completed. Returns the result of complete() for callbacks and
+        errors, None otherwise."""
+        ts = packet.ts_sec + packet.ts_usec / 1e6
+        if packet.is_event_type_submission:
+            self.submit(packet.busnum, packet.urb, ts, item)
+        else:
+            return self.complete(packet.busnum, packet.urb, ts)
+
+    def expire(self, now):
+        """Evict the submissions older than now - timeout. Returns the list
+        of evicted (key, (ts, item)) tuples."""
+        evicted = list()
+        if self.timeout is None:
+            return evicted
+        oldest = now - self.timeout
+        while self.pending:
+            key, (ts, item) = next(self.pending.iteritems())
+            if ts >= oldest:
+                break
+            del self.pending[key]
+            evicted.append((key, (ts, item)))
+        self.evicted += len(evicted)
+        return evicted
+
+    def clear(self):
+        self.pending.clear()
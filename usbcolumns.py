@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Convert a usbmon pcap capture to a saved columnar capture.
+
+    usbcolumns.py capture.pcap capture-dir
+
+The directory holds the usbmon headers (a typed column per header field,
+with the setup packet fields decoded), the payload offsets and the payload
+bytes as NumPy .npy files. usbstatisfier.py, usbgraph.py and usbview.py
+accept the directory in place of the pcap file and memory-map it, so that
+the capture need not be parsed again each time it is analyzed.
+"""
+
+import sys
+from optparse import OptionParser
+
+from columnar import export_pcap
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog capture.pcap capture-dir")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error('expected a pcap file and a directory')
+    try:
+        count = export_pcap(args[0], args[1])
+    except (IOError, OSError, ValueError), e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+    sys.stderr.write('%d packets saved to %s\n' % (count, args[1]))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Austin Leirvik <aua at pdx.edu>
+# Copyright (C) 2011 Wil Cooley <wcooley at pdx.edu>
+# Copyright (C) 2011 Joanne McBride <jirab21@yahoo.com>
+# Copyright (C) 2011 Danny Aley <danny.aley@gmail.com>
+# Copyright (C) 2011 Erich Ulmer <blurrymadness@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""Import USB captures into an SQLite database and query them.
+
+    usbdb.py --import file.pcap captures.db
+    usbdb.py --device 5 --request SET_REPORT captures.db
+    usbdb.py captures.db "epnum = 0x81 AND datalen > 8" | usbview.py
+
+The database is described in capturedb.py. A query is an optional SQL
+condition on the columns of the packets table, combined with the --device,
+--endpoint, --request and --capture options. The packets selected are
+written as pcap to --output, or to standard output if it is not a terminal
+(for usbview.py, usbreplay.py or usbmodify.py), or else listed.
+"""
+
+import sqlite3
+import sys
+from optparse import OptionParser
+
+from capturedb import CaptureDB, build_query
+from pcapfile import PcapWriter
+
+
+def list_packets(db, clause, params, limit, out):
+    """Write a line per packet selected by clause to out."""
+    columns = ['id', 'capture', 'ts', 'busnum', 'devnum', 'epnum',
+               'event_type', 'xfer_type', 'status', 'datalen',
+               'bmRequestType', 'bRequest', 'wValue', 'wIndex', 'wLength',
+               'substr(data, 1, 16)']
+    for row in db.select(columns, clause, params, limit):
+        (packet, capture, ts, busnum, devnum, epnum, event_type, xfer_type,
+         status, datalen, bmRequestType, bRequest, wValue, wIndex, wLength,
+         data) = row
+        setup = ''
+        if bRequest is not None:
+            setup = ' setup %02x %02x %04x %04x %04x' % (
+                    bmRequestType, bRequest, wValue, wIndex, wLength)
+        out.write('%d %d %.6f %d:%02d:%02x %s %d %d%s len %d %s\n' % (
+                packet, capture, ts, busnum, devnum, epnum, event_type,
+                xfer_type, status, setup, datalen,
+                ' '.join('%02x' % ord(b) for b in str(data or ''))))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] DATABASE [CONDITION]")
+    parser.add_option("--import", dest="imports", action="append",
+            default=[], metavar="FILE",
+            help="Import the pcap file (or saved capture directory) FILE; "
+                 "may be given several times.")
+    parser.add_option("--name", default=None,
+            help="Name of the imported capture (default: the file name); "
+                 "only with a single --import.")
+    parser.add_option("--list-captures", default=False, action="store_true",
+            help="List the captures in the database.")
+    parser.add_option("-d", "--device", type="int", default=None,
+            help="Only the packets of device number DEVICE.")
+    parser.add_option("-e", "--endpoint", default=None,
+            help="Only the packets of endpoint ENDPOINT (in hex).")
+    parser.add_option("-r", "--request", default=None,
+            help="Only the control requests REQUEST, a standard request "
+                 "(e.g. GET_DESCRIPTOR) or an HID class request (e.g. "
+                 "SET_REPORT).")
+    parser.add_option("-c", "--capture", default=None,
+            help="Only the packets of the capture named CAPTURE.")
+    parser.add_option("-n", "--limit", type="int", default=None,
+            help="At most LIMIT packets.")
+    parser.add_option("--count", default=False, action="store_true",
+            help="Only print the number of packets selected.")
+    parser.add_option("-o", "--output", default=None, metavar="FILE",
+            help="Write the packets selected to the pcap file FILE.")
+    (options, args) = parser.parse_args()
+    if not args or len(args) > 2:
+        parser.error('expected a database and an optional condition')
+    if options.name is not None and len(options.imports) != 1:
+        parser.error('--name can only be used with a single --import')
+
+    db = CaptureDB(args[0])
+    if options.imports:
+        # index the packets of all the captures at once
+        db.drop_indexes()
+        try:
+            for path in options.imports:
+                db.import_pcap(path, options.name, reindex=False)
+        finally:
+            db.create_indexes()
+    if options.list_captures:
+        for capture, name, linktype, snaplen, count in db.captures():
+            sys.stdout.write('%d %s: %d packets\n' % (capture, name, count))
+    if options.imports or options.list_captures:
+        if len(args) == 1:
+            sys.exit(0)
+
+    try:
+        endpoint = int(options.endpoint, 16) \
+                if options.endpoint is not None else None
+        clause, params = build_query(args[1] if len(args) > 1 else None,
+                                     options.device, endpoint,
+                                     options.request, options.capture)
+        if options.count:
+            sys.stdout.write('%d\n' % db.count(clause, params))
+        elif options.output or not sys.stdout.isatty():
+            linktype, snaplen = db.linktype(clause, params)
+            f = open(options.output, 'wb') if options.output else sys.stdout
+            writer = PcapWriter(f, linktype, snaplen)
+            for hdr, data in db.records(clause, params, options.limit):
+                writer.dump(hdr, data)
+            if options.output:
+                writer.close()
+            else:
+                writer.flush()
+        else:
+            list_packets(db, clause, params, options.limit, sys.stdout)
+    except ValueError, e:
+        parser.error(str(e))
+    except sqlite3.Error, e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
@@ -24,64 +24,76 @@ plotting the data payload of USB packets.
 """
 
 import sys
+import time
+from optparse import OptionParser
 from usbview import PcapThread
 from usbrevue import Packet
+import analysis
+import graphexport
+from columnar import ColumnarCapture, ByteExpression, is_saved_capture
+from bytestore import ByteStore, ValueColumn, MinMaxPyramid, MISSING
 from PyQt4 import Qt
 from PyQt4.QtGui import *
 from PyQt4.QtCore import (QAbstractTableModel, QModelIndex, QVariant,
-                          QString, QByteArray, pyqtSignal, QTimer)
+                          QString, QByteArray, QRectF, QObject, pyqtSignal,
+                          QTimer)
 import PyQt4.Qwt5 as Qwt
 import numpy as np
 import random
 import re
 
+# default maximum number of redraws per second
+DEFAULT_FPS = 30
+
 
 class ByteModel(QAbstractTableModel):
-    """Qt Model for byte data."""
+    """Qt Model for byte data.
+
+    Payloads are kept in one ByteStore for all packets and one per
+    (devnum, epnum) endpoint; the model shows the store of the selected
+    endpoint (all packets by default), which is also the one plotted.
+    """
 
-    row_added = pyqtSignal() # emit when a new usb packet is received
+    # emit when new usb packets are received, with the number of packets
+    row_added = pyqtSignal(int)
     # emit when a new usb packet's data payload is larger than any
     # we've seen before
     col_added = pyqtSignal()
     cb_checked = pyqtSignal(int) # emit when a column checkbox is checked
     cb_unchecked = pyqtSignal(int) # emit when a column checkbox is unchecked
+    endpoint_added = pyqtSignal(object) # emit with each new (devnum, epnum)
+    # emit when another endpoint is selected
+    endpoint_selected = pyqtSignal()
 
     def __init__(self, parent=None):
         QAbstractTableModel.__init__(self, parent)
 
         # to keep track of which column checkboxes are checked
         self.cb_states = list()
-
+        # selected endpoint; None for all packets
+        self.endpoint = None
 
     def rowCount(self, parent = QModelIndex()):
-        if len(single_bytes) > 0:
-            # all byte arrays will have the same length, so just get
-            # the lowest one, since if there are any bytes at all,
-            # then we've have that one
-            return len(single_bytes[0])+1
-        else:
-            return 1
+        # one row per packet, plus the row of checkboxes
+        return len(single_bytes) + 1
 
     def columnCount(self, parent = QModelIndex()):
-        return len(single_bytes)
+        return single_bytes.width
 
     def data(self, index, role = Qt.Qt.DisplayRole):
         row = index.row()
         col = index.column()
         # 0 is the row with checkboxes, so no value there
         if row != 0:
-            val = single_bytes[col][row-1]
+            val = single_bytes[row-1, col]
 
         if role == Qt.Qt.DisplayRole:
             if row == 0: # again, 0 has checkboxes
                 return QVariant()
-            elif isinstance(val, str):
-                return val
+            elif val == MISSING: # no value for that byte
+                return '-'
             else:
-                if val == -1: # -1 => no value for that byte
-                    return '-'
-                else:
-                    return "%02X" % val
+                return "%02X" % val
         elif role == Qt.Qt.CheckStateRole and row == 0:
             return QVariant(self.cb_states[col])
         return QVariant()
@@ -112,65 +124,149 @@ class ByteModel(QAbstractTableModel):
         else:
             return Qt.Qt.ItemIsEnabled | Qt.Qt.ItemIsSelectable
 
+    def check_column(self, col):
+        """Tick the checkbox of column col, if it isn't already."""
+        if self.cb_states[col] == 0:
+            index = self.index(0, col)
+            self.setData(index, QVariant(Qt.Qt.Checked), Qt.Qt.CheckStateRole)
+            self.dataChanged.emit(index, index)
+
     def new_packet(self, packet):
-        if len(packet.data) > 0:
-            if len(single_bytes) > 0:
-                l = len(single_bytes[0]) # number of packets so far
-            else:
-                l = 0
-            w = len(single_bytes) # (max) number of bytes so far
-
-            first_row = True if len(single_bytes) == 0 else False
-            # if the incoming packet has more bytes than we've seen
-            # before, add the appropriate number of empty lists to the
-            # single_bytes list, along with columns for each new byte
-            if len(packet.data) > len(single_bytes):
-                self.beginInsertColumns(QModelIndex(),
-                                        w,
-                                        max(len(single_bytes),
-                                            len(packet.data) - 1))
-
-                for i in range(len(packet.data) - len(single_bytes)):
-                    if first_row:
-                        single_bytes.append(list())
-                        self.cb_states.append(0)
-                    else:
-                        single_bytes.append([-1] * len(single_bytes[0]))
-                        self.cb_states.append(0)
-                self.endInsertColumns()
-                self.col_added.emit()
-
-            self.beginInsertRows(QModelIndex(), l, l)
-            offset = 0
-            for b in packet.data: # add the new packet data
-                single_bytes[offset].append(b)
-                offset += 1
-            # fill remaining bytes with -1
-            while offset < len(single_bytes):
-                single_bytes[offset].append(-1)
-                offset += 1
+        self.new_packets([packet])
+
+    def select_endpoint(self, endpoint):
+        """Show (and plot) the packets of endpoint, a (devnum, epnum) tuple,
+        or of all endpoints if None."""
+        global single_bytes
+        self.beginResetModel()
+        self.endpoint = endpoint
+        single_bytes = stores[endpoint]
+        self.endResetModel()
+        self.endpoint_selected.emit()
+
+    def new_packets(self, packets):
+        """Add the payloads of a batch of packets; packets without data are
+        skipped."""
+        rows = [((packet.devnum, packet.epnum), packet.data,
+                 packet.ts_sec + packet.ts_usec / 1e6) for packet in packets]
+        rows = [row for row in rows if len(row[1]) > 0]
+        if not rows:
+            return
+        shown = len(rows) if self.endpoint is None else \
+                sum(1 for row in rows if row[0] == self.endpoint)
+        l = len(single_bytes) # number of packets so far
+        w = single_bytes.width # (max) number of bytes so far
+        widest = max(len(data) for key, data, ts in rows)
+        # checkboxes are kept for every offset of every endpoint
+        if widest > len(self.cb_states):
+            self.cb_states.extend([0] * (widest - len(self.cb_states)))
+        if self.endpoint is not None:
+            widest = max([len(data) for key, data, ts in rows
+                          if key == self.endpoint] or [0])
+
+        # if the incoming packets have more bytes than we've seen
+        # before, add columns for each new byte
+        if widest > w:
+            self.beginInsertColumns(QModelIndex(), w, widest - 1)
+            single_bytes.widen(widest)
+            self.endInsertColumns()
+            self.col_added.emit()
+
+        if shown:
+            self.beginInsertRows(QModelIndex(), l, l + shown - 1)
+        added = []
+        for key, data, ts in rows:
+            stores[None].append(data, ts)
+            if key not in stores:
+                stores[key] = ByteStore()
+                added.append(key)
+            stores[key].append(data, ts)
+        if shown:
             self.endInsertRows()
-            self.row_added.emit()
-
-            # update the custom byte values for the new packet
-            for cb in custom_bytes:
-                # swap [\d+] for single_bytes[\d+][-1] so that we can
-                # evaluate the string
-                cb_run = re.sub(r'\[(\d+)\]', r'single_bytes[\1][-1]', cb)
-                
-                # figure out which bytes make up this custom byte
-                composite_bytes = re.findall(r'single_bytes\[(\d+)\]', cb_run)
-
-                # if all bytes that make up this composite byte are
-                # defined for this new packet, append the appropriate value
-                if not -1 in [single_bytes[int(c)][-1] for c in composite_bytes if c < len(single_bytes)]:
-                    try:
-                        custom_bytes[cb].append(eval(cb_run))
-                    except Exception:
-                        pass
-                else: # otherwise append -1
-                    custom_bytes[cb].append(-1)
-                    
+        for key in added:
+            self.endpoint_added.emit(key)
+
+        # update the custom byte values for the new packets
+        for cb in custom_bytes.itervalues():
+            cb.update()
+        self.row_added.emit(shown)
+
+    def load_capture(self, capture, chunk_size=65536):
+        """Add the packets of a ColumnarCapture (e.g. a capture saved with
+        usbcolumns.py) in bulk: their payloads are copied into the stores a
+        matrix of chunk_size packets at a time, rather than one by one.
+        Packets without data are skipped."""
+        shown = len(single_bytes)
+        added = []
+        self.beginResetModel()
+        for first, chunk in capture.chunks(chunk_size):
+            rows = np.flatnonzero(chunk.datalen > 0)
+            if not len(rows):
+                continue
+            data, valid = chunk.payload_matrix(rows)
+            ts = chunk.ts[rows]
+            stores[None].append_matrix(data, valid, ts)
+            keys = ((chunk.devnum[rows].astype(np.int64) << 8) |
+                    chunk.epnum[rows])
+            for key in np.unique(keys):
+                endpoint = (int(key >> 8), int(key & 0xff))
+                if endpoint not in stores:
+                    stores[endpoint] = ByteStore()
+                    added.append(endpoint)
+                sel = keys == key
+                stores[endpoint].append_matrix(data[sel], valid[sel], ts[sel])
+        widest = stores[None].width
+        if widest > len(self.cb_states):
+            self.cb_states.extend([0] * (widest - len(self.cb_states)))
+        self.endResetModel()
+        self.col_added.emit()
+        for endpoint in added:
+            self.endpoint_added.emit(endpoint)
+
+        for cb in custom_bytes.itervalues():
+            cb.update()
+        self.row_added.emit(len(single_bytes) - shown)
+
+
+class CustomByte(object):
+    """A custom byte expression (a columnar.ByteExpression), in which [N]
+    stands for the byte at payload offset N, and its value for every packet
+    so far (NaN for the packets lacking one of the bytes, or for which it
+    can't be evaluated), evaluated over whole columns of the byte store at a
+    time.
+    """
+
+    def __init__(self, exp):
+        self.exp = exp
+        self.expression = ByteExpression(exp)
+        self.values = ValueColumn()
+        self.pyramid = MinMaxPyramid(self.values.values)
+
+    def evaluate(self, start, stop):
+        """Values for the packets start to stop, as a float64 array."""
+        n = stop - start
+
+        def column(offset):
+            if offset >= single_bytes.width:
+                return np.zeros(n, np.int64), np.zeros(n, bool)
+            values = single_bytes.column(offset, start, stop)
+            return values, values != MISSING
+
+        return self.expression.evaluate(column, n)
+
+    def update(self):
+        """Compute the values of the packets added since the last update.
+        Returns the exception raised by the expression, if any."""
+        start, stop = len(self.values), len(single_bytes)
+        if start == stop:
+            return None
+        try:
+            values = self.evaluate(start, stop)
+        except Exception, e:
+            self.values.extend(np.full(stop - start, np.nan))
+            return e
+        self.values.extend(values)
+        return None
 
 
 class ByteView(QTableView):
@@ -183,10 +279,6 @@ class ByteView(QTableView):
         self.autoscroll_toggle.setCheckable(True)
         self.autoscroll_toggle.setChecked(False)
 
-        self.autoscroll_timer = QTimer(self)
-        self.autoscroll_timer.setSingleShot(True)
-        self.autoscroll_timer.timeout.connect(self.scrollToBottom)
-
     def contextMenuEvent(self, event):
         menu = QMenu()
         menu.addAction(self.autoscroll_toggle)
@@ -196,8 +288,68 @@ class ByteView(QTableView):
         self.resizeColumnsToContents()
 
     def row_added(self):
-        if self.autoscroll_toggle.isChecked() and not self.autoscroll_timer.isActive():
-            self.autoscroll_timer.start(50)
+        """Called by the render scheduler after packets were added."""
+        if self.autoscroll_toggle.isChecked():
+            self.scrollToBottom()
+
+
+class RenderScheduler(QObject):
+    """Coalesce requests to redraw into frames rendered at most fps times
+    per second.
+
+    mark_dirty() records that there is something new to show (and how many
+    packets came in); render is called once for everything marked since the
+    previous frame, no sooner than 1/fps seconds after it. The scheduler
+    keeps statistics of the ingest rate, the time taken by render and the
+    number of dropped frames, i.e. frame slots missed because rendering took
+    longer than a frame.
+    """
+
+    def __init__(self, render, fps=DEFAULT_FPS, parent=None):
+        QObject.__init__(self, parent)
+        self.render = render
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.render_frame)
+        self.set_fps(fps)
+        self.last_frame = 0.0
+
+        self.frames = 0
+        self.dropped = 0
+        self.render_time = 0.0 # duration of the last frame, in seconds
+        self.ingest_rate = 0.0 # packets per second
+        self.packets = 0
+        self.rate_packets = 0
+        self.rate_time = time.time()
+
+    def set_fps(self, fps):
+        self.interval = 1.0 / max(fps, 1)
+
+    def mark_dirty(self, packets=0):
+        self.packets += packets
+        if not self.timer.isActive():
+            wait = self.last_frame + self.interval - time.time()
+            self.timer.start(max(0, int(wait * 1000)))
+
+    def render_frame(self):
+        start = time.time()
+        if start - self.rate_time >= 1.0:
+            self.ingest_rate = ((self.packets - self.rate_packets) /
+                                (start - self.rate_time))
+            self.rate_packets = self.packets
+            self.rate_time = start
+        self.render()
+        end = time.time()
+        self.render_time = end - start
+        self.frames += 1
+        self.dropped += int(self.render_time / self.interval)
+        self.last_frame = end
+
+    def stats(self):
+        """One-line summary of the statistics."""
+        return ('%.0f packets/s, render %.1f ms, %d frames, %d dropped' %
+                (self.ingest_rate, self.render_time * 1000, self.frames,
+                 self.dropped))
 
 # Acceptable colors to plot with
 colors = [(0,255,255),
@@ -245,6 +397,17 @@ class BytePlot(Qwt.QwtPlot):
         self.setTitle('Byte Values')
 
         self.x_range = 200 # the "width" of the graph in packets
+        # with the time axis, the "width" of the graph in seconds
+        self.time_axis = False
+        self.time_range = 10.0
+        # min/max pyramids of the plotted payload offsets
+        self.pyramids = {}
+
+        # render statistics, drawn over the canvas when shown
+        self.overlay = QLabel(self.canvas())
+        self.overlay.setStyleSheet('background: rgba(255, 255, 255, 192);')
+        self.overlay.move(4, 4)
+        self.overlay.hide()
 
         random.seed()
 
@@ -268,32 +431,57 @@ class BytePlot(Qwt.QwtPlot):
         self.setAxisTitle(0, "Byte value")
         self.setAxisTitle(2, "Packet sequence number")
 
-    def row_added(self):
-        l = len(single_bytes[0]) # number of packets so far
-        # mask matches each valid byte (e.g. value > -1) to True, and
-        # the invalid (missing) bytes to False
+    def set_time_axis(self, enabled, seconds):
+        """Plot against the packet timestamps, showing the last seconds of
+        the capture, or against the packet sequence numbers."""
+        self.time_axis = enabled
+        self.time_range = seconds
+        if enabled:
+            self.setAxisTitle(2, "Time (s)")
+        else:
+            self.setAxisTitle(2, "Packet sequence number")
+            self.setAxisAutoScale(2)
+        self.update_curves()
+
+    def endpoint_selected(self):
+        """Start over with the values of the newly selected endpoint."""
+        self.pyramids = dict((column, self.column_pyramid(column))
+                             for column in self.pyramids)
+        for d in custom_bytes:
+            custom_bytes[d] = CustomByte(d)
+            custom_bytes[d].update()
+        self.setAxisAutoScale(2)
+        self.update_curves()
+
+    def column_pyramid(self, column):
+        return MinMaxPyramid(lambda start, stop:
+                             single_bytes.float_column(column, start, stop))
+
+    def show_stats(self, text):
+        self.overlay.setText(text)
+        self.overlay.adjustSize()
+        self.overlay.show()
+
+    def update_curves(self):
+        """Give every curve the values in the plot window, and redraw."""
         for c in self.curves:
-            mask = [j >= 0 for j in single_bytes[c]]
-            self.set_curve_data(l, self.curves[c], range(l), single_bytes[c], mask)
+            self.set_curve_data(self.curves[c], c)
         for c in self.custom_curves:
-            mask = [j >= 0 for j in custom_bytes[c]]
-            self.set_curve_data(l, self.custom_curves[c], range(l), custom_bytes[c], mask)
+            self.set_curve_data(self.custom_curves[c], custom_bytes[c])
 
         self.replot()
 
     def cb_checked(self, column):
         # set up the curve if this is the first time that checkbox was ticked
         if column not in self.curves:
-            l = len(single_bytes[0])
-            mask = [j >= 0 for j in single_bytes[column]]
             self.curves[column]= ByteCurve("Byte " + str(column))
-            self.set_curve_data(l, self.curves[column], range(l), single_bytes[column], mask)
+            self.pyramids[column] = self.column_pyramid(column)
 
         # grab a random color and assign it to the curve
         r, g, b = colors.pop(random.randint(0, len(colors)-1))
         color = QColor(r, g, b)
         self.curves[column].setPen(QPen(QBrush(color), 2))
-        self.curves[column].setStyle(Qwt.QwtPlotCurve.Dots)
+        self.set_curve_data(self.curves[column], column)
 
         self.curves[column].attach(self)
 
@@ -331,62 +519,87 @@ class BytePlot(Qwt.QwtPlot):
         # take care of the active custom byte definitions
         for d in byte_def_strings:
             if not len(d) == 0:
-                # swap [\d+] for single_bytes[\d+][pos] so we can
-                # evalute within the for loop below
-                d_run = re.sub(r'\[(\d+)\]', r'single_bytes[\1][pos]', d)
-                    
-                # find out what byte values are being used
-                composite_bytes = re.findall(r'single_bytes\[(\d+)\]', d_run)
-
                 # if this is a new definition
                 if d not in self.custom_curves:
+                    try:
+                        cb = CustomByte(d)
+                    except SyntaxError, e:
+                        msg = QMessageBox()
+                        msg.setText('There was an error understanding a custom byte value:\n' + str(e))
+                        msg.exec_()
+                        continue
                     # set up the curve
                     self.custom_curves[d] = ByteCurve(d)
-                    custom_bytes[d] = list()
+                    custom_bytes[d] = cb
                     self.custom_curves[d].attach(self)
-                    # back-fill the list of values
-                    for pos in range(len(single_bytes[0])):
-                        if not -1 in [single_bytes[int(c)][pos] for c in composite_bytes if c < len(single_bytes)]:
-                            try:
-                                custom_bytes[d].append(eval(d_run))
-                            except Exception, e:
-                                msg = QMessageBox()
-                                msg.setText('There was an error understanding a custom byte value:\n' + e.message)
-                                msg.exec_()
-                                break
-                        else:
-                            custom_bytes[d].append(-1)
-                else: # otherwise just append the latest value
-                    for pos in range(len(custom_bytes[d]), len(single_bytes[0])):
-                        if not -1 in [single_bytes[int(c)][pos] for c in composite_bytes]:
-                            custom_bytes[d].append(eval(d_run))
-                        else:
-                            custom_bytes[d].append(-1)
-
-                mask = [j >= 0 for j in custom_bytes[d]]
-                self.set_curve_data(len(single_bytes[0]), self.custom_curves[d], range(len(single_bytes[0])), custom_bytes[d], mask)
-                
+                # back-fill the values, or just compute the latest ones
+                e = custom_bytes[d].update()
+                if e is not None:
+                    msg = QMessageBox()
+                    msg.setText('There was an error understanding a custom byte value:\n' + str(e))
+                    msg.exec_()
+
+                self.set_curve_data(self.custom_curves[d], custom_bytes[d])
+
                 r, g, b = colors.pop(random.randint(0, len(colors)-1))
                 color = QColor(r, g, b)
                 self.custom_curves[d].setPen(QPen(QBrush(color), 2))
-                self.custom_curves[d].setStyle(Qwt.QwtPlotCurve.Dots)
 
         self.replot()
 
-    def set_curve_data(self, length, curve, x, y, mask):
+    def plot_window(self):
+        """First and last+1 rows of the selected store in the plot."""
+        length = len(single_bytes)
+        if self.time_axis and length:
+            end = single_bytes.timestamps()[-1]
+            return single_bytes.row_at(end - self.time_range), length
         # if there are more packets to plot than the current width of
         # the graph, just plot the latest packets
-        if length > self.x_range:
-            curve.setData(ByteData(x[length-self.x_range:length], y[length-self.x_range:length], mask[length-self.x_range:length]))
-            self.setAxisScale(2, length-self.x_range, length)
-        # otherwise plot them all
+        return max(0, length - self.x_range), length
+
+    def set_curve_data(self, curve, column):
+        """Give curve the values of column (a payload offset or a
+        CustomByte) for the packets in the plot window.
+
+        When the window holds more packets than can be told apart on the
+        canvas, the curve is drawn as the min/max envelope of one bucket of
+        packets per pixel column, taken from the column's pyramid; otherwise
+        every value is drawn as a dot. Missing values are masked out.
+        """
+        start, length = self.plot_window()
+        if isinstance(column, CustomByte):
+            pyramid = column.pyramid
+        elif column < single_bytes.width:
+            pyramid = self.pyramids[column]
         else:
-            curve.setData(ByteData(x[:self.x_range], y[:self.x_range], mask[:self.x_range]))
-                        
+            # this endpoint's payloads are too short
+            curve.setData(ByteData([], [], []))
+            return
+        pyramid.update(length)
+        x, lo, hi = pyramid.envelope(start, length,
+                                     max(self.canvas().width(), 1))
+        if lo is hi:
+            curve.setStyle(Qwt.QwtPlotCurve.Dots)
+            y = lo
+        else:
+            # a vertical stroke per bucket, from its minimum to its maximum
+            curve.setStyle(Qwt.QwtPlotCurve.Lines)
+            x = np.repeat(x, 2)
+            y = np.column_stack((lo, hi)).ravel()
+        if self.time_axis and length:
+            # seconds since the first packet of the capture
+            first_ts = stores[None].timestamps()[0]
+            x = single_bytes.timestamps()[x] - first_ts
+            end = single_bytes.timestamps()[-1] - first_ts
+            self.setAxisScale(2, end - self.time_range, end)
+        elif length > self.x_range:
+            self.setAxisScale(2, start, length)
+        curve.setData(ByteData(x, y, ~np.isnan(y)))
+
     def change_x_range(self, range):
         self.x_range = range
 
-        self.row_added()
+        self.update_curves()
 
     def clamp_axis(self, min, max):
         if min >= 0 and max >= 0:
@@ -411,10 +624,10 @@ class ByteData(Qwt.QwtArrayData):
     """Subclassed QwtArrayData with mask"""
 
     def __init__(self, x, y, mask):
-        Qwt.QwtArrayData.__init__(self, x, y)
         self.__mask = np.asarray(mask, bool)
-        self.__x = np.asarray(x)
-        self.__y = np.asarray(y)
+        self.__x = np.asarray(x, np.float64)
+        self.__y = np.asarray(y, np.float64)
+        Qwt.QwtArrayData.__init__(self, self.__x, self.__y)
 
     def copy(self):
         return self
@@ -422,30 +635,80 @@ class ByteData(Qwt.QwtArrayData):
     def mask(self):
         return self.__mask
 
+    def arrays(self):
+        """The x and y values and the mask, as NumPy arrays."""
+        return self.__x, self.__y, self.__mask
+
+    def boundingRect(self):
+        # leave the missing values (MISSING or NaN) out of autoscaling
+        x = self.__x[self.__mask]
+        y = self.__y[self.__mask]
+        if not len(x):
+            return QRectF(1.0, 1.0, -2.0, -2.0)
+        return QRectF(x.min(), y.min(), x.max() - x.min(), y.max() - y.min())
+
+
+def run_starts(mask):
+    """Boolean array which is True at the first element of every run of
+    True values of mask."""
+    mask = np.asarray(mask, bool)
+    starts = mask.copy()
+    starts[1:] = mask[1:] & ~mask[:-1]
+    return starts
+
 
 class ByteCurve(Qwt.QwtPlotCurve):
-    """Subclassed QwtPlotCurve so that data is masked"""
+    """Subclassed QwtPlotCurve so that data is masked.
+
+    The points whose mask value is True are turned into a single shape in
+    plot coordinates, once per setData(): a QPainterPath for the Lines
+    style, with a gap wherever the mask is False, or a QPolygonF of points
+    otherwise. Drawing maps that shape onto the canvas with one transform
+    and one paint call, however fragmented the mask is.
+    """
 
     def __init__(self, title=None):
         Qwt.QwtPlotCurve.__init__(self, title)
+        self.byte_data = None
+        self.shape = None
+
+    def setData(self, data):
+        Qwt.QwtPlotCurve.setData(self, data)
+        self.byte_data = data
+        self.shape = None
+
+    def build_shape(self):
+        x, y, mask = self.byte_data.arrays()
+        points = zip(x[mask].tolist(), y[mask].tolist())
+        if self.style() == Qwt.QwtPlotCurve.Lines:
+            path = QPainterPath()
+            for (px, py), start in zip(points, run_starts(mask)[mask]):
+                if start:
+                    path.moveTo(px, py)
+                else:
+                    path.lineTo(px, py)
+            return path
+        return QPolygonF([QPointF(px, py) for px, py in points])
 
-    # only draw the bytes whose mask value is True
     def draw(self, painter, xMap, yMap, rect):
-        try:
-            indices = np.arange(self.data().size())[self.data().mask()]
-            if len(indices > 0):
-                fs = np.array(indices)
-                fs[1:] -= indices[:-1]
-                fs[0] = 2
-                fs = indices[fs > 1]
-                ls = np.array(indices)
-                ls[:-1] -= indices[1:]
-                ls[-1] = -2
-                ls = indices[ls < -1]
-                for first, last in zip(fs, ls):
-                    Qwt.QwtPlotCurve.drawFromTo(self, painter, xMap, yMap, first, last)
-        except AttributeError:
-            pass
+        if self.byte_data is None:
+            return
+        if self.shape is None:
+            self.shape = self.build_shape()
+        # the (linear) scale maps as a single transform
+        if xMap.s1() == xMap.s2() or yMap.s1() == yMap.s2():
+            return
+        sx = (xMap.p2() - xMap.p1()) / (xMap.s2() - xMap.s1())
+        sy = (yMap.p2() - yMap.p1()) / (yMap.s2() - yMap.s1())
+        transform = QTransform(sx, 0, 0, sy, xMap.p1() - xMap.s1() * sx,
+                               yMap.p1() - yMap.s1() * sy)
+        painter.save()
+        painter.setPen(self.pen())
+        if isinstance(self.shape, QPainterPath):
+            painter.drawPath(transform.map(self.shape))
+        else:
+            painter.drawPoints(transform.map(self.shape))
+        painter.restore()
 
 
 class ByteValWidget(QWidget):
@@ -470,7 +733,8 @@ Use the following notation to refer to existing byte offsets:
     * offset 1: [1]
     ...
 
-Any valid Python expression can be used to modify byte offset values.""")
+Python operators, comparisons, and/or/not, abs() and bool() can be used to
+combine byte offset values.""")
 
         self.y_axis_edit.returnPressed.connect(self.update_byte_vals)
 
@@ -478,6 +742,49 @@ Any valid Python expression can be used to modify byte offset values.""")
         self.byte_vals_changed.emit(str(self.y_axis_edit.text()))
 
 
+class FieldFinderWidget(QGroupBox):
+    """Rank byte offsets by entropy and change rate to help locate the
+    interesting fields of a payload."""
+
+    offset_selected = pyqtSignal(int)
+
+    def __init__(self, title, parent=None):
+        QGroupBox.__init__(self, title, parent)
+
+        self.analyze_button = QPushButton('Analyze')
+        self.analyze_button.clicked.connect(self.analyze)
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(['Offset', 'Entropy',
+                                              'Changed', 'Toggling bits'])
+        self.table.verticalHeader().hide()
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.cellDoubleClicked.connect(self.cell_double_clicked)
+        self.setToolTip('Double-click an offset to plot it.')
+
+        self.vb = QVBoxLayout()
+        self.vb.addWidget(self.analyze_button)
+        self.vb.addWidget(self.table)
+        self.setLayout(self.vb)
+
+    def analyze(self):
+        if len(single_bytes) == 0:
+            return
+        data = single_bytes.values()
+        stats = analysis.offset_stats(data, data != MISSING)
+
+        self.table.setRowCount(len(stats))
+        for row, s in enumerate(stats):
+            cells = [str(s.offset), '%.3f' % s.entropy, '%.3f' % s.change_rate,
+                     format(s.toggling_bits, '08b')]
+            for col, text in enumerate(cells):
+                self.table.setItem(row, col, QTableWidgetItem(text))
+        self.table.resizeColumnsToContents()
+
+    def cell_double_clicked(self, row, col):
+        self.offset_selected.emit(int(self.table.item(row, 0).text()))
+
+
 class ClampYAxisWidget(QGroupBox):
     """Let the user specify max and min values for the y-axis."""
 
@@ -515,29 +822,95 @@ class ClampYAxisWidget(QGroupBox):
 
 
 class PlotWindowSliderWidget(QGroupBox):
-    """Let the user change the width of the plot window."""
+    """Let the user change the width of the plot window. The slider has a
+    logarithmic scale, from 10 to 10 million packets."""
     value_changed = pyqtSignal(int)
 
+    # slider steps per factor of 10
+    STEPS = 100
+
     def __init__(self, title, parent=None):
         QGroupBox.__init__(self, title, parent)
 
         self.plot_range = QSlider()
         self.plot_range.setOrientation(Qt.Qt.Horizontal)
-        self.plot_range.setRange(10, 1000)
-        self.plot_range.setValue(200)
-        self.plot_range.setTickInterval(50)
+        self.plot_range.setRange(self.STEPS, 7 * self.STEPS)
+        self.plot_range.setValue(self.position(200))
+        self.plot_range.setTickInterval(self.STEPS)
         self.plot_range.setTickPosition(Qt.QSlider.TicksBelow)
-        self.plot_range.valueChanged.connect(lambda val: self.value_changed.emit(val))
+        self.plot_range.valueChanged.connect(self.slider_moved)
         self.plot_range_labels = QHBoxLayout()
         self.plot_range_labels.addWidget(QLabel('10'))
         self.plot_range_labels.addWidget(self.plot_range)
-        self.plot_range_labels.addWidget(QLabel('1000'))
+        self.plot_range_labels.addWidget(QLabel('10M'))
         self.setLayout(self.plot_range_labels)
         self.setMaximumHeight(100)
 
+    def position(self, packets):
+        return int(round(np.log10(packets) * self.STEPS))
+
+    def packets(self, position):
+        return int(round(10 ** (position / float(self.STEPS))))
+
+    def slider_moved(self, position):
+        packets = self.packets(position)
+        self.plot_range.setToolTip('%d packets' % packets)
+        self.value_changed.emit(packets)
+
+
+class TimeAxisWidget(QGroupBox):
+    """Let the user plot against time instead of packet sequence numbers,
+    and set the width of the plot window in seconds."""
+    changed = pyqtSignal(bool, float)
+
+    def __init__(self, title, parent=None):
+        QGroupBox.__init__(self, title, parent)
+        self.setCheckable(True)
+        self.setChecked(False)
+
+        self.seconds = QDoubleSpinBox()
+        self.seconds.setRange(0.001, 1e6)
+        self.seconds.setDecimals(3)
+        self.seconds.setValue(10.0)
+        self.seconds.setSuffix(' s')
+
+        self.hb = QHBoxLayout()
+        self.hb.addWidget(QLabel('Width:'))
+        self.hb.addWidget(self.seconds)
+        self.setLayout(self.hb)
+        self.setMaximumHeight(100)
+
+        self.toggled.connect(self.emit_changed)
+        self.seconds.valueChanged.connect(self.emit_changed)
+
+    def emit_changed(self, *args):
+        self.changed.emit(self.isChecked(), self.seconds.value())
+
+
+class EndpointWidget(QGroupBox):
+    """Let the user pick the endpoint whose packets are shown."""
+    endpoint_selected = pyqtSignal(object)
+
+    def __init__(self, title, parent=None):
+        QGroupBox.__init__(self, title, parent)
+        self.endpoints = [None]
+        self.combo = QComboBox()
+        self.combo.addItem('All endpoints')
+        self.combo.currentIndexChanged.connect(
+                lambda i: self.endpoint_selected.emit(self.endpoints[i]))
+
+        self.hb = QHBoxLayout()
+        self.hb.addWidget(self.combo)
+        self.setLayout(self.hb)
+        self.setMaximumHeight(100)
+
+    def endpoint_added(self, endpoint):
+        self.endpoints.append(endpoint)
+        self.combo.addItem('Device %d, endpoint %02x' % endpoint)
+
 
 class USBGraph(QApplication):
-    def __init__(self, argv):
+    def __init__(self, argv, options, args=()):
         QApplication.__init__(self, argv)
         self.w = QWidget()
         self.w.resize(800, 600)
@@ -558,11 +931,24 @@ class USBGraph(QApplication):
         self.x_range = PlotWindowSliderWidget('Plot Width (# of packets)')
         self.x_range.value_changed.connect(self.byteplot.change_x_range)
 
+        self.time_axis = TimeAxisWidget('Time Axis')
+        self.time_axis.changed.connect(self.byteplot.set_time_axis)
+
+        self.endpoint = EndpointWidget('Endpoint')
+        self.endpoint.endpoint_selected.connect(self.bytemodel.select_endpoint)
+        self.bytemodel.endpoint_added.connect(self.endpoint.endpoint_added)
+        self.bytemodel.endpoint_selected.connect(self.byteplot.endpoint_selected)
+
         self.y_clamp = ClampYAxisWidget('Clamp Y Axis')
         self.y_clamp.y_axis_vals_changed.connect(self.byteplot.clamp_axis)
 
-        self.bytemodel.row_added.connect(self.byteplot.row_added)
-        self.bytemodel.row_added.connect(self.byteview.row_added)
+        self.fieldfinder = FieldFinderWidget('Field Candidates')
+        self.fieldfinder.offset_selected.connect(self.bytemodel.check_column)
+
+        # new packets are shown by the scheduler's frames
+        self.show_stats = options.stats
+        self.scheduler = RenderScheduler(self.render, options.fps, self)
+        self.bytemodel.row_added.connect(self.scheduler.mark_dirty)
         self.bytemodel.col_added.connect(self.byteview.col_added)
         self.bytemodel.cb_checked.connect(self.byteplot.cb_checked)
         self.bytemodel.cb_unchecked.connect(self.byteplot.cb_unchecked)
@@ -572,14 +958,20 @@ class USBGraph(QApplication):
         self.main_area = QSplitter()
         self.main_area.addWidget(self.byteview)
         self.main_area.addWidget(self.byteplot)
-        self.main_area.setSizes([400,400])
+        self.main_area.addWidget(self.fieldfinder)
+        self.main_area.setSizes([400,400,200])
 
         self.lower_right_area = QVBoxLayout()
         self.lower_right_area.addWidget(self.x_range)
+        self.lower_right_area.addWidget(self.time_axis)
         self.lower_right_area.addWidget(self.y_clamp)
 
+        self.lower_left_area = QVBoxLayout()
+        self.lower_left_area.addWidget(self.endpoint)
+        self.lower_left_area.addWidget(self.bytevalgroup)
+
         self.lower_area = QHBoxLayout()
-        self.lower_area.addWidget(self.bytevalgroup)
+        self.lower_area.addLayout(self.lower_left_area)
         self.lower_area.addLayout(self.lower_right_area)
 
         self.vb = QVBoxLayout()
@@ -589,15 +981,26 @@ class USBGraph(QApplication):
         self.w.setLayout(self.vb)
         self.w.show()
 
-        self.pcapthread = PcapThread()
-        self.pcapthread.dump_opened.connect(self.dump_opened)
-        self.pcapthread.new_packet.connect(self.new_packet)
-        self.pcapthread.start()
+        if args and is_saved_capture(args[0]):
+            # a saved capture is loaded at once from its memory-mapped arrays
+            self.pcapthread = None
+            self.bytemodel.load_capture(ColumnarCapture.load(args[0]))
+        else:
+            self.pcapthread = PcapThread(source=args[0] if args else '-')
+            self.pcapthread.dump_opened.connect(self.dump_opened)
+            self.pcapthread.packets_ready.connect(self.packets_ready)
+            self.pcapthread.start()
 
         self.dumper = None
 
-    def new_packet(self, packet):
-        self.bytemodel.new_packet(packet)
+    def render(self):
+        self.byteplot.update_curves()
+        self.byteview.row_added()
+        if self.show_stats:
+            self.byteplot.show_stats(self.scheduler.stats())
+
+    def packets_ready(self):
+        self.bytemodel.new_packets(self.pcapthread.take_packets())
 
     def bytes_added(self):
         self.byteplot.bytes_added()
@@ -606,11 +1009,32 @@ class USBGraph(QApplication):
         pass
 
 
-single_bytes = list()
+# payload bytes and timestamps of the packets of each (devnum, epnum)
+# endpoint, and of all packets under None
+stores = {None: ByteStore()}
+# the store of the selected endpoint
+single_bytes = stores[None]
+# CustomByte of each custom byte expression
 custom_bytes = {}
 
 
 if __name__ == "__main__":
-    app = USBGraph(sys.argv)
+    parser = OptionParser()
+    parser.add_option("--fps", type="int", default=DEFAULT_FPS,
+            help="Redraw the plot at most FPS times per second (default %d)."
+                 % DEFAULT_FPS)
+    parser.add_option("--stats", default=False, action="store_true",
+            help="Show the ingest rate, render time and dropped frames "
+                 "over the plot.")
+    parser.add_option("--headless", default=False, action="store_true",
+            help="Don't open a window; export the plot of the capture "
+                 "given as argument (or read from stdin) as set by the "
+                 "options below.")
+    graphexport.add_options(parser)
+    (options, args) = parser.parse_args()
+    if options.headless:
+        graphexport.run(parser, options, args)
+        sys.exit(0)
+    app = USBGraph(sys.argv, options, args)
     sys.exit(app.exec_())
 
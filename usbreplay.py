@@ -26,6 +26,7 @@ import usb.core
 import usb.util
 import pcapy
 from usbrevue import Packet
+from urbtracker import UrbTracker
 import optparse
 import traceback
 import time
@@ -40,6 +41,7 @@ LOGICAL_CFG = 0
 LOGICAL_IFACE = 0     
 LOGICAL_ALT_SETTING = 0
 DEBUG = False
+URB_TIMEOUT = 60      # seconds before an uncompleted URB is forgotten
 
 
 
@@ -115,7 +117,7 @@ class Replayer(object):
         self.debug = debug
         if self.debug: sys.stderr.write('In Replayer.__init__\n')
         self.init_handlers()
-        self.urbs = []
+        self.urbs = UrbTracker(timeout=URB_TIMEOUT)
         self.vid = vid
         self.pid = pid
 
@@ -343,7 +345,7 @@ class Replayer(object):
         #if packet.urb not in self.urbs:
         if self.debug:
             sys.stderr.write( 'Appending 0x%x to urb list\n' % packet.urb)
-        self.urbs.append(packet.urb)
+        self.urbs.track(packet)
         if self.debug:
             sys.stderr.write( 'Current urbs = %s\n' % self.urbs)
 
@@ -389,7 +391,7 @@ class Replayer(object):
         #if packet.urb not in self.urbs:
         if self.debug:
             sys.stderr.write( 'Appending 0x%x to urb list\n' % packet.urb)
-        self.urbs.append(packet.urb)
+        self.urbs.track(packet)
         if self.debug:
             sys.stderr.write( 'Current urbs =  %s\n' % self.urbs)
 
@@ -456,10 +458,10 @@ class Replayer(object):
         """
         if self.debug:
             sys.stderr.write( 'In Replayer.get_callback: this is a callback packet for urb id = 0x%x\n' % packet.urb)
-        if packet.urb in self.urbs:
+        match = self.urbs.track(packet)
+        if match is not None:
             if self.debug:
-                sys.stderr.write( 'Removing 0x%x from urb list\n' % packet.urb)
-            self.urbs.remove(packet.urb)
+                sys.stderr.write( 'Removed 0x%x from urb list, captured latency %.3f ms\n' % (packet.urb, match[0] * 1e3))
         else:
             sys.stderr.write( 'Packet urb id=0x%x has a callback but not a submission\n' % packet.urb)
         if self.debug:
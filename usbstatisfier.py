@@ -25,74 +25,375 @@ from __future__ import division
 import sys
 import pcapy
 import gflags
-import re
 import struct
+from collections import Counter
+import numpy as np
 from usbrevue import Packet
+from pcapfile import PcapWriter
+from columnar import ColumnarCapture, ColumnExpression, CaptureSpool, \
+        is_saved_capture
+from search import PatternMatcher
+import analysis
 from PyQt4 import QtGui,QtCore
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 
 FLAGS = gflags.FLAGS
 
-gflags.DEFINE_list('exp',None, 'A comma-separated list of expressions to be applied at data payload byte offsets. Offsets are referenced as "data[0], data[1], ...". Arithmetic operators (+, -, *, /), logical operators (and, or, not), and bitwise operators (^, &, |, !) are supported. For logical xor, use "bool(a) ^ bool(b)".')
-gflags.DEFINE_boolean('verbose', False, 'Verbose mode; display the details of each packet modified.')
+gflags.DEFINE_list('exp',None, 'A comma-separated list of expressions to be applied at data payload byte offsets. Offsets are referenced as "data[0], data[1], ..." (negative offsets count from the end of the payload; slices such as "data[0:2] == [1, 2]" work as well). Arithmetic operators (+, -, *, /), logical operators (and, or, not), and bitwise operators (^, &, |, ~) are supported. For logical xor, use "bool(a) ^ bool(b)". Comparisons and bit masks ("data[0] & 0x80") are counted (with ratio and first/last timestamps of the matches); other expressions report their minimum and maximum.')
+gflags.DEFINE_list('pattern', None, 'A comma-separated list of byte patterns to look for in the data payloads, as hex bytes with "??" for any byte (e.g. "a1 01 ?? 00"). All patterns are searched for in a single pass; every occurrence is counted, per endpoint and per payload offset.')
+gflags.DEFINE_boolean('verbose', False, 'Verbose mode; display the details of each packet modified, and with --pattern every packet matching a pattern.')
+gflags.DEFINE_boolean('fields', False, 'Rank the data payload offsets of each endpoint by how much they change (entropy, change rate and toggling bits) to locate candidate fields.')
+gflags.DEFINE_integer('top', 16, 'Number of candidate offsets to report per endpoint with --fields; 0 reports all.')
+gflags.DEFINE_boolean('correlate', False, 'Report correlated payload offsets (Pearson correlation and mutual information), correlation of each offset with time and likely little/big-endian 16-bit pairs for one endpoint.')
+gflags.DEFINE_string('endpoint', None, 'Endpoint to analyze with --correlate, as "devnum:epnum" with epnum in hex (e.g. "3:81"). Defaults to the endpoint carrying the most data packets.')
+gflags.DEFINE_float('threshold', 0.9, 'Minimum absolute correlation reported by --correlate.')
+gflags.DEFINE_boolean('timing', False, 'Report per-endpoint timing: inter-arrival times, polling interval estimate, submission to callback latency and throughput.')
+gflags.DEFINE_float('bucket', 1.0, 'Width in seconds of the throughput time series buckets used by --timing.')
+gflags.DEFINE_enum('speed', None, ['low', 'full', 'high', 'super'], 'Bus speed of the device, used by --timing to convert the declared polling intervals to milliseconds (frames at low and full speed, 2^(interval-1) microframes at high and super speed). By default it is guessed per endpoint from the measured polling period.')
+gflags.DEFINE_string('throughput_csv', None, 'With --timing, write the per-endpoint throughput time series (time, endpoint, bytes/sec) to this CSV file.')
+
+
+def parse_endpoint(text):
+    """(devnum, epnum) of a "devnum:epnum" endpoint, epnum in hex, or None
+    if text is None. Raises ValueError if it is malformed."""
+    if text is None:
+        return None
+    devnum, sep, epnum = text.partition(':')
+    try:
+        if not sep:
+            raise ValueError
+        return int(devnum), int(epnum, 16)
+    except ValueError:
+        raise ValueError('bad endpoint %r: use "devnum:epnum" with epnum in '
+                         'hex, e.g. "3:81"' % text)
+
+
+class ExpressionStats(object):
+    """Running results of one --exp expression.
+
+    For predicates, count is the number of matching packets and first_ts and
+    last_ts the timestamps of the first and last match. For other
+    expressions, count is the number of packets the expression could be
+    evaluated for and min/max are the extremes of its value.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.count = 0
+        self.total = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.min = None
+        self.max = None
+
+    def update(self, capture):
+        """Evaluate the expression over a chunk of packets."""
+        values, valid = self.expression.evaluate(capture)
+        self.total += len(capture)
+        if self.expression.is_predicate:
+            hits = np.flatnonzero(values)
+        else:
+            hits = np.flatnonzero(valid)
+            if len(hits):
+                vals = values[hits]
+                lo, hi = vals.min(), vals.max()
+                self.min = lo if self.min is None else min(self.min, lo)
+                self.max = hi if self.max is None else max(self.max, hi)
+        if len(hits):
+            ts = capture.ts
+            self.count += len(hits)
+            if self.first_ts is None:
+                self.first_ts = ts[hits[0]]
+            self.last_ts = ts[hits[-1]]
+
+    @property
+    def ratio(self):
+        return self.count / self.total if self.total else 0.0
+
+
+class PatternStats(object):
+    """Running results of the --pattern byte patterns.
+
+    For every pattern, packets is the number of packets containing it at
+    least once, hits the number of occurrences, endpoints the number of
+    packets containing it per (busnum, devnum, epnum) and offsets a Counter
+    of the payload offsets it was found at.
+    """
+
+    def __init__(self, patterns):
+        self.matcher = PatternMatcher(patterns)
+        n = len(self.matcher.patterns)
+        self.packets = [0] * n
+        self.hits = [0] * n
+        self.endpoints = [Counter() for i in xrange(n)]
+        self.offsets = [Counter() for i in xrange(n)]
+
+    def update(self, capture):
+        """Scan a chunk of packets. Returns the list of (packet index in the
+        chunk, hits) of the matching packets; see PatternMatcher.scan()."""
+        matches = list(self.matcher.scan_payloads(capture.blob.tostring(),
+                                                  capture.offsets))
+        if not matches:
+            return matches
+        headers = capture.headers
+        for i, hits in matches:
+            addr = (int(headers['busnum'][i]), int(headers['devnum'][i]),
+                    int(headers['epnum'][i]))
+            for index in set(index for index, offset in hits):
+                self.packets[index] += 1
+                self.endpoints[index][addr] += 1
+            for index, offset in hits:
+                self.hits[index] += 1
+                self.offsets[index][offset] += 1
+        return matches
 
 
 class Statisfier(object):
-    def __init__(self, cmdline_exps):
+    # number of packets evaluated at once by the --exp expressions
+    chunk_size = 4096
+    # number of packets of a saved capture analyzed at once
+    capture_chunk_size = 65536
+
+    def __init__(self, cmdline_exps, fields=False, correlate=False,
+                 timing=False, patterns=None, verbose=False, endpoint=None):
         self.pcap = None
         self.out = None
         self.cmdline_exps = cmdline_exps
-        self.isEquals = False
+        self.fields = fields
+        self.correlate = correlate
+        # (devnum, epnum) analyzed by --correlate
+        self.endpoint = endpoint
+        # packets kept on disk for the columnar (--fields, --correlate)
+        # analysis, which reads them in several passes
+        self.spool = None
 
         # statisifer datas
-        self.numPackets = 0;
-        self.numTruePackets = 0;
-        self.datamin = list()
-        self.datamax = list()
-
-        for exp in self.cmdline_exps:
-          self.matches = re.finditer(r"data\[(\d+)\]", exp)
-        self.matches_list = [m for m in self.matches]
-
-    def run(self):
-        for packet in self.packet_generator('-'):
-            self.commit_packet(packet)
-
-        # print out changes to each packet if --verbose
-        #if FLAGS.verbose:
-        #which options did we use
-        if self.isEquals:
-            sys.stderr.write(str(self.numTruePackets))
-            sys.stderr.write('/')
-            sys.stderr.write(str(self.numPackets))
+        self.numPackets = 0
+        self.first_ts = None
+        self.chunk = list()
+        self.exp_stats = [ExpressionStats(ColumnExpression(exp))
+                          for exp in self.cmdline_exps or []]
+        self.timing = analysis.TimingStats(FLAGS.bucket) if timing else None
+        self.pattern_stats = PatternStats(patterns) if patterns else None
+        self.verbose = verbose
+
+    def run(self, input_stream='-'):
+        if is_saved_capture(input_stream):
+            self.run_capture(ColumnarCapture.load(input_stream))
+            return
+        if self.fields or self.correlate:
+            self.spool = CaptureSpool()
+        try:
+            for packet in self.packet_generator(input_stream):
+                self.commit_packet(packet)
+            self.flush_chunk()
+            if self.out is not None:
+                self.out.flush()
+            self.report(self.spool.capture() if self.spool else None)
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+
+    def run_capture(self, capture):
+        """Analyze a capture saved with usbcolumns.py: its packets are
+        already columns, so they are analyzed a chunk at a time straight
+        from the memory-mapped arrays."""
+        self.numPackets = len(capture)
+        if len(capture):
+            self.first_ts = float(capture.ts[0])
+        if not sys.stdout.isatty():
+            self.out = PcapWriter(sys.stdout, capture.linktype,
+                                  capture.snaplen)
+        analyze = (self.exp_stats or self.timing is not None or
+                   self.pattern_stats is not None)
+        if analyze or self.out is not None:
+            for first, chunk in capture.chunks(self.capture_chunk_size):
+                if analyze:
+                    self.analyze_chunk(chunk, first)
+                if self.out is not None:
+                    self.out.write_records(chunk.pcap_records())
+            if self.out is not None:
+                self.out.flush()
+        self.report(capture)
+
+    def report(self, capture):
+        """Print the results; capture holds every packet for --fields and
+        --correlate."""
+        if self.fields or self.correlate:
+            if self.fields:
+                self.print_field_stats(capture)
+            if self.correlate:
+                self.print_correlations(capture, self.endpoint)
+
+        sys.stderr.write('NumPackets = %d\n' % self.numPackets)
+        self.print_exp_stats()
+        if self.pattern_stats is not None:
+            self.print_pattern_stats()
+        if self.timing is not None:
+            self.print_timing()
+            if FLAGS.throughput_csv:
+                self.write_throughput(FLAGS.throughput_csv)
+
+    def print_timing(self):
+        """Print the per-endpoint timing statistics."""
+        ms = lambda t: '-' if t is None else '%.3f' % (t * 1e3)
+        high_speed = None
+        if FLAGS.speed is not None:
+            high_speed = FLAGS.speed in ('high', 'super')
+        for addr in sorted(self.timing.endpoints):
+            ep = self.timing.endpoints[addr]
+            sys.stderr.write('Endpoint %d:%02d:%02x: %d packets, %d bytes\n' %
+                             (addr + (ep.packets, ep.bytes)))
+            declared = ep.declared_period(high_speed)
+            if declared is not None:
+                period, hs = declared
+                sys.stderr.write('  interval: declared %d (%s ms at %s '
+                        'speed%s), estimated %s ms\n' % (
+                        ep.declared_interval(), ms(period),
+                        'high/super' if hs else 'low/full',
+                        '' if high_speed is not None else ', guessed',
+                        ms(ep.polling_estimate())))
+            for event_type, name in (('S', 'submissions'), ('C', 'callbacks')):
+                h = ep.interarrival[event_type]
+                if h.n:
+                    sys.stderr.write('  %s: inter-arrival min %s, median %s, '
+                            'p90 %s, max %s ms\n' % (name, ms(h.min),
+                            ms(h.quantile(0.5)), ms(h.quantile(0.9)),
+                            ms(h.max)))
+            h = ep.latency
+            if h.n:
+                sys.stderr.write('  latency (%d urbs): min %s, median %s, '
+                        'p90 %s, max %s ms\n' % (h.n, ms(h.min),
+                        ms(h.quantile(0.5)), ms(h.quantile(0.9)), ms(h.max)))
+            times, rates = ep.throughput.series()
+            if len(rates):
+                sys.stderr.write('  throughput: mean %.1f, peak %.1f bytes/s '
+                        '(%g s buckets)\n' % (rates.mean(), rates.max(),
+                                               ep.throughput.bucket))
+
+    def write_throughput(self, filename):
+        """Write the throughput time series of every endpoint as CSV."""
+        with open(filename, 'w') as f:
+            f.write('time,endpoint,bytes_per_sec\n')
+            for addr in sorted(self.timing.endpoints):
+                times, rates = self.timing.endpoints[addr].throughput.series()
+                for t, r in zip(times, rates):
+                    f.write('%f,%d:%02d:%02x,%f\n' % ((t - self.first_ts,) +
+                                                      addr + (r,)))
+
+    def print_exp_stats(self):
+        """Print the results of the --exp expressions. Timestamps are
+        relative to the first packet."""
+        for stats in self.exp_stats:
+            sys.stderr.write('%s: %d/%d (%.2f%%)' % (stats.expression.exp,
+                    stats.count, stats.total, stats.ratio * 100))
+            if not stats.expression.is_predicate and stats.count:
+                sys.stderr.write(' Min = %s Max = %s' % (stats.min, stats.max))
+            if stats.count:
+                sys.stderr.write(' First = %f Last = %f' % (
+                    stats.first_ts - self.first_ts,
+                    stats.last_ts - self.first_ts))
             sys.stderr.write('\n')
 
-        else:
-            sys.stderr.write('NumPackets = ')
-            sys.stderr.write(str(self.numPackets))
-            sys.stderr.write('\n')
-
-            #write out for each match the relevant data
-            #currently broken due to loop positioning etc...
-            for match in self.matches_list:
-                sys.stderr.write('Data[')
-                sys.stderr.write(match.group(1))
-                sys.stderr.write(']')
-
-                sys.stderr.write(' Min = ')
-                sys.stderr.write(str(self.datamin[int(match.group(1))]))
-
-                sys.stderr.write(' Max = ')
-                sys.stderr.write(str(self.datamax[int(match.group(1))]))
-                sys.stderr.write('\n')
-
+    def print_pattern_stats(self, top=None):
+        """Print the packet and occurrence counts of the --pattern byte
+        patterns, per endpoint, and their most frequent payload offsets."""
+        if top is None:
+            top = FLAGS.top
+        stats = self.pattern_stats
+        for index, pattern in enumerate(stats.matcher.patterns):
+            sys.stderr.write('%s: %d packets, %d hits\n' % (pattern,
+                    stats.packets[index], stats.hits[index]))
+            for addr in sorted(stats.endpoints[index]):
+                sys.stderr.write('  Endpoint %d:%02d:%02x: %d packets\n' %
+                                 (addr + (stats.endpoints[index][addr],)))
+            common = stats.offsets[index].most_common(top or None)
+            if common:
+                sys.stderr.write('  offsets: %s\n' % ', '.join(
+                        '%d (%d)' % item for item in common))
+
+    def print_field_stats(self, capture, top=None):
+        """Print the candidate fields of each endpoint, most interesting
+        first."""
+        if top is None:
+            top = FLAGS.top
+        stats = analysis.field_stats(capture)
+        for addr in sorted(stats):
+            sys.stderr.write('Endpoint %d:%02d:%02x\n' % addr)
+            sys.stderr.write('  offset  count  entropy  changed  toggling bits\n')
+            for s in stats[addr][:top or None]:
+                if s.score == 0:
+                    break
+                sys.stderr.write('  %6d %6d %8.3f %8.3f  %s\n' % (
+                    s.offset, s.count, s.entropy, s.change_rate,
+                    format(s.toggling_bits, '08b')))
+
+    def print_correlations(self, capture, endpoint=None, threshold=None):
+        """Print coupled payload offsets of a single endpoint. endpoint is a
+        (devnum, epnum) tuple; by default the busiest endpoint is used."""
+        if threshold is None:
+            threshold = FLAGS.threshold
+        datalen = capture.datalen
+        eps = dict((addr, rows[datalen[rows] > 0])
+                   for addr, rows in capture.endpoints().items())
+        if endpoint is not None:
+            eps = dict((addr, rows) for addr, rows in eps.items()
+                       if addr[1:] == tuple(endpoint))
+        if not eps or not max(len(rows) for rows in eps.values()):
+            sys.stderr.write('No data packets to correlate\n')
+            return
+        addr = max(eps, key=lambda a: len(eps[a]))
+        rows = eps[addr]
+        width = int(datalen[rows].max())
+
+        # one pass for the sums, then one per group of columns for the
+        # mutual information, reading a block of packets at a time
+        blocks = lambda: analysis.payload_blocks(capture, rows, width)
+        corr = analysis.CorrelationAccumulator(width)
+        tcorr = analysis.TimeCorrelationAccumulator(width)
+        offsets = analysis.OffsetStatsAccumulator(width)
+        pairs = analysis.EndianPairAccumulator(width)
+        for data, valid, ts in blocks():
+            corr.add(data, valid)
+            tcorr.add(data, valid, ts)
+            offsets.add(data, valid)
+            pairs.add(data, valid)
+        corr = corr.result()
+        tcorr = tcorr.result()
+        columns = sorted(s.offset for s in offsets.stats() if s.score > 0)
+        mi = analysis.mutual_information_blocks(blocks, columns)
+
+        sys.stderr.write('Endpoint %d:%02d:%02x (%d packets)\n' % (addr +
+                                                                 (len(rows),)))
+        mi_index = dict((c, k) for k, c in enumerate(columns))
+        sys.stderr.write('Correlated offsets (|r| >= %.2f):\n' % threshold)
+        for i, j, r in analysis.correlated_pairs(corr, threshold):
+            if i in mi_index and j in mi_index:
+                info = '%.3f' % mi[mi_index[i], mi_index[j]]
+            else:
+                info = '-'
+            sys.stderr.write('  data[%d] ~ data[%d]: r = %+.3f, MI = %s bits\n'
+                             % (i, j, r, info))
+
+        sys.stderr.write('Correlation with time:\n')
+        for i in np.argsort(-np.abs(tcorr)):
+            if abs(tcorr[i]) < threshold:
+                break
+            sys.stderr.write('  data[%d]: r = %+.3f\n' % (i, tcorr[i]))
+
+        sys.stderr.write('Likely 16-bit values:\n')
+        for pair in pairs.pairs():
+            sys.stderr.write('  data[%d:%d] %s-endian (score %.2f, %d carries)\n'
+                             % (pair.offset, pair.offset + 2, pair.endian,
+                                pair.score, pair.events))
 
     def packet_generator(self, input_stream='-'):
         self.pcap = pcapy.open_offline(input_stream)
 
-        # create the Dumper object now that we have a Reader
-        # self.out = self.pcap.dump_open('-')
+        # pass the packets through to a pipe
+        if not sys.stdout.isatty():
+            self.out = PcapWriter(sys.stdout, self.pcap.datalink())
 
         while True:
             (hdr, pack) = self.pcap.next()
@@ -103,59 +404,62 @@ class Statisfier(object):
             yield Packet(hdr, pack)
 
     def commit_packet(self, packet):
-        self.apply_cmdline_exps(packet)
+        self.numPackets += 1
+        if self.first_ts is None:
+            self.first_ts = packet.ts_sec + packet.ts_usec / 1e6
+        raw = packet.repack()
+        if (self.exp_stats or self.timing is not None or
+                self.pattern_stats is not None or self.spool is not None):
+            self.chunk.append(raw)
+            if len(self.chunk) >= self.chunk_size:
+                self.flush_chunk()
 
         if self.pcap is None:
             sys.stderr.write('Attempted to dump packets without first reading them -- make sure to call packet_generator()')
             sys.exit(1)
         else:
-            if not sys.stdout.isatty():
-                self.out.dump(packet.hdr, packet.datapack)
-
-    def apply_cmdline_exps(self, packet):
-        """Apply the expression supplied at the command line to a packet."""
-
-        #make sure is an expression to use
-        if self.cmdline_exps is not None:
-            for exp in self.cmdline_exps:
-                max_offset = 0 # highest offset needed to perfrm this expression
-
-                # find max_offset
-                numEquals = re.search("==" or ">" or "<",exp)
-                if numEquals:
-                   self.isEquals = True
-                else:
-                   self.isEquals = False
-
-                #if there's anything to save, make sure there's space to save it
-                if self.matches:
-                    for match in self.matches:
-                        if match.group(1) > max_offset:
-                            max_offset = int(match.group(1))
-
-                #what type of operations are we recording
-                if self.isEquals:
-                    self.numPackets += 1
-                    if len(packet.data) > max_offset:
-                        if eval(exp, {}, packet) is True:
-                            self.numTruePackets += 1
-
-                else: # isEquals == False
-                    if len(self.datamin) < len(packet.data):
-                       for num in range(len(packet.data) - len(self.datamin)):
-                           self.datamin.append(99999)
-                           self.datamax.append(0)
-
-                    #iterate over each match and modify their piece of the list
-                    for match in self.matches_list:
-                        if len(packet.data) > 0:
-                            if packet.data[int(match.group(1))] < self.datamin[int(match.group(1))]:
-                                self.datamin[int(match.group(1))] = packet.data[int(match.group(1))]
-
-                            if packet.data[int(match.group(1))] > self.datamax[int(match.group(1))]:
-                                self.datamax[int(match.group(1))] = packet.data[int(match.group(1))]
-
-                    self.numPackets += 1
+            if self.out is not None:
+                self.out.dump(packet.hdr, raw)
+
+    def flush_chunk(self):
+        """Evaluate all expressions over the packets committed since the last
+        flush."""
+        if self.chunk:
+            capture = ColumnarCapture.from_records(self.chunk)
+            self.analyze_chunk(capture, self.numPackets - len(self.chunk))
+            if self.spool is not None:
+                self.spool.append(capture)
+            self.chunk = list()
+
+    def analyze_chunk(self, capture, first):
+        """Update the statistics with a chunk of packets (a ColumnarCapture)
+        whose first packet is packet number first."""
+        self.apply_cmdline_exps(capture)
+        if self.timing is not None:
+            self.timing.update(capture)
+        if self.pattern_stats is not None:
+            matches = self.pattern_stats.update(capture)
+            if self.verbose:
+                self.print_pattern_hits(capture, matches, first)
+
+    def print_pattern_hits(self, capture, matches, first):
+        """Print the packets of a chunk matching a --pattern byte pattern;
+        first is the number of the first packet of the chunk."""
+        patterns = self.pattern_stats.matcher.patterns
+        ts = capture.ts
+        headers = capture.headers
+        for i, hits in matches:
+            sys.stderr.write('Packet %d (%f, %d:%02d:%02x): %s\n' % (
+                first + i, ts[i] - self.first_ts, headers['busnum'][i],
+                headers['devnum'][i], headers['epnum'][i],
+                ', '.join('%s @ %d' % (patterns[index], offset)
+                          for index, offset in hits)))
+
+    def apply_cmdline_exps(self, capture):
+        """Apply the expressions supplied at the command line to a chunk of
+        packets (a ColumnarCapture)."""
+        for stats in self.exp_stats:
+            stats.update(capture)
 
     # accessors and mutators
     def set_cmdline_exp(self, exps):
@@ -177,13 +481,17 @@ if __name__ == "__main__":
     # At least one of these must be specified
     try:
         argv = FLAGS(sys.argv)
-    except gflags.FlagsError:
+        endpoint = parse_endpoint(FLAGS.endpoint)
+    except (gflags.FlagsError, ValueError), e:
+        sys.stderr.write('%s\n' % e)
         sys.stderr.write('There was an error parsing the command line arguments.Please use --help.')
         sys.exit(1)
 
-    statisfier = Statisfier(FLAGS.exp)
+    statisfier = Statisfier(FLAGS.exp, FLAGS.fields, FLAGS.correlate,
+                            FLAGS.timing, FLAGS.pattern, FLAGS.verbose,
+                            endpoint)
     try:
-        statisfier.run()
+        statisfier.run(argv[1] if len(argv) > 1 else '-')
     except (KeyboardInterrupt, SystemExit):
         sys.exit(0)
 
@@ -20,21 +20,39 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import struct
 import sys
+import threading
+import time
+from array import array
 from optparse import OptionParser
 import pcapy
-from usbrevue import Packet, USBMON_TRANSFER_TYPE, SETUP_REQUEST_TYPES
+from usbrevue import Packet, USBMON_TRANSFER_TYPE, SETUP_REQUEST_TYPES, \
+                     REQUEST_TYPE_TYPE, REQUEST_TYPE_MASK
+from urbtracker import UrbTracker
+from blocklist import BlockList
+from util import LRUCache
+from pcapfile import PcapReader, PcapWriter
+from search import byte_pattern, find_in_payload, find_records
+from columnar import ColumnarCapture, ColumnExpression, CaptureReader, \
+        is_saved_capture
+import numpy as np
 import codegen
 from PyQt4.QtCore import Qt, QThread, QVariant, pyqtSignal, \
                          QAbstractTableModel, QModelIndex, \
-                         QPersistentModelIndex, QTimer, QString
+                         QTimer, QString
 from PyQt4.QtGui import *
 
 
+# milliseconds during which arriving packets are gathered into one batch
+BATCH_INTERVAL = 50
+
+
 class PcapThread(QThread):
     """ Thread responsible for reading pcap data from input and signalling
- arriving packets. """
-    new_packet = pyqtSignal(object)
+ arriving packets. Packets are queued, and packets_ready is signalled only
+ when the queue was empty, so that they can be taken in batches. """
+    packets_ready = pyqtSignal()
     eof = pyqtSignal()
     dump_opened = pyqtSignal(object)
 
@@ -42,6 +60,14 @@ class PcapThread(QThread):
         QThread.__init__(self)
         self.source = source
         self.dest = dest
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def take_packets(self):
+        """ Return the list of packets queued since the last call. """
+        with self.lock:
+            packets, self.pending = self.pending, []
+        return packets
 
     def run(self):
         if self.source == '-' and sys.stdin.isatty():
@@ -58,7 +84,52 @@ class PcapThread(QThread):
             if hdr is None:
                 self.eof.emit()
                 break
-            self.new_packet.emit(Packet(hdr, pack))
+            packet = Packet(hdr, pack)
+            with self.lock:
+                self.pending.append(packet)
+                notify = len(self.pending) == 1
+            if notify:
+                self.packets_ready.emit()
+
+
+class IndexThread(QThread):
+    """ Thread indexing the records of a pcap file for the packet model to
+ load them on demand. Signals each chunk of records indexed along with their
+ row color codes and, if there is a capture filter, the numbers of the
+ records it accepts (else None). """
+    records_indexed = pyqtSignal(int, int, object, object)
+    eof = pyqtSignal()
+
+    def __init__(self, reader):
+        QThread.__init__(self)
+        self.reader = reader
+        self.cancelled = False
+        # compiled capture filter, applied from the next chunk on
+        self.cap_filter = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        urbs = UrbTracker(timeout=URB_TIMEOUT)
+        # small chunks first, so that the first screenful shows up at once
+        chunk = INDEX_FIRST_CHUNK
+        while not self.cancelled:
+            first = len(self.reader)
+            count = self.reader.index(chunk)
+            if not count:
+                break
+            colors = array('B', [record_color(urbs, self.reader.record(i)[1])
+                                 for i in xrange(first, first + count)])
+            code = self.cap_filter
+            records = None
+            if code is not None:
+                records = array('l', [i for i in xrange(first, first + count)
+                                      if filter_accepts(code, Packet(
+                                          *self.reader.record(i)))])
+            self.records_indexed.emit(first, count, colors, records)
+            chunk = min(chunk * 2, INDEX_CHUNK)
+        self.eof.emit()
 
 
 
@@ -69,34 +140,267 @@ ADDRESS_COL = 1
 SETUP_COL = 2
 DATA_COL = 3
 
+# seconds before a submission without callback is forgotten
+URB_TIMEOUT = 60
+
+# row background color codes, by bmRequestType type of the setup packet
+NO_COLOR = 0
+REQUEST_TYPE_COLORS = dict(standard=1, class_=2, vendor=3)
+
+# number of decoded packets kept around for the rows being displayed
+DECODE_CACHE_SIZE = 1024
+# number of rows whose display and tooltip strings are kept
+RENDER_CACHE_SIZE = 4096
+
+# removing more separate ranges of rows than this resets the model
+BULK_REMOVE_RANGES = 32
+
+# rows whose packets are evaluated at a time when searching by expression
+SEARCH_CHUNK = 16384
+
+# records of a pcap file indexed between two updates of the model
+INDEX_FIRST_CHUNK = 1024
+INDEX_CHUNK = 65536
+
+# usbmon header fields needed to color a row: urb, event_type, xfer_type,
+# busnum, flag_setup, ts_sec, ts_usec and the setup bmRequestType
+COLOR_FIELDS = struct.Struct('<QcBxxHcxqi12xB')
+
+
+def record_color(urbs, raw):
+    """ Row color code of a raw usbmon packet: setup packets are colored by
+ their bmRequestType type, control callbacks like their submission, which is
+ paired with them by the UrbTracker urbs. """
+    if len(raw) < COLOR_FIELDS.size:
+        return NO_COLOR
+    (urb, event_type, xfer_type, busnum, flag_setup, ts_sec, ts_usec,
+     bmRequestType) = COLOR_FIELDS.unpack_from(raw)
+    color = NO_COLOR
+    if flag_setup == '\x00':
+        request_type = REQUEST_TYPE_TYPE[bmRequestType &
+                                         REQUEST_TYPE_MASK['type_']]
+        color = REQUEST_TYPE_COLORS.get(request_type, NO_COLOR)
+    if event_type == 'S':
+        urbs.submit(busnum, urb, ts_sec + ts_usec / 1e6, color)
+    else:
+        match = urbs.complete(busnum, urb, ts_sec + ts_usec / 1e6)
+        if match is not None and event_type == 'C' and \
+                xfer_type == USBMON_TRANSFER_TYPE['control']:
+            color = match[1]
+    return color
+
+
+class PacketRecord(object):
+    """ A row of the packet model: the pcap header and raw usbmon packet,
+ decoded on demand, and the row color code worked out on arrival. """
+    __slots__ = ('hdr', 'raw', 'color')
+
+    def __init__(self, hdr, raw, color=NO_COLOR):
+        self.hdr = hdr
+        self.raw = raw
+        self.color = color
+
+
+def row_size(row):
+    """ Bytes of packet data held in memory by a row of the packet model. """
+    return len(row.raw) if isinstance(row, PacketRecord) else 0
+
+
+
 
 class PacketModel(QAbstractTableModel):
     """ Qt model for packet data. """
+    # the sorted rows removed in bulk, signalled before the model is reset
+    rows_deleted = pyqtSignal(object)
+
     def __init__(self, parent = None):
         QAbstractTableModel.__init__(self, parent)
-        self.packets = []
+        # PacketRecords, strings for annotations and, for packets loaded on
+        # demand from self.reader, record numbers
+        self.rows = BlockList()
+        self.reader = None
+        # color codes of the records of self.reader
+        self.record_colors = array('B')
+        self.decoded = LRUCache(DECODE_CACHE_SIZE)
+        # row record -> {(role, column): rendered string}
+        self.rendered = LRUCache(RENDER_CACHE_SIZE)
+        self.monospace_font = QFont("monospace")
+        self.annotation_font = QFont()
+        self.annotation_font.setBold(True)
+        self.color_table = {NO_COLOR: QVariant(),
+                            REQUEST_TYPE_COLORS['standard']: QColor('lightgray'),
+                            REQUEST_TYPE_COLORS['class_']: QColor(250, 230, 190),
+                            REQUEST_TYPE_COLORS['vendor']: QColor(190, 250, 190)}
+        self.urbs = UrbTracker(timeout=URB_TIMEOUT)
         self.headers = {TIMESTAMP_COL: "Timestamp",
                         ADDRESS_COL: "Address",
                         SETUP_COL: "Setup",
                         DATA_COL: "Data"}
         # timestamp of the first received packet
         self.first_ts = 0.0
+        # number of annotations added since the model was last cleared
+        self.annotations = 0
+        # number of rows of self.reader which have been edited
+        self.edited_records = 0
+        # packet bytes held by the rows
+        self.nbytes = 0
+        # ring buffer mode: limits on rows and bytes held, and where evicted
+        # packets go
+        self.max_rows = None
+        self.max_bytes = None
+        self.spill = None
+        self.evicted = 0
 
     def rowCount(self, parent = QModelIndex()):
-        return 0 if parent.isValid() else len(self.packets)
+        return 0 if parent.isValid() else len(self.rows)
 
     def columnCount(self, parent = QModelIndex()):
         return 0 if parent.isValid() else len(self.headers)
 
+    def decode(self, rec):
+        """ Return the Packet (or annotation string) for a row record. Safe to
+ call from other threads. """
+        if isinstance(rec, str):
+            return rec
+        if isinstance(rec, PacketRecord):
+            return Packet(rec.hdr, rec.raw)
+        return Packet(*self.reader.record(rec))
+
+    def packet(self, row):
+        """ Return the Packet (or annotation string) at row. """
+        rec = self.rows[row]
+        if isinstance(rec, str):
+            return rec
+        pack = self.decoded.get(rec)
+        if pack is None:
+            pack = self.decode(rec)
+            self.decoded[rec] = pack
+        return pack
+
+    def raw(self, rec):
+        """ Return the raw usbmon packet of a row record, None for
+ annotations. """
+        if isinstance(rec, PacketRecord):
+            return rec.raw
+        if isinstance(rec, str):
+            return None
+        return self.reader.record(rec)[1]
+
+    def record_base(self):
+        """ If the rows are consecutive records of self.reader, as they are
+ until rows are edited, annotated or removed other than from the front,
+ return the record number of row 0; else None. """
+        if self.reader is None or not self.rows or self.annotations or \
+                self.edited_records:
+            return None
+        first, last = self.rows[0], self.rows[-1]
+        if last - first != len(self.rows) - 1:
+            return None
+        return first
+
+    def find(self, start, forward=True, regex=None, expr=None, accept=None):
+        """ Return the first row after start (or before it, if not forward)
+ whose payload matches the byte pattern regex (see search.byte_pattern) or
+ for which the expression expr is true, and which accept(row) accepts if
+ given. Returns -1 if there is none. """
+        if forward:
+            lo, hi = start + 1, len(self.rows)
+        else:
+            lo, hi = 0, start
+        if regex is not None:
+            rows = self.find_bytes(regex, lo, hi, forward)
+        else:
+            rows = self.find_expression(expr, lo, hi, forward)
+        for row in rows:
+            if accept is None or accept(row):
+                return row
+        return -1
+
+    def find_bytes(self, regex, lo, hi, forward):
+        base = self.record_base()
+        if base is not None:
+            # search the file itself
+            for rec in find_records(regex, self.reader, base + lo, base + hi,
+                                    forward):
+                yield rec - base
+            return
+        rows = xrange(lo, hi) if forward else xrange(hi - 1, lo - 1, -1)
+        for row in rows:
+            raw = self.raw(self.rows[row])
+            if raw is not None and find_in_payload(regex, raw):
+                yield row
+
+    def find_expression(self, expr, lo, hi, forward):
+        # evaluated a chunk of packets at a time as a ColumnExpression,
+        # falling back to evaluating packets one at a time for expressions
+        # it doesn't support
+        colexp = ColumnExpression(expr)
+        code = compile(expr, '<search>', 'eval')
+        chunks = range(lo, hi, SEARCH_CHUNK)
+        if not forward:
+            chunks.reverse()
+        for first in chunks:
+            last = min(first + SEARCH_CHUNK, hi)
+            recs = [(row, rec) for row, rec in
+                    enumerate(self.rows.iter_range(first, last), first)
+                    if not isinstance(rec, str)]
+            if not recs:
+                continue
+            hits = None
+            if colexp is not None:
+                try:
+                    capture = ColumnarCapture.from_records(
+                            self.raw(rec) for row, rec in recs)
+                    values, valid = colexp.evaluate(capture)
+                    hits = [recs[i][0] for i in
+                            np.flatnonzero(np.asarray(values, bool) & valid)]
+                except Exception:
+                    colexp = None
+            if hits is None:
+                hits = [row for row, rec in recs
+                        if filter_accepts(code, self.decode(rec))]
+            if not forward:
+                hits.reverse()
+            for row in hits:
+                yield row
+
+    def row_color(self, rec):
+        if isinstance(rec, PacketRecord):
+            return rec.color
+        return self.record_colors[rec]
+
     def data(self, index, role = Qt.DisplayRole):
         row = index.row()
         col = index.column()
-        pack = self.packets[row]
+        rec = self.rows[row]
+
+        if role == Qt.DisplayRole or role == Qt.ToolTipRole:
+            if isinstance(rec, str):
+                return rec if role == Qt.DisplayRole else QVariant()
+            strings = self.rendered.get(rec)
+            if strings is None:
+                strings = self.rendered[rec] = dict()
+            if (role, col) not in strings:
+                strings[(role, col)] = self.render(self.packet(row), col, role)
+            return strings[(role, col)]
+        elif role == Qt.FontRole:
+            if col in [SETUP_COL, ADDRESS_COL, DATA_COL]:
+                return self.monospace_font
+            if isinstance(rec, str):
+                return self.annotation_font
+        elif role == Qt.BackgroundColorRole:
+            if isinstance(rec, str):
+                return QVariant()
+            return self.color_table[self.row_color(rec)]
+        elif role == Qt.UserRole: # packet object
+            return QVariant(self.packet(row))
+ 
+        return QVariant()
 
+    def render(self, pack, col, role):
+        """ Display or tooltip text of a packet cell. """
         if role == Qt.DisplayRole:
-            if isinstance(pack, str):
-                return pack
-            elif col == TIMESTAMP_COL:
+            if col == TIMESTAMP_COL:
                 return "%f" % (pack.ts_sec + pack.ts_usec/1e6 - self.first_ts)
             elif col == ADDRESS_COL:
                 return pack.packet_summ
@@ -106,13 +410,6 @@ class PacketModel(QAbstractTableModel):
                 if pack.setup.bmRequestTypeType == 'standard':
                     return SETUP_REQUEST_TYPES[pack.setup.bRequest]
                 return pack.setup.data_to_str()
-        elif role == Qt.FontRole:
-            if col in [SETUP_COL, ADDRESS_COL, DATA_COL]:
-                return QFont("monospace")
-            if isinstance(pack, str):
-                font = QFont()
-                font.setBold(True)
-                return font
         elif role == Qt.ToolTipRole:
             if col == ADDRESS_COL:
                 return '%s %s (%s, %s) ' % (pack.event_type_preposition,
@@ -121,34 +418,8 @@ class PacketModel(QAbstractTableModel):
                                             pack.endpoint_dir)
             if col == SETUP_COL and pack.is_setup_packet:
                 return pack.setup.fields_to_str()
-        elif role == Qt.BackgroundColorRole:
-            if isinstance(pack, Packet):
-                if pack.is_setup_packet:
-                    return self.packet_color(pack)
-                elif pack.is_event_type_callback and pack.is_control_xfer:
-                    # find the corresponding submission, color accordingly
-                    for i in xrange(row, -1, -1):
-                        if isinstance(self.packets[i], Packet) and \
-                                self.packets[i].event_type == 'S' and \
-                                self.packets[i].busnum == pack.busnum and \
-                                self.packets[i].devnum == pack.devnum and \
-                                self.packets[i].epnum == pack.epnum:
-                            return self.packet_color(self.packets[i])
-        elif role == Qt.UserRole: # packet object
-            return QVariant(pack)
- 
         return QVariant()
 
-    def packet_color(self, pack):
-        if not pack.is_setup_packet:
-            return QVariant()
-        if pack.setup.bmRequestTypeType == 'standard':
-            return QColor('lightgray')
-        elif pack.setup.bmRequestTypeType == 'class_':
-            return QColor(250, 230, 190)
-        elif pack.setup.bmRequestTypeType == 'vendor':
-            return QColor(190, 250, 190)
-
     def setData(self, index, value, role = Qt.EditRole):
         if role != Qt.EditRole or index.column() != DATA_COL:
             return False
@@ -157,8 +428,21 @@ class PacketModel(QAbstractTableModel):
             data = map(lambda b: int(b, 16), datastr.split())
         except Exception:
             return False
+        pack = self.packet(index.row())
         for i in xrange(len(data)):
-            self.packets[index.row()].data[i] = data[i]
+            pack.data[i] = data[i]
+        rec = self.rows[index.row()]
+        self.rendered.pop(rec)
+        old_size = row_size(rec)
+        if not isinstance(rec, PacketRecord):
+            # an edited packet is no longer what is in the file
+            self.decoded.pop(rec)
+            rec = PacketRecord(pack.hdr, None, self.row_color(rec))
+            self.rows[index.row()] = rec
+            self.edited_records += 1
+            self.decoded[rec] = pack
+        rec.raw = pack.repack()
+        self.nbytes += row_size(rec) - old_size
         self.dataChanged.emit(index, index)
         return True
         
@@ -176,51 +460,375 @@ class PacketModel(QAbstractTableModel):
     def removeRows(self, first, count, parent = None):
         last = first + count - 1
         self.beginRemoveRows(QModelIndex(), first, last)
-        self.packets = self.packets[:first] + self.packets[last+1:]
+        for rec in self.rows.iter_range(first, last + 1):
+            self.decoded.pop(rec)
+            self.rendered.pop(rec)
+            self.nbytes -= row_size(rec)
+        del self.rows[first:last+1]
         self.endRemoveRows()
         return True
 
+    def remove_rows(self, rows):
+        """ Remove the given rows, in any order. """
+        rows = sorted(set(rows))
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row - 1:
+                ranges[-1][1] = row
+            else:
+                ranges.append([row, row])
+        if len(ranges) > BULK_REMOVE_RANGES:
+            # a single pass over the store instead of one per range
+            self.beginResetModel()
+            self.decoded.clear()
+            self.rendered.clear()
+            self.nbytes -= sum(row_size(self.rows[row]) for row in rows)
+            self.rows.delete_indices(rows)
+            self.rows_deleted.emit(rows)
+            self.endResetModel()
+        else:
+            for first, last in reversed(ranges):
+                self.removeRows(first, last - first + 1)
+
     def clear(self):
         self.beginResetModel()
-        self.packets = []
+        self.rows = BlockList()
+        self.decoded.clear()
+        self.rendered.clear()
+        self.urbs.clear()
         self.first_ts = 0.0
+        self.annotations = 0
+        self.edited_records = 0
+        self.nbytes = 0
         self.endResetModel()
 
+    def set_ring_buffer(self, max_rows=None, max_bytes=None, spill=None):
+        """ Keep at most max_rows rows and/or max_bytes bytes of packets,
+ evicting the oldest rows as new packets arrive. Evicted packets are
+ written to spill (a PcapWriter or file name) if given. """
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        if isinstance(spill, basestring):
+            spill = PcapWriter(spill)
+        self.spill = spill
+        self.evict()
+
+    def evict(self):
+        """ Remove the oldest rows beyond the ring buffer limits. """
+        excess_rows = len(self.rows) - self.max_rows if self.max_rows else 0
+        excess_bytes = self.nbytes - self.max_bytes if self.max_bytes else 0
+        if excess_rows <= 0 and excess_bytes <= 0:
+            return
+        count = freed = 0
+        for rec in self.rows.iter_range(0, len(self.rows)):
+            if count >= excess_rows and freed >= excess_bytes:
+                break
+            count += 1
+            freed += row_size(rec)
+            if self.spill is not None and isinstance(rec, PacketRecord):
+                self.spill.dump(rec.hdr, rec.raw)
+            elif self.spill is not None and not isinstance(rec, str):
+                self.spill.dump(*self.reader.record(rec))
+        if self.spill is not None:
+            self.spill.flush()
+        self.removeRows(0, count)
+        self.evicted += count
+
     def new_packet(self, pack):
-        l = len(self.packets)
-        self.first_ts = self.first_ts or pack.ts_sec + pack.ts_usec/1e6
-        self.beginInsertRows(QModelIndex(), l, l)
-        self.packets.append(pack)
+        self.new_packets([pack])
+
+    def new_packets(self, packs):
+        """ Append a batch of packets with a single row insertion. """
+        if not packs:
+            return
+        records = []
+        for pack in packs:
+            self.first_ts = self.first_ts or pack.ts_sec + pack.ts_usec/1e6
+            raw = pack.repack()
+            records.append(PacketRecord(pack.hdr, raw,
+                                        record_color(self.urbs, raw)))
+        l = len(self.rows)
+        self.beginInsertRows(QModelIndex(), l, l + len(records) - 1)
+        self.rows.extend(records)
+        self.nbytes += sum(len(rec.raw) for rec in records)
+        self.endInsertRows()
+        self.evict()
+
+    def open_file(self, reader):
+        """ Show the records of a PcapReader (or a CaptureReader), which are
+ added as they are indexed with new_records(). """
+        self.clear()
+        self.reader = reader
+        self.record_colors = array('B')
+
+    def new_records(self, first, count, colors, records=None):
+        """ Append rows for count records of the reader from record first,
+ with the given color codes; only for the record numbers records among them
+ if given. """
+        self.record_colors.extend(colors)
+        if records is None:
+            records = xrange(first, first + count)
+        if not records:
+            return
+        if not self.first_ts:
+            pack = self.decode(records[0])
+            self.first_ts = pack.ts_sec + pack.ts_usec/1e6
+        l = len(self.rows)
+        self.beginInsertRows(QModelIndex(), l, l + len(records) - 1)
+        self.rows.extend(records)
         self.endInsertRows()
+        self.evict()
 
     def new_annotation(self, note):
-        l = len(self.packets)
+        l = len(self.rows)
         self.beginInsertRows(QModelIndex(), l, l)
-        self.packets.append("*** " + str(note))
+        self.rows.append("*** " + str(note))
+        self.annotations += 1
         self.endInsertRows()
 
 
 
 
+# the filter has not been evaluated for the row yet
+UNKNOWN = -1
+# rows evaluated by the filter thread between two progress signals
+FILTER_CHUNK = 2048
+# minimum time between two re-filterings of the proxy, relative to the time
+# the last one took
+INVALIDATE_RATIO = 10
+
+
+def filter_accepts(code, row):
+    """ Evaluate a compiled display filter for a Packet (or annotation
+ string): 1 if accepted, else 0. """
+    if isinstance(row, str):
+        return 1
+    if code is None:
+        return 0
+    try:
+        return int(bool(eval(code, USBMON_TRANSFER_TYPE, row)))
+    except Exception:
+        return 0
+
+
+class FilterThread(QThread):
+    """ Thread evaluating a display filter over a snapshot of the packet
+ model rows (a BlockList.snapshot(), which doesn't change while the model
+ does) from row start on, signalling the results a chunk of rows at a time.
+ Cancelling it only makes it stop after the current chunk. """
+    results = pyqtSignal(int, int, object)
+
+    def __init__(self, generation, code, rows, decode, start=0):
+        QThread.__init__(self)
+        self.generation = generation
+        self.code = code
+        self.rows = rows
+        self.decode = decode
+        self.first = start
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        for first in xrange(self.first, len(self.rows), FILTER_CHUNK):
+            if self.cancelled:
+                return
+            states = array('b', [filter_accepts(self.code, self.decode(row))
+                                 for row in self.rows.iter_range(
+                                     first, first + FILTER_CHUNK)])
+            self.results.emit(self.generation, first, states)
+
+
+
+
 class PacketFilterProxyModel(QSortFilterProxyModel):
-    """ Proxy model for filtering displayed packets. """
+    """ Proxy model for filtering displayed packets. Whether each source row
+ is accepted is remembered, so a packet is only evaluated once per filter.
+
+ Packets are never evaluated on the GUI thread, but for edited ones. Unless
+ the filter accepts everything, new rows are hidden until a FilterThread has
+ evaluated them, and a new filter is evaluated in a FilterThread; until its
+ results for a row come in, the row keeps the result of the previous filter. Each generation
+ of results is numbered, so results of a filter that has since been
+ replaced are ignored. Results are stored as they arrive; as re-filtering
+ goes over all rows, the proxy does so no sooner than INVALIDATE_RATIO times
+ the previous re-filtering took, so that it keeps up with the worker
+ without hogging the event loop. """
     def __init__(self, parent = None):
         QSortFilterProxyModel.__init__(self, parent)
+        self.setDynamicSortFilter(True)
         self.expr = 'True'
+        self.code = compile(self.expr, '<filter>', 'eval')
+        # per source row: 1 if accepted, 0 if not or UNKNOWN
+        self.accepted = array('b')
+        self.generation = 0
+        self.worker = None
+        # number of rows of the worker's snapshot since removed from the front
+        self.worker_shift = 0
+        self.restart_pending = False
+        self.invalidate_pending = False
+        self.next_invalidate = 0.0
+        # cancelled workers still running, kept until they finish
+        self.retired = set()
+
+    def setSourceModel(self, model):
+        # connect these before the proxy's own handlers, so that the cache
+        # matches the source rows by the time they run
+        model.rowsInserted.connect(self.source_rows_inserted)
+        model.rowsRemoved.connect(self.source_rows_removed)
+        model.dataChanged.connect(self.source_data_changed)
+        model.modelReset.connect(self.source_reset)
+        model.rows_deleted.connect(self.source_rows_deleted)
+        QSortFilterProxyModel.setSourceModel(self, model)
+        self.source_reset()
+
+    def source_rows_inserted(self, parent, first, last):
+        count = last - first + 1
+        if self.accepts_all():
+            self.accepted[first:first] = array('b', [1]) * count
+            return
+        self.accepted[first:first] = array('b', [UNKNOWN]) * count
+        # a running worker goes on with the new rows once done with its own
+        if self.worker is None and not self.restart_pending:
+            self.refilter(first)
+
+    def source_rows_removed(self, parent, first, last):
+        del self.accepted[first:last+1]
+        if self.worker is not None and first == 0:
+            # rows evicted from the front of a ring buffer: just shift the
+            # worker's rows
+            self.worker_shift += last + 1
+        else:
+            self.restart_worker()
+
+    def source_rows_deleted(self, rows):
+        # drop the results of the rows removed in bulk, so that those of the
+        # others survive the model reset which follows
+        kept = array('b')
+        prev = 0
+        for row in rows:
+            kept.extend(self.accepted[prev:row])
+            prev = row + 1
+        kept.extend(self.accepted[prev:])
+        self.accepted = kept
+        self.restart_worker()
+
+    def restart_worker(self):
+        if self.worker is not None and not self.restart_pending:
+            # the worker's row numbers are off now; start over once the
+            # rows have been removed
+            self.generation += 1
+            self.restart_pending = True
+            QTimer.singleShot(0, self.refilter)
+
+    def source_data_changed(self, top_left, bottom_right):
+        # a packet edited by hand
+        model = self.sourceModel()
+        for row in xrange(top_left.row(), bottom_right.row() + 1):
+            self.accepted[row] = filter_accepts(self.code, model.packet(row))
+
+    def source_reset(self):
+        rows = self.sourceModel().rowCount()
+        if len(self.accepted) == rows:
+            # rows removed in bulk, see source_rows_deleted()
+            return
+        self.cancel_worker()
+        self.generation += 1
+        if self.accepts_all():
+            self.accepted = array('b', [1]) * rows
+        else:
+            self.accepted = array('b', [UNKNOWN]) * rows
+            self.refilter()
 
     def set_filter(self, e):
         self.expr = str(e) or 'True'
+        try:
+            self.code = compile(self.expr, '<filter>', 'eval')
+        except SyntaxError:
+            self.code = None
+        self.generation += 1
+        self.refilter()
+
+    def accepts_all(self):
+        return self.expr == 'True'
+
+    def cancel_worker(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            if self.worker.isRunning():
+                self.retired.add(self.worker)
+            self.worker = None
+
+    def worker_finished(self):
+        self.retired.discard(self.sender())
+
+    def refilter(self, start=0):
+        """ Start evaluating the current filter over the rows from start
+ on. """
+        self.cancel_worker()
+        self.restart_pending = False
+        rows = self.sourceModel().rows
+        if start >= len(rows):
+            return
+        if self.accepts_all():
+            self.accepted[start:] = array('b', [1]) * (len(rows) - start)
+            self.invalidateFilter()
+            return
+        self.worker = FilterThread(self.generation, self.code,
+                                   rows.snapshot(), self.sourceModel().decode,
+                                   start)
+        self.worker_shift = 0
+        self.worker.results.connect(self.filter_results)
+        self.worker.finished.connect(self.worker_finished)
+        self.worker.start()
+
+    def filter_results(self, generation, first, states):
+        if generation != self.generation or self.worker is None:
+            return
+        # skip the rows which have been evicted meanwhile
+        first -= self.worker_shift
+        end = len(self.worker.rows) - self.worker_shift
+        done = first + len(states) >= end
+        if first < 0:
+            states = states[-first:]
+            first = 0
+        if states:
+            self.accepted[first:first+len(states)] = states
+            self.schedule_invalidate()
+        if done:
+            # keep the thread until it has returned from run(), and go on
+            # with the rows added since it started
+            self.cancel_worker()
+            if end < len(self.accepted):
+                self.refilter(max(end, 0))
+
+    def schedule_invalidate(self):
+        # have the proxy show or hide the rows according to their new
+        # state, once for all the results queued up meanwhile
+        if not self.invalidate_pending:
+            self.invalidate_pending = True
+            delay = max(self.next_invalidate - time.time(), 0.0)
+            QTimer.singleShot(int(delay * 1000), self.apply_results)
+
+    def apply_results(self):
+        self.invalidate_pending = False
+        start = time.time()
         self.invalidateFilter()
+        end = time.time()
+        self.next_invalidate = end + INVALIDATE_RATIO * (end - start)
+
+    def accepts(self, source_row):
+        # rows not evaluated yet stay hidden
+        return source_row < len(self.accepted) and \
+                self.accepted[source_row] == 1
 
     def filterAcceptsRow(self, source_row, source_parent):
-        index = self.sourceModel().index(source_row, 0, source_parent)
-        packet = self.sourceModel().data(index, Qt.UserRole).toPyObject()
-        if isinstance(packet, QString):
-            return True
-        try:
-            return bool(eval(self.expr, USBMON_TRANSFER_TYPE, packet))
-        except Exception:
-            return False
+        return self.accepts(source_row)
+
+    def remove_rows(self, rows):
+        self.sourceModel().remove_rows(
+                [self.mapToSource(self.index(row, 0)).row() for row in rows])
 
     def clear(self):
         self.sourceModel().clear()
@@ -330,9 +938,7 @@ class PacketView(QTreeView):
 
     def remove_selected(self):
         rows = self.selectionModel().selectedRows()
-        rows = map(lambda x: QPersistentModelIndex(x), rows)
-        for idx in rows:
-            self.model().removeRow(idx.row())
+        self.model().remove_rows([idx.row() for idx in rows])
 
     def remove_all(self):
         self.model().clear()
@@ -342,6 +948,10 @@ class PacketView(QTreeView):
         if self.autoscroll_toggle.isChecked() and not self.autoscroll_timer.isActive():
             self.autoscroll_timer.start(50)
 
+        # only annotations span columns; don't look at every packet of a
+        # batch if there are none
+        if not self.model().sourceModel().annotations:
+            return
         for row in xrange(start, end+1):
             idx = self.model().index(row, 0, parent)
             pack = self.model().data(idx, Qt.UserRole).toPyObject()
@@ -425,6 +1035,57 @@ data:\tA list of transmitted bytes of data"""
 
 
 
+class SearchWidget(QWidget):
+    """ Search bar: finds the next or previous packet matching a byte pattern
+ or an expression. """
+    search = pyqtSignal(str, bool, bool)
+
+    def __init__(self, parent = None):
+        QWidget.__init__(self, parent)
+        self.mode = QComboBox()
+        self.mode.addItems(["Bytes", "Expression"])
+        self.mode.setToolTip("Search payloads for hex bytes, with ?? for any "
+                             "byte (e.g. 'a1 01 ?? 00'),\nor for packets "
+                             "for which a python expression is true")
+        self.search_edit = QLineEdit()
+        if hasattr(self.search_edit, "setPlaceholderText"):
+            self.search_edit.setPlaceholderText("Search")
+        self.prev_button = QPushButton("Previous")
+        self.next_button = QPushButton("Next")
+        self.status = QLabel()
+
+        self.hb = QHBoxLayout()
+        self.hb.addWidget(self.mode)
+        self.hb.addWidget(self.search_edit)
+        self.hb.addWidget(self.prev_button)
+        self.hb.addWidget(self.next_button)
+        self.hb.addWidget(self.status)
+        self.setLayout(self.hb)
+
+        self.search_edit.returnPressed.connect(self.search_next)
+        self.next_button.clicked.connect(self.search_next)
+        self.prev_button.clicked.connect(self.search_prev)
+
+    def start_search(self):
+        self.search_edit.setFocus()
+        self.search_edit.selectAll()
+
+    def search_next(self):
+        self.emit_search(True)
+
+    def search_prev(self):
+        self.emit_search(False)
+
+    def emit_search(self, forward):
+        text = str(self.search_edit.text())
+        if text:
+            self.search.emit(text, self.mode.currentIndex() == 0, forward)
+
+    def set_status(self, text):
+        self.status.setText(text)
+
+
+
 class USBView(QApplication):
     def __init__(self, argv, options, args):
         QApplication.__init__(self, argv)
@@ -432,6 +1093,9 @@ class USBView(QApplication):
         self.w.resize(1000, 800)
 
         self.packetmodel = PacketModel()
+        if options.ring_packets or options.ring_bytes:
+            self.packetmodel.set_ring_buffer(options.ring_packets,
+                                             options.ring_bytes, options.spill)
         self.proxy = PacketFilterProxyModel()
         self.proxy.setSourceModel(self.packetmodel)
         self.packetview = PacketView()
@@ -451,6 +1115,13 @@ class USBView(QApplication):
         self.filterpane.new_view_filter.connect(self.proxy.set_filter)
         self.filterpane.new_cap_filter.connect(self.new_cap_filter)
 
+        self.searchpane = SearchWidget()
+        self.searchpane.search.connect(self.search)
+        self.find_act = QAction("Find", self.w)
+        self.find_act.setShortcut(QKeySequence.Find)
+        self.find_act.triggered.connect(self.searchpane.start_search)
+        self.w.addAction(self.find_act)
+
         self.annotator = QLineEdit()
         self.annotator.returnPressed.connect(self.new_annotation)
         if hasattr(self.annotator, "setPlaceholderText"):
@@ -458,22 +1129,47 @@ class USBView(QApplication):
 
         self.vb = QVBoxLayout()
         self.vb.addWidget(self.filterpane)
+        self.vb.addWidget(self.searchpane)
         self.vb.addWidget(self.packetview)
         self.vb.addWidget(self.annotator)
         self.w.setLayout(self.vb)
         self.w.show()
 
+        self.dumper = None
+        self.passthru_toggled(options.passthru)
+        self.filterexpr = None
+        self.pause_toggled(False)
+
+        self.reader = None
         if sys.stdin.isatty() and len(args) > 0:
-            self.pcapthread = PcapThread(source=args[0])
+            # load the packets of a pcap file (or a capture saved with
+            # usbcolumns.py) on demand if we can read it
+            try:
+                if is_saved_capture(args[0]):
+                    self.reader = CaptureReader(args[0])
+                else:
+                    self.reader = PcapReader(args[0])
+            except (IOError, ValueError):
+                self.pcapthread = PcapThread(source=args[0])
         else:
             self.pcapthread = PcapThread()
-        self.pause_toggled(False)
-        self.pcapthread.dump_opened.connect(self.dump_opened)
-        self.pcapthread.start()
 
-        self.dumper = None
-        self.passthru_toggled(options.passthru)
-        self.filterexpr = None
+        if self.reader is not None:
+            self.packetmodel.open_file(self.reader)
+            if not sys.stdout.isatty():
+                self.dumper = PcapWriter(sys.stdout, self.reader.linktype,
+                                         self.reader.snaplen)
+            self.indexthread = IndexThread(self.reader)
+            self.indexthread.records_indexed.connect(self.new_records)
+            self.indexthread.eof.connect(self.index_finished)
+            self.indexthread.start()
+        else:
+            self.batch_timer = QTimer(self)
+            self.batch_timer.setSingleShot(True)
+            self.batch_timer.timeout.connect(self.new_packets)
+            self.pcapthread.packets_ready.connect(self.packets_ready)
+            self.pcapthread.dump_opened.connect(self.dump_opened)
+            self.pcapthread.start()
 
     def new_annotation(self):
         note = self.annotator.text()
@@ -489,25 +1185,87 @@ class USBView(QApplication):
             self.packetview.passthru_toggle.setChecked(state)
 
     def pause_toggled(self, state):
-        if state:
-            self.pcapthread.new_packet.disconnect(self.new_packet)
-        else:
-            self.pcapthread.new_packet.connect(self.new_packet)
-    
-    def new_packet(self, packet):
-        if self.filterexpr:
-            try:
-                if not eval(self.filterexpr, USBMON_TRANSFER_TYPE, packet):
-                    return
-            except Exception:
-                return
+        self.paused = state
+
+    def packets_ready(self):
+        # give more packets a chance to arrive and join the batch
+        if not self.batch_timer.isActive():
+            self.batch_timer.start(BATCH_INTERVAL)
 
+    def new_packets(self):
+        packets = self.pcapthread.take_packets()
+        # packets arriving while paused are dropped
+        if self.paused:
+            return
+        if self.filterexpr:
+            packets = filter(self.cap_filter_accepts, packets)
         if self.passthru:
-            self.dump_packet(packet)
-        self.packetmodel.new_packet(packet)
+            for packet in packets:
+                self.dump_packet(packet)
+        self.packetmodel.new_packets(packets)
+
+    def new_records(self, first, count, colors, records):
+        self.packetmodel.new_records(first, count, colors, records)
+        if self.passthru and self.dumper is not None:
+            if records is None:
+                records = xrange(first, first + count)
+            for i in records:
+                self.dumper.dump(*self.reader.record(i))
+            sys.stdout.flush()
+
+    def index_finished(self):
+        # the capture filter only applies to the records still to be read
+        self.filterpane.cap_filter_edit.setEnabled(False)
+        self.filterpane.cap_filter_clear.setEnabled(False)
+
+    def search(self, text, is_bytes, forward):
+        text = str(text)
+        current = self.proxy.mapToSource(self.packetview.currentIndex())
+        if current.isValid():
+            start = current.row()
+        else:
+            start = -1 if forward else self.packetmodel.rowCount()
+        try:
+            if is_bytes:
+                row = self.packetmodel.find(start, forward,
+                                            regex=byte_pattern(text),
+                                            accept=self.row_visible)
+            else:
+                row = self.packetmodel.find(start, forward, expr=text,
+                                            accept=self.row_visible)
+        except (ValueError, SyntaxError), e:
+            self.searchpane.set_status(str(e))
+            return
+        if row < 0:
+            self.searchpane.set_status("Not found")
+            return
+        self.searchpane.set_status("")
+        index = self.proxy.mapFromSource(self.packetmodel.index(row, 0))
+        self.packetview.setCurrentIndex(index)
+        self.packetview.scrollTo(index)
+
+    def row_visible(self, row):
+        index = self.packetmodel.index(row, 0)
+        return self.proxy.mapFromSource(index).isValid()
+
+    def cap_filter_accepts(self, packet):
+        try:
+            return bool(eval(self.filterexpr, USBMON_TRANSFER_TYPE, packet))
+        except Exception:
+            return False
 
     def new_cap_filter(self, e):
         self.filterexpr = str(e)
+        if self.reader is not None:
+            # applied as the file is indexed
+            code = None
+            if self.filterexpr:
+                try:
+                    code = compile(self.filterexpr, '<filter>', 'eval')
+                except SyntaxError:
+                    # as in live mode, nothing gets through
+                    code = compile('False', '<filter>', 'eval')
+            self.indexthread.cap_filter = code
 
     def dump_packet(self, pack):
         if self.dumper is not None:
@@ -523,6 +1281,12 @@ if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-p", "--passthru", default=False, action="store_true",
             help="Start with passthru enabled.")
+    parser.add_option("--ring-packets", type="int", metavar="N",
+            help="Keep only the last N packets, evicting older ones.")
+    parser.add_option("--ring-bytes", type="int", metavar="N",
+            help="Keep only the last N bytes of packets, evicting older ones.")
+    parser.add_option("--spill", metavar="FILE",
+            help="Write packets evicted from the ring buffer to pcap FILE.")
     (options, args) = parser.parse_args()
     app = USBView(sys.argv, options, args)
     sys.exit(app.exec_())
@@ -22,6 +22,8 @@
 
 """Miscellaneous utilities"""
 
+from collections import OrderedDict
+
 def reverse_update_dict(dictionary):
     """Update dictionary by adding val => key
 
@@ -46,6 +48,50 @@ def apply_mask(mask, oval, nval):
     """
     return ((mask & nval) | ( ~mask & oval ))
 
+class LRUCache(object):
+    """Mapping of at most maxsize items, forgetting the least recently used
+    item when full.
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c.get('a')
+    1
+    >>> c['c'] = 3
+    >>> 'b' in c, 'a' in c, len(c)
+    (False, True, 2)
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()